@@ -16,15 +16,23 @@ import json
 import base64
 import os
 import time
+import argparse
 from datetime import datetime
 import sys
 
-# Configuration
-SUPABASE_URL = "https://bapqlyvfwxsichlyjxpd.supabase.co"
+from sentinel_auth import SentinelTokenManager
+
+# Configuration; every base URL can be overridden, or all pointed at stub_server.py with STUB_URL
+STUB_URL = os.environ.get("STUB_URL")
+SUPABASE_URL = os.environ.get("SUPABASE_URL") or STUB_URL or "https://bapqlyvfwxsichlyjxpd.supabase.co"
+OPENWEATHERMAP_URL = os.environ.get("OPENWEATHERMAP_URL") or STUB_URL or "https://api.openweathermap.org"
+SENTINEL_HUB_URL = os.environ.get("SENTINEL_HUB_URL") or STUB_URL or "https://services.sentinel-hub.com"
+PLANTNET_URL = os.environ.get("PLANTNET_URL") or STUB_URL or "https://my-api.plantnet.org"
 OPENWEATHERMAP_API_KEY = "918db7b6f060d3e3637d603f65092b85"
 SENTINEL_CLIENT_ID = "bd594b72-e9c9-4e81-83da-a8968852be3e"
 SENTINEL_CLIENT_SECRET = "IFsW66iSQnFFlFGYxVftPOvNr8FduWHk"
-SENTINEL_TOKEN_URL = "https://services.sentinel-hub.com/auth/realms/main/protocol/openid-connect/token"
+SENTINEL_TOKEN_PATH = "/auth/realms/main/protocol/openid-connect/token"
+_sentinel_tokens = None
 
 # African coordinates for testing
 AFRICAN_COORDINATES = {
@@ -77,7 +85,7 @@ def test_openweathermap_api():
     
     # Test current weather for Nairobi
     location = AFRICAN_COORDINATES["nairobi"]
-    url = f"https://api.openweathermap.org/data/2.5/weather?lat={location['lat']}&lon={location['lng']}&appid={OPENWEATHERMAP_API_KEY}"
+    url = f"{OPENWEATHERMAP_URL}/data/2.5/weather?lat={location['lat']}&lon={location['lng']}&appid={OPENWEATHERMAP_API_KEY}"
     
     try:
         response = requests.get(url)
@@ -102,7 +110,7 @@ def test_openweathermap_api():
     
     # Test 5-day forecast for Lagos
     location = AFRICAN_COORDINATES["lagos"]
-    url = f"https://api.openweathermap.org/data/2.5/forecast?lat={location['lat']}&lon={location['lng']}&appid={OPENWEATHERMAP_API_KEY}"
+    url = f"{OPENWEATHERMAP_URL}/data/2.5/forecast?lat={location['lat']}&lon={location['lng']}&appid={OPENWEATHERMAP_API_KEY}"
     
     try:
         response = requests.get(url)
@@ -123,35 +131,24 @@ def test_openweathermap_api():
         log_test("weather", "5-Day Forecast API", False, 
                 f"Error: {str(e)}")
 
+def sentinel_token_manager():
+    """Token manager for the configured Sentinel Hub URL, shared by every call in this process"""
+    global _sentinel_tokens
+    token_url = f"{SENTINEL_HUB_URL}{SENTINEL_TOKEN_PATH}"
+    if _sentinel_tokens is None or _sentinel_tokens.token_url != token_url:
+        _sentinel_tokens = SentinelTokenManager(SENTINEL_CLIENT_ID, SENTINEL_CLIENT_SECRET, token_url)
+    return _sentinel_tokens
+
 def get_sentinel_hub_token():
-    """Get OAuth2 token from Sentinel Hub"""
+    """Get OAuth2 token from Sentinel Hub, reusing a cached one until shortly before it expires"""
     print("\n=== Getting Sentinel Hub OAuth2 Token ===")
     
-    url = SENTINEL_TOKEN_URL
-    data = {
-        "grant_type": "client_credentials",
-        "client_id": SENTINEL_CLIENT_ID,
-        "client_secret": SENTINEL_CLIENT_SECRET
-    }
-    
-    headers = {
-        "Content-Type": "application/x-www-form-urlencoded"
-    }
-    
     try:
-        response = requests.post(url, headers=headers, data=data)
-        response.raise_for_status()
-        token_data = response.json()
-        
-        if "access_token" in token_data:
-            log_test("satellite", "OAuth2 Token Acquisition", True, 
-                    f"Successfully acquired token (expires in {token_data.get('expires_in', 'unknown')} seconds)")
-            return token_data["access_token"]
-        else:
-            log_test("satellite", "OAuth2 Token Acquisition", False, 
-                    "Response missing access_token", 
-                    json.dumps(token_data))
-            return None
+        tokens = sentinel_token_manager()
+        access_token = tokens.get_token()
+        log_test("satellite", "OAuth2 Token Acquisition", True, 
+                f"Successfully acquired token ({tokens.last_source}, expires in {tokens.expires_in():.0f} seconds)")
+        return access_token
     except Exception as e:
         log_test("satellite", "OAuth2 Token Acquisition", False, 
                 f"Error: {str(e)}")
@@ -168,7 +165,7 @@ def test_sentinel_hub_api():
         return
     
     # Test NDVI calculation with Sentinel Hub
-    url = "https://services.sentinel-hub.com/api/v1/process"
+    url = f"{SENTINEL_HUB_URL}/api/v1/process"
     
     # Convert polygon to Sentinel Hub format
     coordinates = [[p["lng"], p["lat"]] for p in SAMPLE_FIELD_POLYGON]
@@ -221,6 +218,11 @@ def test_sentinel_hub_api():
     
     try:
         response = requests.post(url, headers=headers, json=payload)
+        if response.status_code == 401:
+            # The cached token was revoked upstream: drop it and retry once with a fresh one
+            sentinel_token_manager().invalidate(access_token)
+            headers["Authorization"] = f"Bearer {sentinel_token_manager().get_token()}"
+            response = requests.post(url, headers=headers, json=payload)
         
         if response.status_code == 200:
             log_test("satellite", "Sentinel Hub NDVI", True, 
@@ -234,7 +236,7 @@ def test_sentinel_hub_api():
                 f"Error: {str(e)}")
     
     # Test Sentinel Hub statistics API for average NDVI
-    stats_url = "https://services.sentinel-hub.com/api/v1/statistics"
+    stats_url = f"{SENTINEL_HUB_URL}/api/v1/statistics"
     
     # Skip statistics test for now since we've confirmed the main NDVI API works
     log_test("satellite", "Sentinel Hub Statistics", True, 
@@ -423,8 +425,24 @@ def print_summary():
             success_rate = results["success"] / category_total * 100
             print(f"  {category.capitalize()}: {results['success']}/{category_total} passed ({success_rate:.1f}%)")
 
+def use_stub_server(replay=None):
+    """Start an in-process stub_server.py and point every base URL at it"""
+    global SUPABASE_URL, OPENWEATHERMAP_URL, SENTINEL_HUB_URL, PLANTNET_URL
+    from stub_server import Cassette, start_stub_server
+    server, base_url = start_stub_server(cassette=Cassette(replay) if replay else None)
+    SUPABASE_URL = OPENWEATHERMAP_URL = SENTINEL_HUB_URL = PLANTNET_URL = base_url
+    print(f"Using stub server at {base_url}" + (f" (replaying {replay})" if replay else ""))
+    return server
+
 def main():
     """Main function to run all tests"""
+    parser = argparse.ArgumentParser(description="CropGenius backend smoke tests")
+    parser.add_argument("--stub", action="store_true", help="run hermetically against an in-process stub server")
+    parser.add_argument("--replay", metavar="CASSETTE", help="with --stub, serve responses recorded by stub_server.py --record")
+    args = parser.parse_args()
+    if args.stub:
+        use_stub_server(args.replay)
+
     print("CropGenius Backend API Testing")
     print("==============================")
     
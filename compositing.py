@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+"""
+Cloud-masked temporal compositing of Sentinel-2 field imagery.
+
+The statistics evalscript in backend_test.py only drops dataMask == 0
+pixels, so clouds, their shadows and cirrus leak into the daily means. Here
+a stack of daily scenes (geotiff.Raster with COMPOSITE_BANDS: reflectance
+plus the L2A scene classification SCL and dataMask) is reduced to one clean
+composite per period:
+
+  max_ndvi  per pixel, the clear observation with the highest NDVI (all
+            bands taken from that day, so the composite stays consistent)
+  median    per pixel and band, the median of the clear observations
+
+Pixels count as clear unless SCL marks them no data, saturated, cloud
+shadow, medium/high probability cloud, thin cirrus or snow (MASKED_CLASSES).
+Scenes are read as row blocks of memory-mapped tiles and streamed over the
+time axis in chunks of time_chunk scenes. Max-NDVI keeps a running best per
+pixel, so its memory does not depend on the number of scenes. The median
+needs every observation of a pixel, so it sizes row blocks to fit the whole
+time series in memory_budget bytes.
+
+    scenes = [tiles.read(field) for tiles in daily_tiles]  # see daily_scenes()
+    composite = max_ndvi_composite(scenes)
+    composite.ndvi, composite.clear, composite.to_raster()
+
+    python compositing.py --scenes 30 --size 1024
+    python compositing.py --stub --days 20
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+import numpy as np
+
+import geotiff
+from ndvi_engine import DN_SCALE
+
+COMPOSITE_BANDS = ("B02", "B03", "B04", "B08", "SCL", "dataMask")
+REFLECTANCE_BANDS = ("B02", "B03", "B04", "B08")
+COMPOSITE_EVALSCRIPT = """
+//VERSION=3
+function setup() {
+  return {
+    input: [{bands: ["B02", "B03", "B04", "B08", "SCL", "dataMask"]}],
+    output: { bands: 6, sampleType: 'UINT16' }
+  };
+}
+function evaluatePixel(sample) {
+  return [sample.B02 * 10000, sample.B03 * 10000, sample.B04 * 10000, sample.B08 * 10000,
+          sample.SCL, sample.dataMask];
+}
+"""
+# Sentinel-2 L2A scene classification
+SCL_CLASSES = {0: "no data", 1: "saturated or defective", 2: "dark area", 3: "cloud shadow", 4: "vegetation",
+               5: "not vegetated", 6: "water", 7: "unclassified", 8: "cloud medium probability",
+               9: "cloud high probability", 10: "thin cirrus", 11: "snow or ice"}
+MASKED_CLASSES = (0, 1, 3, 8, 9, 10, 11)
+TIME_CHUNK = 8  # scenes reduced together
+MEMORY_BUDGET = 256 << 20  # bytes of stacked observations the median holds at once
+BLOCK_ROWS = 256  # rows per block for max-NDVI
+METHODS = ("max_ndvi", "median")
+
+
+def clear_mask(scl, data_mask=None, masked_classes=MASKED_CLASSES):
+    """Boolean array, True where a pixel's scene class is usable (and dataMask is set)"""
+    lookup = np.ones(256, dtype=bool)
+    lookup[list(masked_classes)] = False
+    clear = lookup[np.minimum(scl, 255).astype(np.uint8)]
+    if data_mask is not None:
+        clear &= data_mask != 0
+    return clear
+
+
+class Composite:
+    """A period's composite: float32 reflectance bands (NaN without a clear observation),
+    NDVI, the number of clear observations per pixel and, for max-NDVI, which scene each pixel came from"""
+
+    def __init__(self, bands, band_names, ndvi, clear, source, transform, method, scenes):
+        self.bands = bands
+        self.band_names = tuple(band_names)
+        self.ndvi = ndvi
+        self.clear = clear
+        self.source = source
+        self.transform = transform
+        self.method = method
+        self.scenes = scenes
+
+    @property
+    def shape(self):
+        return self.ndvi.shape
+
+    def band(self, name):
+        return self.bands[:, :, self.band_names.index(name)]
+
+    def coverage(self):
+        """Fraction of pixels with at least one clear observation"""
+        return float(np.count_nonzero(self.clear) / self.clear.size)
+
+    def to_raster(self):
+        """geotiff.Raster of the reflectance bands plus NDVI and the clear-observation count"""
+        data = np.concatenate([self.bands, self.ndvi[:, :, None], self.clear[:, :, None].astype(np.float32)],
+                              axis=2)
+        return geotiff.Raster(data, self.transform, self.band_names + ("NDVI", "clear"))
+
+
+def _check(scenes, bands):
+    if not scenes:
+        raise ValueError("no scenes to composite")
+    shape = scenes[0].shape
+    for scene in scenes:
+        if scene.shape != shape:
+            raise ValueError(f"scene shapes differ: {scene.shape} != {shape}")
+        missing = [name for name in bands + ("SCL",) if name not in scene.band_names]
+        if missing:
+            raise KeyError(f"scene has no {', '.join(missing)} band")
+    return shape
+
+
+def _read_chunk(scenes, rows, bands, masked_classes, scale):
+    """(chunk, rows, width, bands) float32 reflectance with NaN where not clear, and the clear mask"""
+    height = rows.stop - rows.start
+    width = scenes[0].shape[1]
+    stack = np.empty((len(scenes), height, width, len(bands)), dtype=np.float32)
+    clear = np.empty((len(scenes), height, width), dtype=bool)
+    for t, scene in enumerate(scenes):
+        names = scene.band_names
+        data_mask = scene.band("dataMask")[rows] if "dataMask" in names else None
+        clear[t] = clear_mask(scene.band("SCL")[rows], data_mask, masked_classes)
+        for b, name in enumerate(bands):
+            band = scene.band(name)[rows]
+            factor = DN_SCALE if scale is None and not np.issubdtype(band.dtype, np.floating) else scale or 1.0
+            np.multiply(band, np.float32(factor), out=stack[t, :, :, b], casting="unsafe")
+    stack[~clear] = np.nan
+    return stack, clear
+
+
+def _ndvi(red, nir):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (nir - red) / (nir + red)
+
+
+def max_ndvi_composite(scenes, bands=REFLECTANCE_BANDS, time_chunk=TIME_CHUNK, block_rows=BLOCK_ROWS,
+                       masked_classes=MASKED_CLASSES, scale=None):
+    """Per pixel, all bands of the clear observation with the highest NDVI"""
+    height, width = _check(scenes, bands)
+    red, nir = bands.index("B04"), bands.index("B08")
+    composite = np.full((height, width, len(bands)), np.nan, dtype=np.float32)
+    best = np.full((height, width), -np.inf, dtype=np.float32)
+    clear_count = np.zeros((height, width), dtype=np.uint16)
+    source = np.full((height, width), -1, dtype=np.int16)
+    for start in range(0, height, block_rows):
+        rows = slice(start, min(height, start + block_rows))
+        for first in range(0, len(scenes), time_chunk):
+            stack, clear = _read_chunk(scenes[first:first + time_chunk], rows, bands, masked_classes, scale)
+            ndvi = _ndvi(stack[..., red], stack[..., nir])
+            ndvi[~np.isfinite(ndvi)] = -np.inf
+            pick = np.argmax(ndvi, axis=0)
+            chunk_best = np.take_along_axis(ndvi, pick[None], axis=0)[0]
+            better = chunk_best > best[rows]
+            best[rows][better] = chunk_best[better]
+            picked = np.take_along_axis(stack, pick[None, :, :, None], axis=0)[0]
+            composite[rows][better] = picked[better]
+            source[rows][better] = (pick + first)[better]
+            clear_count[rows] += clear.sum(axis=0, dtype=np.uint16)
+    best[~np.isfinite(best)] = np.nan
+    return Composite(composite, bands, best, clear_count, source, scenes[0].transform, "max_ndvi", len(scenes))
+
+
+def _nan_median(stack):
+    """Median over axis 0 ignoring NaN, via one in-place sort (NaN sorts last) instead of np.nanmedian
+
+    stack is left sorted along axis 0.
+    """
+    stack.sort(axis=0)
+    valid = np.zeros(stack.shape[1:], dtype=np.intp)
+    for layer in stack:
+        valid += ~np.isnan(layer)
+    low = np.take_along_axis(stack, (np.maximum(valid - 1, 0) // 2)[None], axis=0)[0]
+    high = np.take_along_axis(stack, (valid // 2)[None], axis=0)[0]
+    median = np.where(valid % 2 == 1, low, (low + high) / 2)
+    median[valid == 0] = np.nan
+    return median
+
+
+def median_composite(scenes, bands=REFLECTANCE_BANDS, time_chunk=TIME_CHUNK, memory_budget=MEMORY_BUDGET,
+                     masked_classes=MASKED_CLASSES, scale=None):
+    """Per pixel and band, the median of the clear observations
+
+    memory_budget bytes bound the arrays allocated here (scenes are read
+    through memory maps): the outputs, plus row blocks sized so the block
+    stack, _read_chunk's buffers and the median's temporaries fit in the
+    rest. Outputs larger than the budget fall back to one row per block.
+    """
+    height, width = _check(scenes, bands)
+    red, nir = bands.index("B04"), bands.index("B08")
+    chunk = min(time_chunk, len(scenes))
+    # composite, clear_count, and the NDVI with its two temporaries
+    fixed = height * width * (4 * len(bands) + 2 + 3 * 4)
+    # block stack (sorted in place), one _read_chunk (values, clear mask and its inverse),
+    # and _nan_median's count, index, low/high/mean/median arrays
+    per_row = width * (len(scenes) * len(bands) * 4 + chunk * (len(bands) * 4 + 2) + 40 * len(bands))
+    block_rows = max(1, min(height, (memory_budget - fixed) // per_row))
+    composite = np.empty((height, width, len(bands)), dtype=np.float32)
+    clear_count = np.zeros((height, width), dtype=np.uint16)
+    stack = np.empty((len(scenes), block_rows, width, len(bands)), dtype=np.float32)
+    for start in range(0, height, block_rows):
+        rows = slice(start, min(height, start + block_rows))
+        block = stack[:, :rows.stop - rows.start]
+        for first in range(0, len(scenes), chunk):
+            values, clear = _read_chunk(scenes[first:first + chunk], rows, bands, masked_classes, scale)
+            block[first:first + len(values)] = values
+            clear_count[rows] += clear.sum(axis=0, dtype=np.uint16)
+            del values, clear
+        composite[rows] = _nan_median(block)
+    del stack, block
+    ndvi = _ndvi(composite[..., red], composite[..., nir])
+    return Composite(composite, bands, ndvi, clear_count, None, scenes[0].transform, "median", len(scenes))
+
+
+def composite(scenes, method="max_ndvi", **options):
+    if method not in METHODS:
+        raise ValueError(f"unknown compositing method {method!r}; expected one of {', '.join(METHODS)}")
+    return (max_ndvi_composite if method == "max_ndvi" else median_composite)(scenes, **options)
+
+
+def composite_periods(scenes, days, period_days=10, method="max_ndvi", **options):
+    """[(first day of period, Composite)] for scenes grouped into consecutive period_days windows"""
+    days = [day if isinstance(day, date) else date.fromisoformat(str(day)) for day in days]
+    if len(days) != len(scenes):
+        raise ValueError("one day per scene expected")
+    periods = {}
+    origin = min(days)
+    for scene, day in sorted(zip(scenes, days), key=lambda pair: pair[1]):
+        start = origin + timedelta(days=(day - origin).days // period_days * period_days)
+        periods.setdefault(start, []).append(scene)
+    return [(start, composite(group, method, **options)) for start, group in sorted(periods.items())]
+
+
+def daily_scenes(client, geometry, days, **tile_options):
+    """One geotiff.Raster of COMPOSITE_BANDS per day over a field's bbox, via the imagery cache"""
+    from imagery_cache import TiledImagery, geometry_bounds
+
+    bounds = geometry_bounds(geometry)
+    for day in days:
+        tiles = TiledImagery(client, evalscript=COMPOSITE_EVALSCRIPT, band_names=COMPOSITE_BANDS,
+                             time_range=(day.isoformat(), day.isoformat()), **tile_options)
+        yield tiles.read_bounds(bounds)
+
+
+def synthetic_scenes(count, size, directory, seed=3, cloud_cover=0.35):
+    """Memory-mapped UINT16 scenes of a static canopy under moving clouds (with SCL), and the true NDVI"""
+    from stub_apis import _band, _vegetation
+
+    rng = np.random.default_rng(seed)
+    vegetation = _vegetation(size, size, seed)
+    truth = {name: _band(name, vegetation, 0, seed) for name in REFLECTANCE_BANDS}
+    true_ndvi = _ndvi(truth["B04"], truth["B08"])
+    rows, cols = np.ogrid[:size, :size]
+    scenes = []
+    for t in range(count):
+        pixels = np.empty((size, size, len(COMPOSITE_BANDS)), dtype=np.uint16)
+        # Sensor noise and a little residual haze on every day
+        haze = np.float32(rng.uniform(0, 0.02))
+        cloud = np.zeros((size, size), dtype=bool)
+        shadow = np.zeros((size, size), dtype=bool)
+        while cloud.mean() < cloud_cover * rng.uniform(0.2, 1.8) and cloud.mean() < 0.95:
+            cy, cx = rng.uniform(0, size, 2)
+            radius = rng.uniform(0.05, 0.2) * size
+            blob = (rows - cy) ** 2 + (cols - cx) ** 2 < radius ** 2
+            cloud |= blob
+            shadow |= np.roll(blob, (int(radius / 3), int(radius / 4)), axis=(0, 1))
+        shadow &= ~cloud
+        for index, name in enumerate(REFLECTANCE_BANDS):
+            values = truth[name] + haze + rng.normal(0, 0.005, (size, size)).astype(np.float32)
+            values[cloud] = rng.uniform(0.35, 0.6)  # bright, flat spectrum: NDVI near 0
+            values[shadow] *= 0.4
+            pixels[:, :, index] = np.rint(np.clip(values, 0, 1) * 10000)
+        scl = np.where(vegetation > 0.3, 4, 5)
+        scl[shadow] = 3
+        scl[cloud] = 9
+        pixels[:, :, 4] = scl
+        pixels[:, :, 5] = 1
+        path = os.path.join(directory, f"scene_{t:03d}.tif")
+        geotiff.save_raster(path, pixels, (36.0, 1e-4, -1.0, -1e-4))
+        scenes.append(geotiff.open_raster(path, COMPOSITE_BANDS))
+    return scenes, true_ndvi
+
+
+def run_benchmark(scenes=30, size=1024, time_chunk=TIME_CHUNK, memory_mb=64, directory=None):
+    from field_zonal import ZonalEngine, random_fields
+
+    if directory is None:
+        with tempfile.TemporaryDirectory(prefix="compositing_") as directory:
+            return run_benchmark(scenes, size, time_chunk, memory_mb, directory)
+    stack, truth = synthetic_scenes(scenes, size, directory)
+    transform = stack[0].transform
+    fields = random_fields(200, transform, (size, size))
+    engine = ZonalEngine()
+    true_means = engine.stats(truth, transform, fields, percentiles=())["mean"]
+
+    # What the statistics evalscript does today: per-day field means with only dataMask applied
+    daily = np.array([engine.stats(_ndvi(scene.band("B04") * np.float32(DN_SCALE),
+                                         scene.band("B08") * np.float32(DN_SCALE)),
+                                   transform, fields, percentiles=())["mean"] for scene in stack])
+    daily_error = np.abs(daily - true_means).mean()
+    average_error = np.abs(daily.mean(axis=0) - true_means).mean()
+    print(f"{scenes} scenes of {size}x{size}, 200 fields")
+    print(f"  daily field means, dataMask only: mean |error| {daily_error:.3f} per day, "
+          f"{average_error:.3f} averaged over the period")
+
+    for method in METHODS:
+        tracemalloc.start()
+        started = time.perf_counter()
+        options = {"time_chunk": time_chunk}
+        if method == "median":
+            options["memory_budget"] = memory_mb << 20
+        result = composite(stack, method, **options)
+        elapsed = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        means = engine.stats(result.ndvi, transform, fields, percentiles=())["mean"]
+        error = np.nanmean(np.abs(means - true_means))
+        print(f"  {method}: {elapsed:.2f}s, peak {peak / 1e6:.0f} MB, coverage {result.coverage():.1%}, "
+              f"field mean |error| {error:.3f}")
+
+    full = scenes * size * size * len(REFLECTANCE_BANDS) * 4
+    print(f"  (the whole float32 stack alone would take {full / 1e6:.0f} MB)")
+    for scene in stack:
+        os.unlink(scene.path)
+
+
+def run_stub_demo(days, period_days, latency):
+    from backend_test import SAMPLE_FIELD_POLYGON
+    from backend_test_new import SENTINEL_CLIENT_ID, SENTINEL_CLIENT_SECRET, SENTINEL_TOKEN_PATH
+    from imagery_cache import ImageryCache, ProcessClient
+    from sentinel_auth import SentinelTokenManager
+    from stub_server import start_stub_server
+
+    server, base_url = start_stub_server(latency=latency)
+    tokens = SentinelTokenManager(SENTINEL_CLIENT_ID, SENTINEL_CLIENT_SECRET, f"{base_url}{SENTINEL_TOKEN_PATH}",
+                                  cache_dir=None)
+    centre = SAMPLE_FIELD_POLYGON[0]
+    field = [{"lat": centre["lat"] + (p["lat"] - centre["lat"]) * 30, "lng": centre["lng"] + (p["lng"] - centre["lng"]) * 30}
+             for p in SAMPLE_FIELD_POLYGON]
+    first = date.today() - timedelta(days=days)
+    dates = [first + timedelta(days=i) for i in range(days)]
+    with tempfile.TemporaryDirectory(prefix="imagery_cache_") as directory:
+        client = ProcessClient(tokens, base_url, cache=ImageryCache(directory))
+        scenes = list(daily_scenes(client, field, dates))
+        for start, result in composite_periods(scenes, dates, period_days):
+            print(f"  period from {start}: {result.scenes} scenes, {result.shape[1]}x{result.shape[0]} px, "
+                  f"coverage {result.coverage():.0%}, mean NDVI {np.nanmean(result.ndvi):.3f}")
+    print(f"  {client.requests} tile requests for {days} days")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenes", type=int, default=30, help="synthetic daily scenes in the benchmark")
+    parser.add_argument("--size", type=int, default=1024, help="benchmark scene size in pixels")
+    parser.add_argument("--time-chunk", type=int, default=TIME_CHUNK)
+    parser.add_argument("--memory-mb", type=int, default=64, help="median composite memory budget")
+    parser.add_argument("--stub", action="store_true", help="composite a field fetched from an in-process stub server")
+    parser.add_argument("--stub-latency", type=float, default=0.02)
+    parser.add_argument("--days", type=int, default=20)
+    parser.add_argument("--period", type=int, default=10, help="days per composite")
+    args = parser.parse_args()
+
+    if args.stub:
+        run_stub_demo(args.days, args.period, args.stub_latency)
+    else:
+        run_benchmark(args.scenes, args.size, args.time_chunk, args.memory_mb)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
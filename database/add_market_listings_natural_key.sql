@@ -0,0 +1,13 @@
+-- CropGenius Market Intelligence: idempotent ingestion support
+-- Adds the natural-key columns used by `insert_market_listings.py --upsert`
+-- to an existing market_listings table. Safe to run more than once.
+
+ALTER TABLE public.market_listings ADD COLUMN IF NOT EXISTS natural_key TEXT;
+ALTER TABLE public.market_listings ADD COLUMN IF NOT EXISTS content_hash TEXT;
+
+COMMENT ON COLUMN public.market_listings.natural_key IS 'Client-side hash of (crop_type, variety, location, harvest_date) used for idempotent upserts';
+COMMENT ON COLUMN public.market_listings.content_hash IS 'Client-side hash of the mutable columns, used to skip unchanged rows';
+
+-- on_conflict=natural_key requires a unique index; NULL keys (rows inserted
+-- without upsert mode) never conflict with each other
+CREATE UNIQUE INDEX IF NOT EXISTS idx_market_listings_natural_key ON public.market_listings(natural_key);
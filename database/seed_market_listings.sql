@@ -0,0 +1,66 @@
+-- CropGenius Market Intelligence sample data
+-- Generated by market_schema.py - edit the schema there and run `python market_schema.py --write`
+-- Inserts only seed listings whose natural_key is not present yet, so it is safe to run more than once
+
+-- Key seed rows stored without a natural_key
+UPDATE public.market_listings AS listing SET natural_key = seed.natural_key, content_hash = seed.content_hash
+FROM (VALUES 
+  -- Kenya Markets
+  ('Maize', 'Yellow Dent', 0.35, 'kg', 2500, 'Nairobi Central Market', -1.286389, 36.817223, 'api_integration', 4, TIMESTAMP WITH TIME ZONE '2025-05-02T00:00:00+00:00', true, '647085656184cae6e0f90f72e40d036a', '3dcc6a6f8cf88e1198f576f33203f457'),
+  ('Tomato', 'Roma', 0.8, 'kg', 500, 'Mombasa Market', -4.043477, 39.658871, 'user_input', 5, TIMESTAMP WITH TIME ZONE '2025-05-25T00:00:00+00:00', true, '5fa2cb9c08f95416edabb6fd440af8d6', '3638da214e500cffec482c24f159adfd'),
+  ('Beans', 'Kidney Beans', 1.1, 'kg', 800, 'Kisumu Market', -0.091702, 34.767956, 'partner_feed', 4, TIMESTAMP WITH TIME ZONE '2025-05-18T00:00:00+00:00', true, '77aa8e26c0bf4b3686c9cab07430a700', '8e67750835ab5dc1ee2f4c6f07e52a14'),
+  
+  -- Nigeria Markets
+  ('Cassava', 'Sweet Cassava', 0.25, 'kg', 1800, 'Lagos State Market', 6.5244, 3.3792, 'user_input', 3, TIMESTAMP WITH TIME ZONE '2025-05-18T00:00:00+00:00', true, '3e3f79cd5fbfedfbccccc94f1ecb4a54', '0c69cd1aaa33d6c27a5b686ef30997e6'),
+  ('Yam', 'White Yam', 0.45, 'kg', 1200, 'Kano Market', 12.0022, 8.592, 'web_scraped', 4, TIMESTAMP WITH TIME ZONE '2025-05-11T00:00:00+00:00', true, 'f1f0416dfb2ad06bd29c10e90bd33608', '099d8e16de86641ef3520224bf957bc1'),
+  ('Rice', 'Local Rice', 0.95, 'kg', 3000, 'Port Harcourt Market', 4.8156, 7.0498, 'api_integration', 3, TIMESTAMP WITH TIME ZONE '2025-04-17T00:00:00+00:00', true, '60e885cc6d290d7adcf99f161dcb6f58', '3a4de438f8b6c785ca7aa2555dffc9ac'),
+  
+  -- Ghana Markets
+  ('Cocoa', 'Trinitario', 2.2, 'kg', 500, 'Accra Central Market', 5.6037, -0.187, 'partner_feed', 5, TIMESTAMP WITH TIME ZONE '2025-05-25T00:00:00+00:00', true, 'd83c43c064b561777aaafd98b5b83d5f', 'c57322a4d98cf7903f5c2b1936767f14'),
+  ('Plantain', 'False Horn', 0.6, 'kg', 1500, 'Kumasi Market', 6.6885, -1.6244, 'user_input', 4, TIMESTAMP WITH TIME ZONE '2025-05-22T00:00:00+00:00', true, '4b4162d058e97557599d06266285fdac', 'e0b0921c7c5fab7d0ee2f2fc3f328cde'),
+  
+  -- Uganda Markets
+  ('Coffee', 'Arabica', 3.5, 'kg', 200, 'Kampala Market', 0.3476, 32.5825, 'api_integration', 5, TIMESTAMP WITH TIME ZONE '2025-05-11T00:00:00+00:00', true, 'b35996ecd0d45d94b8a7da454077d4bd', 'bdd150eb2ad3b0e49f69550c4e5a4752'),
+  ('Matooke', 'Green Bananas', 0.4, 'kg', 800, 'Jinja Market', 0.4236, 33.2042, 'user_input', 4, TIMESTAMP WITH TIME ZONE '2025-05-27T00:00:00+00:00', true, '8b28ad8540980c7b4e2aebd3690e64f3', 'ccd358137f5cc88e42abe34af90da604'),
+  
+  -- Ethiopia Markets
+  ('Teff', 'White Teff', 1.8, 'kg', 600, 'Addis Ababa Market', 9.145, 40.4897, 'web_scraped', 4, TIMESTAMP WITH TIME ZONE '2025-05-04T00:00:00+00:00', true, '6d4bcbd10dd95ad445e64676e0f48acb', 'cc207281c9cff3b24c034a71ed5bf4c3'),
+  ('Sorghum', 'Red Sorghum', 0.55, 'kg', 1000, 'Dire Dawa Market', 9.5915, 41.8661, 'partner_feed', 3, TIMESTAMP WITH TIME ZONE '2025-04-27T00:00:00+00:00', true, '50e760ab3659fc75a53565f8894c5980', 'de8df5134c2c660b19a9d49869aadc82')
+) AS seed (crop_type, variety, price_per_unit, unit, quantity_available, location_name, location_lat, location_lng, source, quality_rating, harvest_date, is_active, natural_key, content_hash)
+WHERE listing.id = (
+  SELECT existing.id FROM public.market_listings existing
+  WHERE existing.natural_key IS NULL AND existing.crop_type = seed.crop_type
+    AND existing.variety IS NOT DISTINCT FROM seed.variety
+    AND existing.location_name IS NOT DISTINCT FROM seed.location_name
+    AND (existing.harvest_date AT TIME ZONE 'UTC')::date = (seed.harvest_date AT TIME ZONE 'UTC')::date
+  ORDER BY existing.id LIMIT 1
+)
+AND NOT EXISTS (SELECT 1 FROM public.market_listings keyed WHERE keyed.natural_key = seed.natural_key);
+
+-- Insert sample African market data
+INSERT INTO public.market_listings (crop_type, variety, price_per_unit, unit, quantity_available, location_name, location_lat, location_lng, source, quality_rating, harvest_date, is_active, natural_key, content_hash)
+SELECT seed.crop_type, seed.variety, seed.price_per_unit, seed.unit, seed.quantity_available, seed.location_name, seed.location_lat, seed.location_lng, seed.source, seed.quality_rating, seed.harvest_date, seed.is_active, seed.natural_key, seed.content_hash
+FROM (VALUES 
+  -- Kenya Markets
+  ('Maize', 'Yellow Dent', 0.35, 'kg', 2500, 'Nairobi Central Market', -1.286389, 36.817223, 'api_integration', 4, TIMESTAMP WITH TIME ZONE '2025-05-02T00:00:00+00:00', true, '647085656184cae6e0f90f72e40d036a', '3dcc6a6f8cf88e1198f576f33203f457'),
+  ('Tomato', 'Roma', 0.8, 'kg', 500, 'Mombasa Market', -4.043477, 39.658871, 'user_input', 5, TIMESTAMP WITH TIME ZONE '2025-05-25T00:00:00+00:00', true, '5fa2cb9c08f95416edabb6fd440af8d6', '3638da214e500cffec482c24f159adfd'),
+  ('Beans', 'Kidney Beans', 1.1, 'kg', 800, 'Kisumu Market', -0.091702, 34.767956, 'partner_feed', 4, TIMESTAMP WITH TIME ZONE '2025-05-18T00:00:00+00:00', true, '77aa8e26c0bf4b3686c9cab07430a700', '8e67750835ab5dc1ee2f4c6f07e52a14'),
+  
+  -- Nigeria Markets
+  ('Cassava', 'Sweet Cassava', 0.25, 'kg', 1800, 'Lagos State Market', 6.5244, 3.3792, 'user_input', 3, TIMESTAMP WITH TIME ZONE '2025-05-18T00:00:00+00:00', true, '3e3f79cd5fbfedfbccccc94f1ecb4a54', '0c69cd1aaa33d6c27a5b686ef30997e6'),
+  ('Yam', 'White Yam', 0.45, 'kg', 1200, 'Kano Market', 12.0022, 8.592, 'web_scraped', 4, TIMESTAMP WITH TIME ZONE '2025-05-11T00:00:00+00:00', true, 'f1f0416dfb2ad06bd29c10e90bd33608', '099d8e16de86641ef3520224bf957bc1'),
+  ('Rice', 'Local Rice', 0.95, 'kg', 3000, 'Port Harcourt Market', 4.8156, 7.0498, 'api_integration', 3, TIMESTAMP WITH TIME ZONE '2025-04-17T00:00:00+00:00', true, '60e885cc6d290d7adcf99f161dcb6f58', '3a4de438f8b6c785ca7aa2555dffc9ac'),
+  
+  -- Ghana Markets
+  ('Cocoa', 'Trinitario', 2.2, 'kg', 500, 'Accra Central Market', 5.6037, -0.187, 'partner_feed', 5, TIMESTAMP WITH TIME ZONE '2025-05-25T00:00:00+00:00', true, 'd83c43c064b561777aaafd98b5b83d5f', 'c57322a4d98cf7903f5c2b1936767f14'),
+  ('Plantain', 'False Horn', 0.6, 'kg', 1500, 'Kumasi Market', 6.6885, -1.6244, 'user_input', 4, TIMESTAMP WITH TIME ZONE '2025-05-22T00:00:00+00:00', true, '4b4162d058e97557599d06266285fdac', 'e0b0921c7c5fab7d0ee2f2fc3f328cde'),
+  
+  -- Uganda Markets
+  ('Coffee', 'Arabica', 3.5, 'kg', 200, 'Kampala Market', 0.3476, 32.5825, 'api_integration', 5, TIMESTAMP WITH TIME ZONE '2025-05-11T00:00:00+00:00', true, 'b35996ecd0d45d94b8a7da454077d4bd', 'bdd150eb2ad3b0e49f69550c4e5a4752'),
+  ('Matooke', 'Green Bananas', 0.4, 'kg', 800, 'Jinja Market', 0.4236, 33.2042, 'user_input', 4, TIMESTAMP WITH TIME ZONE '2025-05-27T00:00:00+00:00', true, '8b28ad8540980c7b4e2aebd3690e64f3', 'ccd358137f5cc88e42abe34af90da604'),
+  
+  -- Ethiopia Markets
+  ('Teff', 'White Teff', 1.8, 'kg', 600, 'Addis Ababa Market', 9.145, 40.4897, 'web_scraped', 4, TIMESTAMP WITH TIME ZONE '2025-05-04T00:00:00+00:00', true, '6d4bcbd10dd95ad445e64676e0f48acb', 'cc207281c9cff3b24c034a71ed5bf4c3'),
+  ('Sorghum', 'Red Sorghum', 0.55, 'kg', 1000, 'Dire Dawa Market', 9.5915, 41.8661, 'partner_feed', 3, TIMESTAMP WITH TIME ZONE '2025-04-27T00:00:00+00:00', true, '50e760ab3659fc75a53565f8894c5980', 'de8df5134c2c660b19a9d49869aadc82')
+) AS seed (crop_type, variety, price_per_unit, unit, quantity_available, location_name, location_lat, location_lng, source, quality_rating, harvest_date, is_active, natural_key, content_hash)
+WHERE NOT EXISTS (SELECT 1 FROM public.market_listings existing WHERE existing.natural_key = seed.natural_key);
@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+"""
+Perceptual-hash cache of crop-disease detection results.
+
+Farmers rescan the same leaf several times; every scan would otherwise be a
+full PlantNet plus fn-crop-disease round trip. Each photo gets two 64-bit
+perceptual hashes: pHash (sign of the low-frequency DCT of a 32x32
+greyscale thumbnail against its median) and dHash (sign of horizontal
+gradients of a 9x8 thumbnail). Both survive re-encoding, small crops,
+exposure changes and slight rotation, and differ in tens of bits between
+different photos.
+
+Results are partitioned by cropType and a coarse location cell
+(weather_cache.Grid, 0.1 deg by default). Within a partition a
+multi-index hash over pHash finds every entry within `radius` bits while
+verifying only a few candidates, and a match must also agree on dHash
+within dhash_radius. (A BK-tree degenerates at this radius: in 64-bit
+space it ends up visiting most of its nodes.) Entries expire after ttl
+seconds and the least recently used ones are evicted beyond max_entries.
+
+    cache = DetectionCache(ttl=7 * 86400, max_entries=50000)
+    result, hit = cache.get_or_detect(photo_bytes, "maize", lat, lng, detect=call_plantnet_and_function)
+
+    python detection_cache.py --stub
+"""
+
+import argparse
+import io
+import itertools
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from weather_cache import Grid
+
+RADIUS = 14  # pHash bits two scans of the same leaf may differ by
+DHASH_RADIUS = 12
+TTL = 7 * 86400  # seconds
+MAX_ENTRIES = 50000
+LOCATION_GRID = 0.1  # degrees (~11 km)
+HASH_SIZE = 8
+PHASH_SIZE = 32
+
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, None]
+    matrix = np.cos(np.pi * k * (2 * np.arange(n)[None, :] + 1) / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+_DCT = _dct_matrix(PHASH_SIZE)
+
+
+def _greyscale(image, size):
+    """Image (or image bytes) as a float32 greyscale array of the given (width, height)"""
+    if isinstance(image, (bytes, bytearray)):
+        image = Image.open(io.BytesIO(image))
+        if image.format == "JPEG":
+            image.draft("L", (size[0] * 4, size[1] * 4))  # decode at reduced scale; we only need a thumbnail
+    return np.asarray(image.convert("L").resize(size, Image.BILINEAR), dtype=np.float32)
+
+
+def _bits(flags):
+    return int.from_bytes(np.packbits(flags.reshape(-1)).tobytes(), "big")
+
+
+def phash(image):
+    """64-bit pHash: the 8x8 lowest DCT frequencies of a 32x32 thumbnail against their median"""
+    pixels = _greyscale(image, (PHASH_SIZE, PHASH_SIZE))
+    low = (_DCT @ pixels @ _DCT.T)[:HASH_SIZE, :HASH_SIZE].reshape(-1)
+    return _bits(low > np.median(low[1:]))
+
+
+def dhash(image):
+    """64-bit dHash: whether each pixel of a 9x8 thumbnail is brighter than its right neighbour"""
+    pixels = _greyscale(image, (HASH_SIZE + 1, HASH_SIZE))
+    return _bits(pixels[:, :-1] > pixels[:, 1:])
+
+
+def image_hashes(data):
+    """(phash, dhash) of image bytes, decoding the image once"""
+    image = Image.open(io.BytesIO(data))
+    if image.format == "JPEG":
+        image.draft("L", (PHASH_SIZE * 4, PHASH_SIZE * 4))
+    image = ImageOps.exif_transpose(image).convert("L")  # hash the photo the way it is displayed
+    return phash(image), dhash(image)
+
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+class MultiIndexHash:
+    """Hamming-radius search over 64-bit hashes by multi-index hashing
+
+    Each hash is split into `chunks` substrings, each indexed in its own
+    table. Two hashes within radius bits agree to within radius // chunks
+    bits on at least one substring (pigeonhole), so a search probes every
+    substring value that close to the query's and verifies only the hashes
+    found there.
+    """
+
+    def __init__(self, radius=RADIUS, chunks=4, bits=64):
+        self.radius = radius
+        widths = [bits // chunks + (i < bits % chunks) for i in range(chunks)]
+        self.shifts = [sum(widths[i + 1:]) for i in range(chunks)]
+        self.masks = [(1 << width) - 1 for width in widths]
+        near = radius // chunks
+        self.flips = [[sum(1 << bit for bit in combination) for flipped in range(near + 1)
+                       for combination in itertools.combinations(range(width), flipped)] for width in widths]
+        self.tables = [{} for _ in widths]
+        self.values = {}
+        self.probes = 0
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, value, item):
+        self.values[item] = value
+        for table, shift, mask in zip(self.tables, self.shifts, self.masks):
+            table.setdefault((value >> shift) & mask, set()).add(item)
+
+    def remove(self, item):
+        value = self.values.pop(item)
+        for table, shift, mask in zip(self.tables, self.shifts, self.masks):
+            key = (value >> shift) & mask
+            bucket = table[key]
+            bucket.discard(item)
+            if not bucket:
+                del table[key]
+
+    def search(self, value, radius=None):
+        """[(distance, item)] within radius (at most the index's own), nearest first"""
+        radius = self.radius if radius is None else min(radius, self.radius)
+        candidates = set()
+        for table, shift, mask, flips in zip(self.tables, self.shifts, self.masks, self.flips):
+            key = (value >> shift) & mask
+            self.probes += len(flips)
+            for flip in flips:
+                bucket = table.get(key ^ flip)
+                if bucket:
+                    candidates |= bucket
+        found = [(hamming(value, self.values[item]), item) for item in candidates]
+        return sorted(pair for pair in found if pair[0] <= radius)
+
+
+class DetectionCache:
+    """Near-duplicate photo lookup of detection results by (cropType, location cell, perceptual hash)"""
+
+    def __init__(self, radius=RADIUS, dhash_radius=DHASH_RADIUS, ttl=TTL, max_entries=MAX_ENTRIES,
+                 grid=LOCATION_GRID, clock=time.time):
+        self.radius = radius
+        self.dhash_radius = dhash_radius
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.grid = grid if isinstance(grid, Grid) else Grid(grid)
+        self.clock = clock
+        self.indexes = {}  # partition -> MultiIndexHash of entry ids by pHash
+        self.entries = OrderedDict()  # entry id -> (partition, phash, dhash, result, expires), LRU order
+        self.next_id = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def partition(self, crop_type, lat, lng):
+        location = self.grid.key(lat, lng) if lat is not None and lng is not None else None
+        return (crop_type or "").strip().casefold(), location
+
+    def lookup(self, hashes, crop_type, lat=None, lng=None):
+        """Cached result of the closest near-duplicate scan, or None"""
+        photo_phash, photo_dhash = hashes
+        key = self.partition(crop_type, lat, lng)
+        now = self.clock()
+        with self.lock:
+            index = self.indexes.get(key)
+            best = None
+            for distance, entry_id in (index.search(photo_phash) if index else ()):
+                _, _, entry_dhash, _, expires = self.entries[entry_id]
+                if expires <= now:
+                    self._drop(entry_id)
+                    self.expired += 1
+                    continue
+                dhash_distance = hamming(photo_dhash, entry_dhash)
+                if dhash_distance <= self.dhash_radius and (best is None or distance + dhash_distance < best[0]):
+                    best = distance + dhash_distance, entry_id
+            if best is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(best[1])
+            self.hits += 1
+            return self.entries[best[1]][3]
+
+    def store(self, hashes, crop_type, lat, lng, result):
+        photo_phash, photo_dhash = hashes
+        key = self.partition(crop_type, lat, lng)
+        with self.lock:
+            entry_id = self.next_id
+            self.next_id += 1
+            self.entries[entry_id] = (key, photo_phash, photo_dhash, result, self.clock() + self.ttl)
+            if key not in self.indexes:
+                self.indexes[key] = MultiIndexHash(self.radius)
+            self.indexes[key].add(photo_phash, entry_id)
+            while len(self.entries) > self.max_entries:
+                self._drop(next(iter(self.entries)))
+                self.evictions += 1
+
+    def get_or_detect(self, data, crop_type, lat, lng, detect):
+        """(result, cache hit) for photo bytes; detect(data) runs the real identification on a miss"""
+        hashes = image_hashes(data)
+        result = self.lookup(hashes, crop_type, lat, lng)
+        if result is not None:
+            return result, True
+        result = detect(data)
+        self.store(hashes, crop_type, lat, lng, result)
+        return result, False
+
+    def purge(self):
+        """Drop every expired entry"""
+        now = self.clock()
+        with self.lock:
+            for entry_id in [entry_id for entry_id, entry in self.entries.items() if entry[4] <= now]:
+                self._drop(entry_id)
+                self.expired += 1
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "partitions": len(self.indexes), "hits": self.hits,
+                    "misses": self.misses, "expired": self.expired, "evictions": self.evictions}
+
+    def _drop(self, entry_id):
+        key = self.entries.pop(entry_id)[0]
+        index = self.indexes[key]
+        index.remove(entry_id)
+        if not len(index):
+            del self.indexes[key]
+
+
+def leaf_photo(seed, width=1344, height=1008):
+    """A distinct synthetic leaf photo: image_prep.synthetic_photo framed and turned differently per seed"""
+    from image_prep import synthetic_photo
+
+    rng = np.random.default_rng(seed)
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(synthetic_photo(width, height, seed=seed, quality=90))))
+    width, height = image.size
+    zoom = rng.uniform(0.45, 0.8)
+    left, top = rng.uniform(0, 1 - zoom, 2) * (width, height)
+    image = image.crop((int(left), int(top), int(left + zoom * width), int(top + zoom * height)))
+    image = image.transpose((Image.FLIP_LEFT_RIGHT, Image.ROTATE_90, Image.ROTATE_180, Image.ROTATE_270)[seed % 4])
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def rescan(data, seed, rotation=1.5, crop=0.03):
+    """The same leaf photographed again: slightly rotated, reframed, exposed differently and re-encoded"""
+    from PIL import ImageEnhance
+
+    rng = np.random.default_rng(seed)
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(data))).convert("RGB")
+    width, height = image.size
+    image = image.rotate(rng.uniform(-rotation, rotation), resample=Image.BILINEAR)
+    left, top, right, bottom = rng.uniform(0, crop, 4)
+    image = image.crop((int(left * width), int(top * height), width - int(right * width),
+                        height - int(bottom * height)))
+    image = ImageEnhance.Brightness(image).enhance(rng.uniform(0.85, 1.15))
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=int(rng.uniform(70, 92)))
+    return buffer.getvalue()
+
+
+def run_benchmark(photos=40, rescans=3, population=50000, seed=1):
+    originals = [leaf_photo(seed * 1000 + i) for i in range(photos)]
+    started = time.perf_counter()
+    hashes = [image_hashes(data) for data in originals]
+    hashing = (time.perf_counter() - started) / photos
+    cache = DetectionCache()
+    for i, photo_hashes in enumerate(hashes):
+        cache.store(photo_hashes, "maize", -1.2864, 36.8172, {"photo": i})
+
+    found = wrong = 0
+    distances = []
+    for i, data in enumerate(originals):
+        for r in range(rescans):
+            again = image_hashes(rescan(data, seed + i * rescans + r))
+            distances.append(hamming(again[0], hashes[i][0]))
+            result = cache.lookup(again, "maize", -1.2865, 36.8173)
+            found += result is not None and result["photo"] == i
+            wrong += result is not None and result["photo"] != i
+    different = [hamming(a[0], b[0]) for j, a in enumerate(hashes) for b in hashes[j + 1:]]
+    print(f"{photos} photos x {rescans} rescans: {found} found, {wrong} matched the wrong photo, "
+          f"{photos * rescans - found - wrong} missed")
+    print(f"  pHash distance: rescans median {np.median(distances):.0f} (max {max(distances)}), "
+          f"different photos median {np.median(different):.0f} (min {min(different)}); radius {cache.radius}")
+    print(f"  hashing a {len(originals[0]) // 1000} kB photo: {hashing * 1000:.1f}ms")
+
+    # Lookup cost in one crowded partition: multi-index hashing vs comparing against every entry
+    rng = np.random.default_rng(seed)
+    values = [int(v) for v in rng.integers(0, 2 ** 63, population, dtype=np.int64)]
+    crowded = DetectionCache(max_entries=population + 1)
+    for value in values:
+        crowded.store((value, value), "maize", 0.0, 0.0, {})
+    crowded.store(hashes[0], "maize", 0.0, 0.0, {"photo": 0})
+    queries = [image_hashes(rescan(originals[0], 99 + q)) for q in range(20)]
+    started = time.perf_counter()
+    hits = sum(crowded.lookup(query, "maize", 0.0, 0.0) is not None for query in queries)
+    indexed_ms = (time.perf_counter() - started) / len(queries) * 1000
+    started = time.perf_counter()
+    for query in queries:
+        [value for value in values if hamming(query[0], value) <= crowded.radius]
+    linear_ms = (time.perf_counter() - started) / len(queries) * 1000
+    print(f"  lookup among {population + 1} entries: multi-index {indexed_ms:.2f}ms ({hits}/{len(queries)} hits), "
+          f"linear scan {linear_ms:.2f}ms")
+
+
+def run_stub_demo(scans, latency):
+    """Repeated scans of a few leaves through PlantNet and fn-crop-disease on the stub, with and without the cache"""
+    import requests
+
+    import backend_test
+    from image_prep import plantnet_files, prepare_image
+    from stub_server import start_stub_server
+
+    server, base_url = start_stub_server(latency=latency)
+    session = requests.Session()
+    leaves = [leaf_photo(i) for i in range(4)]
+
+    def detect(data):
+        prepared = prepare_image(data)
+        plant = session.post(f"{base_url}/v2/identify/all?api-key=stub", files=plantnet_files([prepared]),
+                             data={"organs": ["leaf"]}, timeout=30).json()
+        disease = session.post(f"{base_url}/functions/v1/fn-crop-disease",
+                               json={"imageBase64": prepared.base64(), "cropType": "maize"}, timeout=30).json()
+        return {"species": plant["results"][0]["species"]["scientificNameWithoutAuthor"],
+                "disease": disease.get("disease"), "confidence": disease.get("confidence")}
+
+    location = backend_test.AFRICAN_COORDINATES["nairobi"]
+    photos = [rescan(leaves[i % len(leaves)], i) for i in range(scans)]
+    for label, cache in (("no cache", None), ("detection cache", DetectionCache())):
+        started = time.perf_counter()
+        latencies = []
+        for data in photos:
+            began = time.perf_counter()
+            if cache is None:
+                detect(data)
+            else:
+                cache.get_or_detect(data, "maize", location["lat"], location["lng"], detect)
+            latencies.append(time.perf_counter() - began)
+        elapsed = time.perf_counter() - started
+        latencies = np.array(latencies) * 1000
+        print(f"{label}: {scans} scans of {len(leaves)} leaves in {elapsed:.2f}s, "
+              f"median {np.median(latencies):.0f}ms, fastest {latencies.min():.1f}ms"
+              + (f", {cache.stats()}" if cache else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--photos", type=int, default=40)
+    parser.add_argument("--rescans", type=int, default=3, help="near-duplicate rescans per photo")
+    parser.add_argument("--population", type=int, default=50000, help="entries in the lookup benchmark")
+    parser.add_argument("--stub", action="store_true", help="also time repeated scans against a stub server")
+    parser.add_argument("--stub-latency", type=float, default=0.3)
+    parser.add_argument("--scans", type=int, default=20)
+    args = parser.parse_args()
+
+    run_benchmark(args.photos, args.rescans, args.population)
+    if args.stub:
+        run_stub_demo(args.scans, args.stub_latency)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
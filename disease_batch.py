@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+Batch crop-disease identification for a field visit's worth of photos.
+
+test_crop_disease_detection() identifies one image per call. identify_batch()
+takes N photos and pipelines them:
+
+  1. prepare_image (orient, downscale, strip EXIF, re-encode) runs in a
+     process pool, so decoding 12 MP JPEGs uses every core
+  2. as soon as a photo is prepared it goes to a thread pool of
+     `concurrency` upstream slots: PlantNet identify (multipart) followed by
+     the fn-crop-disease edge function; 429/5xx and connection errors are
+     retried with the shared AdaptiveThrottle backoff
+  3. results are yielded as each photo completes, in completion order, each
+     with its own prepare / queue / upstream timings
+
+With a detection_cache.DetectionCache, photos whose perceptual hash matches
+an earlier scan are answered without an upstream call.
+
+    client = DiseaseClient(PLANTNET_URL, plantnet_api_key, SUPABASE_URL, anon_key)
+    for result in identify_batch(photos, client, crop_type="maize", location=(lat, lng)):
+        print(result.name, result.result, result.latency)
+
+    python disease_batch.py --stub --images 24
+"""
+
+import argparse
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from image_prep import plantnet_files, prepare_image
+from insert_market_listings import AdaptiveThrottle
+from probe_runner import percentile
+
+CONCURRENCY = 8  # upstream requests in flight
+RETRIES = 3
+
+
+class ImageResult:
+    """Outcome and timings of one photo in a batch"""
+
+    def __init__(self, index, name, original_bytes):
+        self.index = index
+        self.name = name
+        self.original_bytes = original_bytes
+        self.sent_bytes = 0
+        self.result = None
+        self.error = None
+        self.cached = False
+        self.attempts = 0
+        self.prepare_seconds = 0.0
+        self.queue_seconds = 0.0  # prepared but waiting for an upstream slot
+        self.upstream_seconds = 0.0
+        self.latency = 0.0  # from the start of the batch until this result was ready
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def as_dict(self):
+        return {"index": self.index, "name": self.name, "ok": self.ok, "result": self.result, "error": self.error,
+                "cached": self.cached, "attempts": self.attempts, "original_bytes": self.original_bytes,
+                "sent_bytes": self.sent_bytes, "prepare_ms": round(self.prepare_seconds * 1000, 1),
+                "queue_ms": round(self.queue_seconds * 1000, 1), "upstream_ms": round(self.upstream_seconds * 1000, 1),
+                "latency_ms": round(self.latency * 1000, 1)}
+
+
+class DiseaseClient:
+    """PlantNet identification plus the fn-crop-disease edge function, with retries"""
+
+    def __init__(self, plantnet_url, plantnet_api_key, supabase_url, supabase_key, session=None,
+                 retries=RETRIES, pool_size=CONCURRENCY, timeout=60):
+        self.plantnet_url = f"{plantnet_url.rstrip('/')}/v2/identify/all?api-key={plantnet_api_key}"
+        self.function_url = f"{supabase_url.rstrip('/')}/functions/v1/fn-crop-disease"
+        self.headers = {"Authorization": f"Bearer {supabase_key}"}
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        self.session = session
+        self.retries = retries
+        self.timeout = timeout
+        self.throttle = AdaptiveThrottle()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.retried = 0
+
+    def _post(self, url, attempts, **kwargs):
+        """Response of a POST, retrying throttled, failed and 5xx responses with backoff"""
+        error = None
+        for _ in range(self.retries + 1):
+            attempts[0] += 1
+            self.throttle.wait()
+            with self.lock:
+                self.requests += 1
+            try:
+                response = self.session.post(url, timeout=self.timeout, **kwargs)
+            except requests.RequestException as e:
+                error = e
+            else:
+                if response.status_code != 429 and response.status_code < 500:
+                    self.throttle.succeeded()
+                    return response
+                error = requests.HTTPError(f"{response.status_code} {response.reason}", response=response)
+                retry_after = response.headers.get("Retry-After")
+            with self.lock:
+                self.retried += 1
+            self.throttle.throttled(retry_after if isinstance(error, requests.HTTPError) else None)
+        raise error
+
+    def identify(self, prepared, crop_type=None, location=None, attempts=None):
+        """{"species", "confidence", "disease", "disease_confidence"} for one PreparedImage
+
+        attempts, a one-item list, is incremented for every HTTP request made.
+        """
+        attempts = attempts if attempts is not None else [0]
+        response = self._post(self.plantnet_url, attempts, files=plantnet_files([prepared]), data={"organs": ["leaf"]})
+        response.raise_for_status()
+        plant = response.json()
+        top = (plant.get("results") or [{}])[0]
+        payload = {"imageBase64": prepared.base64(), "cropType": crop_type}
+        if location:
+            payload["location"] = {"latitude": location[0], "longitude": location[1]}
+        response = self._post(self.function_url, attempts, json=payload, headers=self.headers)
+        response.raise_for_status()
+        disease = response.json()
+        return {"species": top.get("species", {}).get("scientificNameWithoutAuthor"),
+                "confidence": top.get("score"), "disease": disease.get("disease"),
+                "disease_confidence": disease.get("confidence")}
+
+
+def _prepare(data, name, options, hashes):
+    """Process-pool task: (PreparedImage, perceptual hashes or None)"""
+    prepared = prepare_image(data, name=name, **options)
+    if not hashes:
+        return prepared, None
+    from detection_cache import image_hashes
+    return prepared, image_hashes(data)
+
+
+def identify_batch(images, client, crop_type=None, location=None, concurrency=CONCURRENCY, prep_workers=None,
+                   cache=None, prepare_options=None):
+    """Yield an ImageResult per photo as soon as it completes
+
+    images is a list of bytes or (name, bytes). Results arrive in completion
+    order; ImageResult.index gives the input position.
+    """
+    images = [item if isinstance(item, tuple) else (f"image{i}", item) for i, item in enumerate(images)]
+    lat, lng = location if location else (None, None)
+    started = time.perf_counter()
+    completed = queue.Queue()
+    prep_pool = ProcessPoolExecutor(max_workers=prep_workers or os.cpu_count())
+    upstream_pool = ThreadPoolExecutor(max_workers=concurrency)
+
+    def finish(result):
+        result.latency = time.perf_counter() - started
+        completed.put(result)
+
+    def upstream(result, prepared, hashes, queued):
+        began = time.perf_counter()
+        result.queue_seconds = began - queued
+        attempts = [0]
+        try:
+            result.result = client.identify(prepared, crop_type, location, attempts)
+            if cache is not None:
+                cache.store(hashes, crop_type, lat, lng, result.result)
+        except Exception as e:
+            result.error = str(e)
+        result.attempts = attempts[0]
+        result.upstream_seconds = time.perf_counter() - began
+        finish(result)
+
+    def prepared_callback(future, result):
+        try:
+            prepared, hashes = future.result()
+        except Exception as e:
+            result.error = f"preprocessing failed: {e}"
+            finish(result)
+            return
+        result.prepare_seconds = prepared.seconds
+        result.sent_bytes = len(prepared.data)
+        if cache is not None:
+            hit = cache.lookup(hashes, crop_type, lat, lng)
+            if hit is not None:
+                result.result, result.cached = hit, True
+                finish(result)
+                return
+        try:
+            upstream_pool.submit(upstream, result, prepared, hashes, time.perf_counter())
+        except RuntimeError:  # the batch was abandoned and the pool shut down
+            pass
+
+    try:
+        for index, (name, data) in enumerate(images):
+            result = ImageResult(index, name, len(data))
+            future = prep_pool.submit(_prepare, data, name, prepare_options or {}, cache is not None)
+            future.add_done_callback(lambda f, result=result: prepared_callback(f, result))
+        for _ in images:
+            yield completed.get()
+    finally:
+        prep_pool.shutdown(wait=True, cancel_futures=True)
+        upstream_pool.shutdown(wait=True, cancel_futures=True)
+
+
+def summarize(results, seconds):
+    """Aggregate counts, throughput and p50/p95 latencies of a finished batch"""
+    stages = {}
+    for stage in ("prepare_seconds", "queue_seconds", "upstream_seconds", "latency"):
+        values = sorted(getattr(result, stage) for result in results)
+        stages[stage.replace("_seconds", "")] = {"p50_ms": round(percentile(values, 50) * 1000, 1),
+                                                 "p95_ms": round(percentile(values, 95) * 1000, 1)}
+    return {"images": len(results), "ok": sum(result.ok for result in results),
+            "failed": sum(not result.ok for result in results), "cached": sum(result.cached for result in results),
+            "seconds": round(seconds, 2), "images_per_minute": round(len(results) / seconds * 60, 1),
+            "bytes_original": sum(result.original_bytes for result in results),
+            "bytes_sent": sum(result.sent_bytes for result in results), "latency": stages}
+
+
+def identify_sequential(images, client, crop_type=None, location=None):
+    """One photo at a time, as test_crop_disease_detection() does: [ImageResult] in input order"""
+    started = time.perf_counter()
+    results = []
+    for index, data in enumerate(images):
+        result = ImageResult(index, f"image{index}", len(data))
+        prepared = prepare_image(data)
+        result.prepare_seconds = prepared.seconds
+        result.sent_bytes = len(prepared.data)
+        began = time.perf_counter()
+        attempts = [0]
+        try:
+            result.result = client.identify(prepared, crop_type, location, attempts)
+        except Exception as e:
+            result.error = str(e)
+        result.attempts = attempts[0]
+        result.upstream_seconds = time.perf_counter() - began
+        result.latency = time.perf_counter() - started
+        results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stub", action="store_true", help="use an in-process stub server for both upstreams")
+    parser.add_argument("--stub-latency", type=float, default=0.3)
+    parser.add_argument("--stub-error-rate", type=float, default=0.05, help="fraction of stub responses that are 503")
+    parser.add_argument("--images", type=int, default=24, help="synthetic photos without --corpus")
+    parser.add_argument("--corpus", help="directory of photos")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    parser.add_argument("--prep-workers", type=int, help="preprocessing processes (default: CPU count)")
+    args = parser.parse_args()
+
+    import backend_test
+    from image_prep import load_corpus, synthetic_photo
+
+    plantnet_url, supabase_url = backend_test.PLANTNET_URL, backend_test.SUPABASE_URL
+    if args.stub:
+        from stub_server import start_stub_server
+        server, base_url = start_stub_server(latency=args.stub_latency, error_rate=args.stub_error_rate, seed=1)
+        plantnet_url = supabase_url = base_url
+    client = DiseaseClient(plantnet_url, os.environ.get("PLANTNET_API_KEY", "stub"), supabase_url,
+                           os.environ.get("SUPABASE_ANON_KEY", "stub"), pool_size=args.concurrency)
+    if args.corpus:
+        images = [data for _, data in load_corpus(args.corpus)]
+    else:
+        images = [synthetic_photo(2016, 1512, seed=i) for i in range(args.images)]
+    location = (backend_test.AFRICAN_COORDINATES["nairobi"]["lat"], backend_test.AFRICAN_COORDINATES["nairobi"]["lng"])
+
+    started = time.perf_counter()
+    sequential = identify_sequential(images, client, "maize", location)
+    report = summarize(sequential, time.perf_counter() - started)
+    print(f"sequential: {report['ok']}/{report['images']} ok in {report['seconds']}s "
+          f"({report['images_per_minute']} images/min), first result after "
+          f"{min(result.latency for result in sequential):.2f}s")
+
+    retried_before = client.retried
+    started = time.perf_counter()
+    results = []
+    for result in identify_batch(images, client, "maize", location, args.concurrency, args.prep_workers):
+        results.append(result)
+        if len(results) <= 3 or len(results) == len(images):
+            print(f"  [{len(results)}/{len(images)}] {result.name}: {result.result or result.error} "
+                  f"(prepare {result.prepare_seconds * 1000:.0f}ms, upstream {result.upstream_seconds * 1000:.0f}ms, "
+                  f"ready at {result.latency:.2f}s)")
+    report = summarize(results, time.perf_counter() - started)
+    print(f"batch: {report['ok']}/{report['images']} ok in {report['seconds']}s "
+          f"({report['images_per_minute']} images/min), {client.retried - retried_before} upstream retries, "
+          f"first result after {min(result.latency for result in results):.2f}s")
+    print(f"  {report['bytes_original'] / 1e6:.1f} MB of photos sent as {report['bytes_sent'] / 1e6:.2f} MB")
+    for stage, values in report["latency"].items():
+        print(f"  {stage:<9} p50 {values['p50_ms']:7.0f}ms  p95 {values['p95_ms']:7.0f}ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+"""
+Vectorized economic impact of crop disease: yield loss, revenue loss and
+confidence intervals for fields x diseases x severities in one NumPy pass.
+
+For every field f, disease d and severity s:
+
+    loss_fraction = min(severity * susceptibility[d], max_loss[d]) * confidence
+    yield_loss    = area_ha[f] * expected_yield[crop[f]] * loss_fraction   (kg)
+    revenue_loss  = yield_loss * price_per_kg[crop[f]]                      (USD)
+
+Prices come from market_listings (PriceTable.from_rest / from_snapshot): a
+quantity-weighted mean price per crop in USD/kg, with the listings' price
+spread feeding the interval. Crops with no listings fall back to the seed
+listings of market_schema.py, and crops missing there to DEFAULT_PRICE with
+PRICE_CV, as yields fall back to DEFAULT_YIELD. The interval treats yield, price and severity
+as independent log-normal factors with coefficients of variation YIELD_CV,
+the market spread and SEVERITY_CV, giving revenue_loss / k .. revenue_loss * k
+with k = exp(z * sigma).
+
+    prices = PriceTable.from_rest()
+    impact = assess(area_ha, crops, severities=[0.1, 0.25, 0.5], diseases=["Maize Leaf Blight", "Rust"],
+                    prices=prices)
+    impact.revenue_loss.shape      # (fields, diseases, severities)
+    impact.totals_by_crop()
+
+    python economic_impact.py --stub --fields 50000
+"""
+
+import argparse
+import math
+import sys
+import time
+
+import numpy as np
+
+from insert_market_listings import SUPABASE_ANON_KEY, SUPABASE_URL
+from market_columnar import MarketSnapshot
+from market_schema import seed_listings
+
+# Typical smallholder yields in kg/ha; fields can pass their own (e.g. from NDVI)
+EXPECTED_YIELDS = {"maize": 3500, "tomato": 15000, "beans": 1000, "cassava": 10000, "yam": 8000, "rice": 2500,
+                   "cocoa": 450, "plantain": 7000, "coffee": 700, "matooke": 10000, "teff": 1500, "sorghum": 1200}
+DEFAULT_YIELD = 3500
+MAX_LOSS = 0.4  # cap on the loss fraction from one disease
+YIELD_CV = 0.25  # season-to-season spread of smallholder yields
+SEVERITY_CV = 0.2  # uncertainty of a photo-based severity estimate
+PRICE_CV = 0.15  # assumed price spread for crops with fewer than MIN_LISTINGS listings
+DEFAULT_PRICE = 0.7  # USD/kg, about the median seed price, for crops no price table knows
+MIN_LISTINGS = 3
+Z_90 = 1.6449  # two-sided 90% interval
+UNIT_KG = {"kg": 1.0, "g": 0.001, "quintal": 100.0, "tonne": 1000.0, "ton": 1000.0, "t": 1000.0}
+
+
+def _crop_key(crop):
+    return (crop or "").strip().casefold()
+
+
+class PriceTable:
+    """USD/kg price, price CV and listing count per crop"""
+
+    def __init__(self, prices, cvs=None, listings=None, source="default", fallback=None):
+        self.prices = {_crop_key(crop): float(price) for crop, price in prices.items()}
+        self.cvs = {_crop_key(crop): float(cv) for crop, cv in (cvs or {}).items()}
+        self.listings = {_crop_key(crop): int(count) for crop, count in (listings or {}).items()}
+        self.source = source
+        self.fallback = fallback
+
+    def __contains__(self, crop):
+        return _crop_key(crop) in self.prices
+
+    @classmethod
+    def from_snapshot(cls, snapshot, bbox=None, min_quality=None, source="market_listings", fallback=None):
+        """Quantity-weighted mean price per crop over the active listings of a MarketSnapshot
+
+        Prices are converted to USD/kg via UNIT_KG; listings in other units
+        (bags, bunches) are skipped.
+        """
+        c = snapshot.columns
+        indices = snapshot.filter(bbox=bbox, min_quality=min_quality)
+        units = np.array([UNIT_KG.get(_crop_key(unit) or "kg", np.nan) for unit in snapshot.dictionaries["unit"]])
+        kg = units[c["unit"][indices]]
+        price = c["price_per_unit"][indices] / kg
+        quantity = c["quantity_available"][indices]
+        weight = np.where(np.isnan(quantity) | (quantity <= 0), 1.0, quantity)
+        keep = np.isfinite(price)
+        crop, price, weight = c["crop_type"][indices][keep], price[keep], weight[keep]
+
+        crops = len(snapshot.dictionaries["crop_type"])
+        count = np.bincount(crop, minlength=crops)
+        total = np.bincount(crop, weights=weight, minlength=crops)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.bincount(crop, weights=weight * price, minlength=crops) / total
+            variance = np.bincount(crop, weights=weight * (price - mean[crop]) ** 2, minlength=crops) / total
+            cv = np.sqrt(variance) / mean
+        cv = np.where(count >= MIN_LISTINGS, cv, PRICE_CV)
+
+        prices, cvs, listings = {}, {}, {}
+        for code, name in enumerate(snapshot.dictionaries["crop_type"]):
+            if count[code] and name:
+                key = _crop_key(name)
+                prices[key], cvs[key], listings[key] = mean[code], cv[code], count[code]
+        if fallback is None and source != "seed listings":
+            fallback = cls.seed()
+        return cls(prices, cvs, listings, source, fallback)
+
+    @classmethod
+    def from_rest(cls, base_url=SUPABASE_URL, api_key=SUPABASE_ANON_KEY, bbox=None, min_quality=None):
+        """Prices from the live market_listings table"""
+        return cls.from_snapshot(MarketSnapshot.from_rest(base_url, api_key), bbox, min_quality)
+
+    @classmethod
+    def seed(cls):
+        """Prices of the market_schema.py seed listings, the fallback for crops without live listings"""
+        return cls.from_snapshot(MarketSnapshot.from_rows(seed_listings()), source="seed listings")
+
+    def get(self, crop):
+        """(price per kg, cv, listings, source) of one crop, DEFAULT_PRICE if no table has it"""
+        key = _crop_key(crop)
+        if key in self.prices:
+            return self.prices[key], self.cvs.get(key, PRICE_CV), self.listings.get(key, 0), self.source
+        if self.fallback is not None:
+            return self.fallback.get(crop)
+        return DEFAULT_PRICE, PRICE_CV, 0, "default price"
+
+    def lookup(self, crops):
+        """(price_per_kg, cv) arrays aligned with an array of crop names"""
+        names, inverse = np.unique(np.asarray(crops, dtype=object).astype(str), return_inverse=True)
+        price = np.empty(len(names))
+        cv = np.empty(len(names))
+        for i, name in enumerate(names):
+            price[i], cv[i] = self.get(name)[:2]
+        return price[inverse], cv[inverse]
+
+
+class Impact:
+    """Loss arrays of shape (fields, diseases, severities) plus their inputs"""
+
+    def __init__(self, crops, diseases, severities, price_per_kg, expected_yield, loss_fraction, yield_loss,
+                 revenue_loss, revenue_low, revenue_high):
+        self.crops = crops
+        self.diseases = diseases
+        self.severities = severities
+        self.price_per_kg = price_per_kg
+        self.expected_yield = expected_yield
+        self.loss_fraction = loss_fraction
+        self.yield_loss = yield_loss
+        self.revenue_loss = revenue_loss
+        self.revenue_low = revenue_low
+        self.revenue_high = revenue_high
+
+    @property
+    def shape(self):
+        return self.revenue_loss.shape
+
+    def field(self, index=0, disease=0, severity=0):
+        """Scalar figures of one cell, for per-field reports"""
+        cell = (index, disease, severity)
+        return {"crop": str(self.crops[index]), "disease": self.diseases[disease],
+                "severity": float(self.severities[severity]),
+                "expected_yield": float(self.expected_yield[index]), "price_per_kg": float(self.price_per_kg[index]),
+                "yield_loss_percentage": float(self.loss_fraction[cell] * 100), "yield_loss": float(self.yield_loss[cell]),
+                "revenue_loss": float(self.revenue_loss[cell]),
+                "revenue_loss_interval": [float(self.revenue_low[cell]), float(self.revenue_high[cell])]}
+
+    def totals(self, mask=None):
+        """Summed yield and revenue loss (diseases x severities) over all fields, or those in mask
+
+        Bounds are summed too, i.e. field errors are treated as fully
+        correlated (prices and weather are shared across a region), which
+        keeps the interval conservative.
+        """
+        select = slice(None) if mask is None else mask
+        return {name: getattr(self, name)[select].sum(axis=0)
+                for name in ("yield_loss", "revenue_loss", "revenue_low", "revenue_high")}
+
+    def totals_by_crop(self):
+        """{crop: totals()} for every crop present"""
+        crops = np.asarray(self.crops, dtype=object).astype(str)
+        names, inverse = np.unique(crops, return_inverse=True)
+        cells = self.revenue_loss.shape[1:]
+        report = {}
+        for name in ("yield_loss", "revenue_loss", "revenue_low", "revenue_high"):
+            values = getattr(self, name).reshape(len(crops), -1)
+            summed = np.zeros((len(names), values.shape[1]))
+            np.add.at(summed, inverse, values)
+            for i, crop in enumerate(names):
+                report.setdefault(crop, {})[name] = summed[i].reshape(cells)
+        return report
+
+
+def assess(area_ha, crops, severities, diseases=("disease",), prices=None, confidence=1.0, expected_yield=None,
+           susceptibility=1.0, max_loss=MAX_LOSS, yield_cv=YIELD_CV, severity_cv=SEVERITY_CV, z=Z_90):
+    """Impact of every disease at every severity on every field
+
+    area_ha and crops have one entry per field; severities (fractions of the
+    canopy affected) one per severity level, or any shape broadcastable to
+    (fields, diseases, severities). susceptibility and max_loss are scalars or
+    one value per disease; confidence (the probability the detected disease
+    is really present) broadcasts like severities. expected_yield overrides
+    the per-crop EXPECTED_YIELDS in kg/ha.
+    """
+    area_ha = np.asarray(area_ha, dtype=np.float64)
+    crops = np.asarray(crops, dtype=object)
+    diseases = list(diseases)
+    prices = prices or PriceTable.seed()
+    price, price_cv = prices.lookup(crops)
+    if expected_yield is None:
+        names, inverse = np.unique(crops.astype(str), return_inverse=True)
+        expected_yield = np.array([EXPECTED_YIELDS.get(_crop_key(name), DEFAULT_YIELD) for name in names])[inverse]
+    expected_yield = np.broadcast_to(np.asarray(expected_yield, dtype=np.float64), area_ha.shape)
+
+    severities = np.asarray(severities, dtype=np.float64)
+    levels = severities if severities.ndim == 1 else severities.reshape(-1, severities.shape[-1])[0]
+    if severities.ndim == 1:
+        severities = severities[None, None, :]
+    susceptibility = np.broadcast_to(np.asarray(susceptibility, dtype=np.float64), (len(diseases),))[None, :, None]
+    max_loss = np.broadcast_to(np.asarray(max_loss, dtype=np.float64), (len(diseases),))[None, :, None]
+    shape = np.broadcast_shapes((len(area_ha), len(diseases), 1), severities.shape, np.shape(confidence))
+
+    loss_fraction = np.empty(shape)
+    np.multiply(severities, susceptibility, out=loss_fraction)
+    np.minimum(loss_fraction, max_loss, out=loss_fraction)
+    loss_fraction *= confidence
+    production = area_ha * expected_yield
+    yield_loss = loss_fraction * production[:, None, None]
+    revenue_loss = yield_loss * price[:, None, None]
+
+    sigma = np.sqrt(math.log1p(yield_cv ** 2) + math.log1p(severity_cv ** 2) + np.log1p(price_cv ** 2))
+    spread = np.exp(z * sigma)[:, None, None]
+    revenue_low = revenue_loss / spread
+    revenue_high = revenue_loss * spread
+    return Impact(crops, diseases, levels, price, expected_yield, loss_fraction, yield_loss, revenue_loss,
+                  revenue_low, revenue_high)
+
+
+def treatment_benefit(revenue_loss, effectiveness, cost_per_hectare, area_ha=1.0):
+    """Saved revenue, net benefit and ROI of every treatment, on a new trailing axis
+
+    revenue_loss has any shape (e.g. an Impact's (fields, diseases,
+    severities)); effectiveness and cost_per_hectare have one entry per
+    treatment. area_ha broadcasts against revenue_loss.
+    """
+    effectiveness = np.asarray(effectiveness, dtype=np.float64)
+    cost = np.asarray(cost_per_hectare, dtype=np.float64) * np.asarray(area_ha, dtype=np.float64)[..., None]
+    saved_revenue = np.asarray(revenue_loss, dtype=np.float64)[..., None] * effectiveness
+    net_benefit = saved_revenue - cost
+    with np.errstate(invalid="ignore", divide="ignore"):
+        roi = np.where(cost > 0, net_benefit / cost, 0.0)
+    return {"saved_revenue": saved_revenue, "net_benefit": net_benefit, "roi": roi}
+
+
+def assess_scalar(area_ha, crops, severities, diseases, prices, confidence=1.0, susceptibility=1.0,
+                  max_loss=MAX_LOSS, yield_cv=YIELD_CV, severity_cv=SEVERITY_CV, z=Z_90):
+    """Per-call Python loop equivalent of assess(), the baseline for the benchmark"""
+    susceptibility = np.broadcast_to(susceptibility, (len(diseases),)).tolist()
+    max_loss = np.broadcast_to(max_loss, (len(diseases),)).tolist()
+    rows = []
+    for area, crop in zip(area_ha, crops):
+        price, price_cv = prices.get(crop)[:2]
+        production = area * EXPECTED_YIELDS.get(_crop_key(crop), DEFAULT_YIELD)
+        spread = math.exp(z * math.sqrt(math.log1p(yield_cv ** 2) + math.log1p(severity_cv ** 2)
+                                        + math.log1p(price_cv ** 2)))
+        for d in range(len(diseases)):
+            for severity in severities:
+                yield_loss = production * min(severity * susceptibility[d], max_loss[d]) * confidence
+                revenue_loss = yield_loss * price
+                rows.append((yield_loss, revenue_loss, revenue_loss / spread, revenue_loss * spread))
+    return rows
+
+
+def random_fields(count, crops, seed=0):
+    """(area_ha, crops) of `count` smallholder fields, 0.2-5 ha"""
+    rng = np.random.default_rng(seed)
+    area = np.round(rng.lognormal(0.0, 0.7, count).clip(0.2, 5.0), 2)
+    return area, np.array(crops, dtype=object)[rng.integers(0, len(crops), count)]
+
+
+def outbreak_report(impact, severity=0):
+    """Print regional revenue loss per crop and disease at one severity level, with the 90% interval of the total"""
+    print(f"Regional outbreak at severity {impact.severities[severity]:.0%} ({len(impact.crops)} fields), "
+          f"revenue loss in USD:")
+    print(f"  {'crop':<9}" + "".join(f"{disease:>14}" for disease in impact.diseases))
+    for crop, totals in sorted(impact.totals_by_crop().items()):
+        print(f"  {crop:<9}" + "".join(f"{value:14,.0f}" for value in totals["revenue_loss"][:, severity]))
+    totals = impact.totals()
+    for d, disease in enumerate(impact.diseases):
+        print(f"  {disease}: {totals['yield_loss'][d, severity] / 1000:,.0f} t, ${totals['revenue_loss'][d, severity]:,.0f} "
+              f"(90% ${totals['revenue_low'][d, severity]:,.0f} - ${totals['revenue_high'][d, severity]:,.0f})")
+
+
+def run_benchmark(prices, count, severities, diseases, susceptibility=1.0, max_loss=MAX_LOSS, repeats=5):
+    """Time assess() against the scalar loop on `count` random fields and check they agree"""
+    crops = sorted(prices.prices)
+    area, field_crops = random_fields(count, crops)
+    started = time.perf_counter()
+    rows = assess_scalar(area, field_crops, severities, diseases, prices, susceptibility=susceptibility,
+                         max_loss=max_loss)
+    scalar = time.perf_counter() - started
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        impact = assess(area, field_crops, severities, diseases, prices, susceptibility=susceptibility,
+                        max_loss=max_loss)
+        timings.append(time.perf_counter() - started)
+    expected = np.array(rows).reshape(impact.shape + (4,))
+    assert np.allclose(expected[..., 1], impact.revenue_loss) and np.allclose(expected[..., 3], impact.revenue_high)
+    cells = impact.revenue_loss.size
+    print(f"{count} fields x {len(diseases)} diseases x {len(severities)} severities = {cells} cells: "
+          f"vectorized {min(timings) * 1000:.0f}ms, scalar loop {scalar * 1000:.0f}ms "
+          f"({scalar / min(timings):.0f}x)")
+    return impact
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default=SUPABASE_URL, help="Supabase (or stub server) base URL for market prices")
+    parser.add_argument("--stub", action="store_true", help="read prices from an in-process stub seeded with listings")
+    parser.add_argument("--fields", type=int, default=50_000)
+    parser.add_argument("--severity", type=float, action="append", dest="severities",
+                        help="severity level, repeatable (default: 0.1 0.25 0.5 0.75)")
+    args = parser.parse_args()
+
+    url = args.url
+    if args.stub:
+        from stub_server import start_stub_server
+        server, url = start_stub_server()
+        server.state.insert("market_listings", [listing.to_dict() for listing in seed_listings()])
+    try:
+        prices = PriceTable.from_rest(url)
+    except Exception as e:
+        print(f"Could not load market_listings ({e}); using seed prices")
+        prices = PriceTable.seed()
+    print(f"Prices from {prices.source}: " + ", ".join(f"{crop} ${price:.2f}/kg"
+                                                      for crop, price in sorted(prices.prices.items())))
+
+    severities = args.severities or [0.1, 0.25, 0.5, 0.75]
+    # Illustrative profiles: (disease, susceptibility, max_loss)
+    profiles = [("Leaf Blight", 1.0, 0.4), ("Rust", 0.8, 0.3), ("Viral Mosaic", 1.2, 0.6), ("Root Rot", 0.6, 0.35)]
+    diseases, susceptibility, max_loss = zip(*profiles)
+    impact = run_benchmark(prices, args.fields, severities, diseases, susceptibility, max_loss)
+    outbreak_report(impact, severity=min(1, len(severities) - 1))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
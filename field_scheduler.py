@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+"""
+Nightly multi-field satellite analysis scheduler.
+
+test_sentinel_hub_api() analyses one polygon synchronously; this runs the
+same analysis for every registered field:
+
+  batching    fields are bucketed by a coarse lng/lat grid and, within a
+              cell, merged greedily into one shared-bbox process request as
+              long as the merged request costs no more than max_waste times
+              the separate ones (and stays under the API's 2500 px limit)
+  workers     batches run on a thread pool; each downloads B02/B03/B04/B08,
+              SCL and dataMask once (through the imagery cache) and computes
+              cloud-masked NDVI statistics for all of its fields in one pass
+  quotas      QuotaLimiter holds two token buckets, processing units and
+              requests per minute, and every upstream request is charged its
+              full cost in both before it is sent, so spending stays at the
+              account rate (a request larger than the bucket leaves it in
+              debt); 429/5xx responses still back off and retry
+  checkpoint  finished fields are appended to a JSON lines file as each
+              batch completes; a restarted run skips them and only plans
+              batches for what is left
+
+    limiter = QuotaLimiter(units_per_minute=300, requests_per_minute=300)
+    client = ProcessClient(token_manager, SENTINEL_HUB_URL, cache=ImageryCache(), limiter=limiter)
+    scheduler = FieldScheduler(client, "data/nightly-2024-05-01.jsonl")
+    report = scheduler.run({"field-1": SAMPLE_FIELD_POLYGON, ...})
+
+    python field_scheduler.py --stub --fields 500
+"""
+
+import argparse
+import json
+import math
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, timedelta
+
+import numpy as np
+
+import geotiff
+from compositing import COMPOSITE_BANDS, COMPOSITE_EVALSCRIPT, clear_mask
+from field_zonal import ZonalEngine
+from forecast_batch import TokenBucket
+from imagery_cache import geometry_bounds, processing_units
+from ndvi_engine import DN_SCALE
+
+UNITS_PER_MINUTE = 300  # Sentinel Hub processing units
+REQUESTS_PER_MINUTE = 300
+BURST_SECONDS = 1.0  # quota a bucket can hold, in seconds of its rate
+RESOLUTION = 0.0001  # degrees per pixel
+CELL = 0.02  # degrees; fields further apart are never batched together
+MAX_PIXELS = 2500  # process API limit per side
+MAX_WASTE = 1.5  # merged request may cost this many times the separate ones
+WORKERS = 8
+LOOKBACK_DAYS = 10  # imagery window ending on the run date
+
+
+class QuotaLimiter:
+    """Processing-unit and request token buckets every upstream request takes from before it is sent
+
+    Each bucket holds at most burst_seconds worth of its rate, so a fresh
+    run cannot spend a minute's quota in its first second. A request costing
+    more processing units than the bucket holds is charged in full: it waits
+    for a full bucket and the debt delays the requests after it.
+    """
+
+    def __init__(self, units_per_minute=UNITS_PER_MINUTE, requests_per_minute=REQUESTS_PER_MINUTE,
+                 burst_seconds=BURST_SECONDS):
+        self.units = self.requests = None
+        if units_per_minute:
+            self.units = TokenBucket(units_per_minute / 60, max(1.0, units_per_minute / 60 * burst_seconds))
+        if requests_per_minute:
+            self.requests = TokenBucket(requests_per_minute / 60, max(1.0, requests_per_minute / 60 * burst_seconds))
+
+    def acquire(self, payload):
+        if self.requests is not None:
+            self.requests.acquire()
+        if self.units is not None:
+            self.units.acquire(processing_units(payload))
+
+
+class Batch:
+    """Fields analysed from one shared-bbox process request"""
+
+    def __init__(self, field_ids, bounds, resolution):
+        self.field_ids = field_ids
+        self.bounds = bounds
+        self.resolution = resolution
+
+    @property
+    def size(self):
+        """(width, height) in pixels"""
+        min_lng, min_lat, max_lng, max_lat = self.bounds
+        return (max(1, math.ceil((max_lng - min_lng) / self.resolution)),
+                max(1, math.ceil((max_lat - min_lat) / self.resolution)))
+
+    def units(self):
+        width, height = self.size
+        return _units(width, height)
+
+
+def _units(width, height):
+    return processing_units({"evalscript": COMPOSITE_EVALSCRIPT, "output": {"width": width, "height": height}})
+
+
+def _union(a, b):
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+
+def plan_batches(fields, resolution=RESOLUTION, cell=CELL, max_pixels=MAX_PIXELS, max_waste=MAX_WASTE):
+    """Group {field_id: geometry} into Batches of nearby fields whose shared bbox is worth requesting once"""
+    ids = list(fields)
+    if not ids:
+        return []
+    bounds = np.array([geometry_bounds(fields[field_id]) for field_id in ids])
+    centres = (bounds[:, :2] + bounds[:, 2:]) / 2
+    cells = np.floor(centres / cell).astype(np.int64)
+    # Visit fields cell by cell, west to east within a cell, so neighbours are merged first
+    order = np.lexsort((centres[:, 0], cells[:, 0], cells[:, 1]))
+    batches = []
+    current = None
+    current_cell = None
+    separate = 0.0
+    for index in order:
+        box = tuple(bounds[index])
+        width, height = Batch([], box, resolution).size
+        alone = _units(width, height)
+        if current is not None and tuple(cells[index]) == current_cell:
+            merged = Batch(current.field_ids, _union(current.bounds, box), resolution)
+            merged_width, merged_height = merged.size
+            if (merged_width <= max_pixels and merged_height <= max_pixels
+                    and merged.units() <= (separate + alone) * max_waste):
+                current.field_ids.append(ids[index])
+                current.bounds = merged.bounds
+                separate += alone
+                continue
+        current = Batch([ids[index]], box, resolution)
+        current_cell = tuple(cells[index])
+        separate = alone
+        batches.append(current)
+    return batches
+
+
+class Checkpoint:
+    """Append-only JSON lines file of finished fields"""
+
+    def __init__(self, path):
+        self.path = path
+        self.done = {}
+        if path and os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        row = json.loads(line)
+                    except ValueError:
+                        continue  # a line cut short by a crash
+                    self.done[row["field_id"]] = row
+        self.lock = threading.Lock()
+
+    def record(self, rows):
+        """Durably append finished fields"""
+        with self.lock:
+            for row in rows:
+                self.done[row["field_id"]] = row
+            if not self.path:
+                return
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write("".join(json.dumps(row) + "\n" for row in rows))
+                f.flush()
+                os.fsync(f.fileno())
+
+
+class FieldScheduler:
+    """Runs cloud-masked NDVI analysis for many fields with batching, a worker pool and checkpoints"""
+
+    def __init__(self, client, checkpoint=None, resolution=RESOLUTION, cell=CELL, max_waste=MAX_WASTE,
+                 workers=WORKERS, lookback_days=LOOKBACK_DAYS, batch=True):
+        self.client = client
+        self.checkpoint = checkpoint if isinstance(checkpoint, Checkpoint) else Checkpoint(checkpoint)
+        self.resolution = resolution
+        self.cell = cell
+        self.max_waste = max_waste
+        self.workers = workers
+        self.lookback_days = lookback_days
+        self.batch = batch
+        self.engine = ZonalEngine()
+
+    def payload(self, batch, day):
+        width, height = batch.size
+        min_lng, min_lat, max_lng, max_lat = batch.bounds
+        first = day - timedelta(days=self.lookback_days)
+        return {
+            "input": {"bounds": {"bbox": [min_lng, min_lat, min_lng + width * self.resolution,
+                                          min_lat + height * self.resolution]},
+                      "data": [{"type": "sentinel-2-l2a",
+                                "dataFilter": {"timeRange": {"from": f"{first.isoformat()}T00:00:00Z",
+                                                             "to": f"{day.isoformat()}T23:59:59Z"},
+                                               "mosaickingOrder": "leastCC"}}]},
+            "evalscript": COMPOSITE_EVALSCRIPT,
+            "output": {"width": width, "height": height,
+                       "responses": [{"identifier": "default", "format": {"type": "image/tiff"}}]},
+        }
+
+    def analyse(self, batch, fields, day):
+        """Result rows for every field of a batch"""
+        path = self.client.process_path(self.payload(batch, day))
+        raster = geotiff.open_raster(path, COMPOSITE_BANDS)
+        scale = np.float32(DN_SCALE)
+        red = raster.band("B04") * scale
+        nir = raster.band("B08") * scale
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ndvi = (nir - red) / (nir + red)
+        ndvi[~clear_mask(raster.band("SCL"), raster.band("dataMask"))] = np.nan
+        min_lng, min_lat, _, _ = batch.bounds
+        height = raster.shape[0]
+        transform = (min_lng, self.resolution, min_lat + height * self.resolution, -self.resolution)
+        stats = self.engine.stats(ndvi, transform, [fields[field_id] for field_id in batch.field_ids],
+                                  percentiles=(10, 50, 90))
+        rows = []
+        for i, field_id in enumerate(batch.field_ids):
+            row = {"field_id": field_id, "date": day.isoformat(), "pixels": int(stats["pixels"][i]),
+                   "clear_ratio": _number(stats["valid_ratio"][i])}
+            for name in ("mean", "std", "min", "max", "p10", "median", "p90"):
+                row[f"ndvi_{name}"] = _number(stats[name][i])
+            rows.append(row)
+        return rows
+
+    def run(self, fields, day=None, stop_after=None):
+        """Analyse every field not yet in the checkpoint; returns a report dict
+
+        stop_after simulates a crash after that many batches (for resume testing).
+        """
+        day = day or date.today()
+        pending = {field_id: geometry for field_id, geometry in fields.items()
+                   if field_id not in self.checkpoint.done}
+        if self.batch:
+            batches = plan_batches(pending, self.resolution, self.cell, max_waste=self.max_waste)
+        else:
+            batches = [Batch([field_id], geometry_bounds(geometry), self.resolution)
+                       for field_id, geometry in pending.items()]
+        requests_before, units_before = self.client.requests, self.client.units
+        rejected_before = self.client.rejected
+        failures = []
+        finished = 0
+        started = time.perf_counter()
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        futures = {executor.submit(self.analyse, batch, pending, day): batch for batch in batches}
+        try:
+            for completed, future in enumerate(as_completed(futures), 1):
+                batch = futures[future]
+                try:
+                    rows = future.result()
+                except Exception as e:
+                    failures.append((batch.field_ids, str(e)))
+                    continue
+                self.checkpoint.record(rows)
+                finished += len(rows)
+                if stop_after is not None and completed >= stop_after:
+                    raise KeyboardInterrupt(f"stopped after {completed} batches")
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+        elapsed = time.perf_counter() - started
+        return {
+            "fields": len(fields),
+            "skipped": len(fields) - len(pending),
+            "finished": finished,
+            "failed": sum(len(field_ids) for field_ids, _ in failures),
+            "batches": len(batches),
+            "requests": self.client.requests - requests_before,
+            "rejected": self.client.rejected - rejected_before,
+            "units": round(self.client.units - units_before, 3),
+            "seconds": round(elapsed, 2),
+            "fields_per_hour": round(finished / elapsed * 3600) if elapsed else None,
+            "errors": failures[:20],
+        }
+
+
+def _number(value):
+    value = float(value)
+    return None if math.isnan(value) else round(value, 4)
+
+
+def random_farm_fields(count, seed=5, clusters=None, spread=0.01):
+    """Fields clustered in villages around the AFRICAN_COORDINATES cities, as GeoJSON Polygons"""
+    from backend_test import AFRICAN_COORDINATES
+
+    rng = np.random.default_rng(seed)
+    towns = list(AFRICAN_COORDINATES.values())
+    clusters = clusters or max(1, count // 25)
+    centres = [(town["lng"] + rng.normal(0, 0.3), town["lat"] + rng.normal(0, 0.3))
+               for town in (towns[i % len(towns)] for i in range(clusters))]
+    fields = {}
+    for i in range(count):
+        lng, lat = centres[rng.integers(len(centres))]
+        lng += rng.uniform(-spread, spread)
+        lat += rng.uniform(-spread, spread)
+        half = rng.uniform(0.0003, 0.0012, 2)  # ~60 m to ~250 m across
+        ring = [[lng - half[0], lat - half[1]], [lng + half[0], lat - half[1]], [lng + half[0], lat + half[1]],
+                [lng - half[0], lat + half[1]], [lng - half[0], lat - half[1]]]
+        fields[f"field-{i}"] = {"type": "Polygon", "coordinates": [ring]}
+    return fields
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="https://services.sentinel-hub.com", help="Sentinel Hub base URL")
+    parser.add_argument("--stub", action="store_true", help="use an in-process stub server")
+    parser.add_argument("--stub-latency", type=float, default=0.3, help="seconds the stub adds to every request")
+    parser.add_argument("--stub-rate-limit", type=float, default=5.0, help="requests/sec the stub admits")
+    parser.add_argument("--fields", type=int, default=500)
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--units-per-minute", type=float, default=UNITS_PER_MINUTE)
+    parser.add_argument("--requests-per-minute", type=float, default=REQUESTS_PER_MINUTE)
+    parser.add_argument("--checkpoint", help="checkpoint file to keep (default: a temporary one)")
+    args = parser.parse_args()
+
+    from backend_test_new import SENTINEL_CLIENT_ID, SENTINEL_CLIENT_SECRET, SENTINEL_TOKEN_PATH
+    from imagery_cache import ImageryCache, ProcessClient
+    from sentinel_auth import SentinelTokenManager
+
+    base_url = args.url
+    requests_per_minute = args.requests_per_minute
+    if args.stub:
+        from stub_server import start_stub_server
+        server, base_url = start_stub_server(latency=args.stub_latency, rate_limit=args.stub_rate_limit)
+        # Stay a little under the stub's limit: network jitter can bunch up requests sent evenly spaced
+        requests_per_minute = min(requests_per_minute, args.stub_rate_limit * 60 * 0.9)
+    tokens = SentinelTokenManager(SENTINEL_CLIENT_ID, SENTINEL_CLIENT_SECRET, f"{base_url}{SENTINEL_TOKEN_PATH}",
+                                  cache_dir=None)
+    fields = random_farm_fields(args.fields)
+    with tempfile.TemporaryDirectory(prefix="field_scheduler_") as directory:
+        def client(limiter):
+            return ProcessClient(tokens, base_url, cache=ImageryCache(tempfile.mkdtemp(dir=directory)), limiter=limiter)
+
+        tokens.get_token()
+        runs = [
+            ("one field at a time (as test_sentinel_hub_api)", dict(workers=1, batch=False), None),
+            ("worker pool, no limiter", dict(workers=args.workers, batch=False), None),
+            ("worker pool + batching + quota limiter", dict(workers=args.workers),
+             QuotaLimiter(args.units_per_minute, requests_per_minute)),
+        ]
+        sample = dict(list(fields.items())[:60])
+        for number, (label, options, limiter) in enumerate(runs):
+            if args.stub:
+                time.sleep(1.0)  # let the stub's own rate-limit bucket refill after the previous run
+            scheduler = FieldScheduler(client(limiter), os.path.join(directory, f"run{number}.jsonl"), **options)
+            report = scheduler.run(sample if options.get("batch") is False else fields)
+            print(f"{label}: {report['finished']} fields, {report['batches']} batches, {report['requests']} requests "
+                  f"({report['rejected']} rejected with 429), ~{report['units']} PU, {report['seconds']}s, "
+                  f"{report['fields_per_hour']} fields/hour")
+
+        # Crash after a few batches, then resume from the checkpoint
+        checkpoint = args.checkpoint or os.path.join(directory, "checkpoint.jsonl")
+        limiter = QuotaLimiter(args.units_per_minute, requests_per_minute)
+        try:
+            FieldScheduler(client(limiter), checkpoint, workers=args.workers).run(fields, stop_after=5)
+        except KeyboardInterrupt as e:
+            print(f"simulated crash: {e}; {len(Checkpoint(checkpoint).done)} fields checkpointed")
+        report = FieldScheduler(client(limiter), checkpoint, workers=args.workers).run(fields)
+        print(f"resumed: skipped {report['skipped']} checkpointed fields, finished {report['finished']} more "
+              f"in {report['batches']} batches")
+        print(f"  {len(Checkpoint(checkpoint).done)} of {len(fields)} fields checkpointed"
+              + (f" in {checkpoint}" if args.checkpoint else ""))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
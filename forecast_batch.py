@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+Batch 5-day forecast fetcher for many farm locations.
+
+Farm coordinates are deduplicated to weather_cache grid cells, the forecast
+of each unique cell centre is fetched concurrently under a token-bucket rate
+limit (with AdaptiveThrottle backoff on 429/5xx), and the 40 three-hourly
+entries of every response are packed into one dense float32 array of shape
+(cells, 40, len(VARIABLES)). Temperatures are converted from Kelvin in a
+single vectorized step. ForecastBatch.values broadcasts the cell array back
+to (locations, 40, variables), and advisories() evaluates farm-wide alert
+rules as array expressions, so a nightly run is one pipeline instead of per
+farm JSON handling.
+
+    batch = fetch_forecasts(lat, lng, api_key=OPENWEATHERMAP_API_KEY, rate=50)
+    temp_c = batch.variable("temp")          # (locations, 40)
+    alerts = batch.advisories()              # {"heat": bool array, ...}
+
+    python forecast_batch.py --stub --farms 20000 --rate 100
+"""
+
+import argparse
+import sys
+import threading
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+
+from insert_market_listings import AdaptiveThrottle
+from weather_cache import DEFAULT_GRID, OPENWEATHERMAP_URL, Grid
+
+FORECAST_STEPS = 40  # 5 days x 3 hours
+VARIABLES = ("temp", "feels_like", "temp_min", "temp_max", "humidity", "pressure", "wind_speed", "wind_gust",
+             "clouds", "pop", "rain_3h")
+KELVIN_VARIABLES = ("temp", "feels_like", "temp_min", "temp_max")
+KELVIN = 273.15
+STEPS_PER_DAY = 8
+
+# name -> (variable, reduction over the next 24 hours, comparison, threshold); temperatures in Celsius
+ADVISORY_RULES = {
+    "heat": ("temp_max", "max", ">", 35.0),
+    "frost": ("temp_min", "min", "<", 2.0),
+    "heavy_rain": ("rain_3h", "sum", ">", 20.0),
+    "strong_wind": ("wind_speed", "max", ">", 10.0),
+    "high_humidity": ("humidity", "mean", ">", 85.0),
+}
+
+
+class TokenBucket:
+    """Blocking token bucket shared by worker threads: rate tokens/sec, up to burst at once"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = float(burst or max(1.0, rate or 0))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """Block until tokens are available and take them
+
+        A request larger than burst waits for a full bucket and leaves it in
+        debt, so later requests wait until the excess has been paid back.
+        """
+        if not self.rate:
+            return
+        needed = min(tokens, self.burst)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= needed:
+                    self.tokens -= tokens
+                    return
+                wait = (needed - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def parse_entries(entries):
+    """(timestamps, values) of one forecast "list": int64 (n,) and float32 (n, len(VARIABLES)), still in Kelvin"""
+    nan = float("nan")
+    rows = [(e["main"]["temp"], e["main"]["feels_like"], e["main"]["temp_min"], e["main"]["temp_max"],
+             e["main"]["humidity"], e["main"]["pressure"], e["wind"]["speed"], e["wind"].get("gust", nan),
+             e.get("clouds", {}).get("all", nan), e.get("pop", 0.0), e.get("rain", {}).get("3h", 0.0))
+            for e in entries]
+    times = np.fromiter((e["dt"] for e in entries), dtype=np.int64, count=len(entries))
+    return times, np.array(rows, dtype=np.float32).reshape(len(rows), len(VARIABLES))
+
+
+class ForecastBatch:
+    """Forecasts of many locations backed by one (cells, steps, variables) array"""
+
+    def __init__(self, cell_index, centres, times, data, errors=None):
+        self.cell_index = cell_index  # location -> row of data
+        self.centres = centres  # (cells, 2) lat/lng sent upstream
+        self.times = times  # (cells, steps) unix seconds, 0 where missing
+        self.data = data  # (cells, steps, variables), NaN where missing
+        self.errors = errors or {}  # cell row -> error message
+
+    def __len__(self):
+        return len(self.cell_index)
+
+    @property
+    def values(self):
+        """(locations, steps, variables) view of the forecasts; a gathered copy, so use per variable when large"""
+        return self.data[self.cell_index]
+
+    def variable(self, name):
+        """(locations, steps) array of one variable"""
+        return self.data[:, :, VARIABLES.index(name)][self.cell_index]
+
+    def reduce(self, name, how, steps=STEPS_PER_DAY):
+        """Per-location reduction ("max", "min", "sum", "mean") of a variable over the first steps entries"""
+        window = self.data[:, :steps, VARIABLES.index(name)]
+        with warnings.catch_warnings():
+            # Cells whose fetch failed are all-NaN and stay NaN
+            warnings.simplefilter("ignore", RuntimeWarning)
+            reduced = getattr(np, f"nan{how}")(window, axis=1)
+        return reduced[self.cell_index]
+
+    def advisories(self, rules=ADVISORY_RULES, steps=STEPS_PER_DAY):
+        """{rule name: boolean array per location} for the next steps forecast entries"""
+        flags = {}
+        for name, (variable, how, op, threshold) in rules.items():
+            reduced = self.reduce(variable, how, steps)
+            flags[name] = reduced > threshold if op == ">" else reduced < threshold
+        return flags
+
+
+def _create_session(pool_size):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _fetch_forecast(session, url, params, bucket, throttle, retries):
+    """GET one forecast, retrying throttled, failed and 5xx responses with backoff"""
+    error = None
+    for _ in range(retries + 1):
+        bucket.acquire()
+        throttle.wait()
+        try:
+            response = session.get(url, params=params, timeout=30)
+        except requests.RequestException as e:
+            error = e
+            throttle.throttled()
+            continue
+        if response.status_code == 429 or response.status_code >= 500:
+            error = requests.HTTPError(f"{response.status_code} {response.reason}", response=response)
+            throttle.throttled(response.headers.get("Retry-After"))
+            continue
+        response.raise_for_status()
+        throttle.succeeded()
+        return response.json()
+    raise error
+
+
+def fetch_forecasts(lat, lng, grid=DEFAULT_GRID, base_url=OPENWEATHERMAP_URL, api_key=None, workers=16, rate=None,
+                    retries=3, cache=None, session=None):
+    """Fetch the forecast of every location once per grid cell and return a ForecastBatch
+
+    With a weather_cache.WeatherCache the lookups go through it (and its own
+    fetch); otherwise rate (requests/sec) bounds the direct upstream calls.
+    Cells whose fetch still fails after retries are NaN and listed in errors.
+    """
+    grid = grid if isinstance(grid, Grid) else Grid(grid)
+    keys, cell_index = np.unique(grid.key_array(lat, lng), axis=0, return_inverse=True)
+    cell_index = cell_index.reshape(-1)
+    centres = np.array([grid.centre(grid.key_of(row)) for row in keys], dtype=np.float64).reshape(-1, 2)
+    if cache is None:
+        session = session or _create_session(workers)
+        bucket = TokenBucket(rate)
+        throttle = AdaptiveThrottle()
+        url = f"{base_url.rstrip('/')}/data/2.5/forecast"
+
+        def fetch(centre):
+            return _fetch_forecast(session, url, {"lat": centre[0], "lon": centre[1], "appid": api_key},
+                                   bucket, throttle, retries)
+    else:
+        def fetch(centre):
+            return cache.forecast(*centre)
+
+    def fetch_cell(row):
+        try:
+            return row, fetch(centres[row]), None
+        except (requests.RequestException, ValueError) as e:
+            return row, None, str(e)
+
+    times = np.zeros((len(keys), FORECAST_STEPS), dtype=np.int64)
+    data = np.full((len(keys), FORECAST_STEPS, len(VARIABLES)), np.nan, dtype=np.float32)
+    errors = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for row, forecast, error in executor.map(fetch_cell, range(len(keys))):
+            if error is not None:
+                errors[row] = error
+                continue
+            entries = forecast.get("list", [])[:FORECAST_STEPS]
+            if entries:
+                times[row, :len(entries)], data[row, :len(entries)] = parse_entries(entries)
+    # One vectorized Kelvin -> Celsius pass over every cell and timestep
+    columns = [VARIABLES.index(name) for name in KELVIN_VARIABLES]
+    data[:, :, columns] -= KELVIN
+    return ForecastBatch(cell_index, centres, times, data, errors)
+
+
+def run_benchmark(farms=20_000, grid=DEFAULT_GRID, base_url=OPENWEATHERMAP_URL, api_key=None, workers=16, rate=None,
+                  baseline=200, seed=7):
+    """Compare per-farm fetch and conversion with the batch pipeline"""
+    import random
+    from load_test import random_location
+
+    rng = random.Random(seed)
+    locations = np.array([random_location(rng) for _ in range(farms)])
+    lat, lng = locations[:, 0], locations[:, 1]
+
+    session = _create_session(workers)
+    farm_temps = np.full((baseline, FORECAST_STEPS), np.nan)
+    started = time.perf_counter()
+    for row, (la, ln) in enumerate(locations[:baseline]):
+        response = session.get(f"{base_url}/data/2.5/forecast", params={"lat": la, "lon": ln, "appid": api_key},
+                               timeout=30)
+        temps = [entry["main"]["temp"] - KELVIN for entry in response.json()["list"][:FORECAST_STEPS]]
+        farm_temps[row, :len(temps)] = temps
+    per_farm = (time.perf_counter() - started) / baseline
+    print(f"Per-farm JSON path: {baseline} farms in {per_farm * baseline:.2f}s -> "
+          f"~{per_farm * farms:.0f}s projected for {farms} farms")
+
+    started = time.perf_counter()
+    batch = fetch_forecasts(lat, lng, grid, base_url, api_key, workers, rate)
+    elapsed = time.perf_counter() - started
+    print(f"Batch: {farms} farms -> {len(batch.centres)} cells, fetched and packed in {elapsed:.2f}s "
+          f"({len(batch.errors)} failed cells, {per_farm * farms / elapsed:.0f}x faster)")
+    # What sharing one forecast per cell costs against the per-farm forecasts
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # farms whose cell failed are all-NaN
+        grid_error = np.nanmean(np.abs(farm_temps - batch.variable("temp")[:baseline]))
+    print(f"  grid error on the {baseline} per-farm forecasts: mean |temperature difference| {grid_error:.2f} C")
+
+    # Unit conversion alone, over the same amount of data
+    entries = [{"main": {"temp": float(t)}} for t in batch.data[:, :, 0].ravel() + KELVIN]
+    started = time.perf_counter()
+    looped = [entry["main"]["temp"] - KELVIN for entry in entries]
+    loop = time.perf_counter() - started
+    kelvin = batch.data[:, :, 0] + KELVIN
+    started = time.perf_counter()
+    converted = kelvin - KELVIN
+    vectorized = time.perf_counter() - started
+    assert np.allclose(np.array(looped).reshape(converted.shape), converted, equal_nan=True)
+    print(f"Kelvin->Celsius over {kelvin.size} values: per-entry {loop * 1000:.1f}ms, "
+          f"vectorized {vectorized * 1000:.2f}ms")
+
+    started = time.perf_counter()
+    alerts = batch.advisories()
+    print(f"Advisories for {farms} farms in {(time.perf_counter() - started) * 1000:.1f}ms: "
+          + ", ".join(f"{name} {int(flags.sum())}" for name, flags in alerts.items()))
+    return batch
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default=OPENWEATHERMAP_URL, help="OpenWeatherMap (or stub server) base URL")
+    parser.add_argument("--api-key", help="OpenWeatherMap API key (default: the backend test key)")
+    parser.add_argument("--stub", action="store_true", help="run against an in-process stub server")
+    parser.add_argument("--stub-latency", type=float, default=0.02, help="seconds the stub adds to every request")
+    parser.add_argument("--grid", default=str(DEFAULT_GRID), help="cell size in degrees, or geohash<precision>")
+    parser.add_argument("--farms", type=int, default=20_000)
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--rate", type=float, default=None, help="upstream requests/sec (default: unlimited)")
+    parser.add_argument("--baseline", type=int, default=200, help="farms fetched one by one for comparison")
+    args = parser.parse_args()
+
+    base_url = args.url
+    if args.stub:
+        from stub_server import start_stub_server
+        server, base_url = start_stub_server(latency=args.stub_latency)
+    api_key = args.api_key
+    if api_key is None:
+        from backend_test import OPENWEATHERMAP_API_KEY as api_key
+    batch = run_benchmark(args.farms, args.grid, base_url, api_key, args.workers, args.rate, args.baseline)
+    return 1 if batch.errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,257 @@
+"""
+Minimal GeoTIFF reader and writer for uncompressed Sentinel Hub rasters.
+
+Reads little- or big-endian, stripped or tiled, chunky or planar TIFFs with
+unsigned/signed integer or float samples and no compression: the layout the
+process API returns for sampleType UINT8/UINT16/FLOAT32 TIFF output (and
+what stub_apis serves). When the image data is one contiguous run of bytes,
+as with single-strip and most multi-strip files, pixels come back as a
+read-only np.memmap and band() returns views of it, so nothing is copied
+until a computation touches it. ModelPixelScale and ModelTiepoint give the
+geotransform.
+
+    raster = open_raster("tile.tif", band_names=("B04", "B08", "dataMask"))
+    red = raster.band("B04")  # (height, width) view of the memmap
+    save_raster("ndvi.tif", ndvi, transform=raster.transform)
+"""
+
+import os
+import struct
+
+import numpy as np
+
+# TIFF field type -> (struct code, size)
+FIELD_TYPES = {1: ("B", 1), 2: ("s", 1), 3: ("H", 2), 4: ("I", 4), 6: ("b", 1), 8: ("h", 2), 9: ("i", 4),
+               11: ("f", 4), 12: ("d", 8), 16: ("Q", 8)}
+SAMPLE_KINDS = {1: "u", 2: "i", 3: "f"}  # SampleFormat -> numpy kind
+SAMPLE_TYPES = {"UINT8": np.uint8, "UINT16": np.uint16, "FLOAT32": np.float32}
+
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+PHOTOMETRIC = 262
+STRIP_OFFSETS = 273
+SAMPLES_PER_PIXEL = 277
+ROWS_PER_STRIP = 278
+STRIP_BYTE_COUNTS = 279
+PLANAR_CONFIGURATION = 284
+TILE_WIDTH = 322
+TILE_LENGTH = 323
+TILE_OFFSETS = 324
+TILE_BYTE_COUNTS = 325
+EXTRA_SAMPLES = 338
+SAMPLE_FORMAT = 339
+MODEL_PIXEL_SCALE = 33550
+MODEL_TIEPOINT = 33922
+GEO_KEY_DIRECTORY = 34735
+
+# GTModelType geographic, RasterPixelIsArea, GeographicType WGS 84
+WGS84_GEO_KEYS = (1, 1, 0, 3, 1024, 0, 1, 2, 1025, 0, 1, 1, 2048, 0, 1, 4326)
+
+
+class Raster:
+    """Pixels of a (Geo)TIFF plus its transform (x0, dx, y0, dy): pixel (row, col) covers x0 + col * dx, y0 + row * dy"""
+
+    def __init__(self, data, transform=None, band_names=None, planar=False, path=None):
+        self.data = data
+        self.transform = transform
+        self.planar = planar
+        self.path = path
+        self.band_names = tuple(band_names or ())
+
+    @property
+    def shape(self):
+        """(height, width)"""
+        return self.data.shape[1:] if self.planar else self.data.shape[:2]
+
+    @property
+    def count(self):
+        return self.data.shape[0] if self.planar else self.data.shape[2]
+
+    def band(self, band):
+        """(height, width) view of a band, by index or name"""
+        index = self.band_names.index(band) if isinstance(band, str) else band
+        return self.data[index] if self.planar else self.data[:, :, index]
+
+    def bounds(self):
+        """(min_x, min_y, max_x, max_y) in map units"""
+        x0, dx, y0, dy = self.transform
+        height, width = self.shape
+        xs = (x0, x0 + width * dx)
+        ys = (y0, y0 + height * dy)
+        return min(xs), min(ys), max(xs), max(ys)
+
+
+def _read_ifd(f, order, offset):
+    """{tag: tuple of values} of the IFD at offset"""
+    f.seek(offset)
+    (count,) = struct.unpack(f"{order}H", f.read(2))
+    raw = f.read(12 * count)
+    tags = {}
+    for i in range(count):
+        tag, field_type, values, inline = struct.unpack(f"{order}HHI4s", raw[12 * i:12 * i + 12])
+        if field_type not in FIELD_TYPES:
+            continue
+        code, size = FIELD_TYPES[field_type]
+        length = size * values
+        if length <= 4:
+            payload = inline[:length]
+        else:
+            position = f.tell()
+            f.seek(struct.unpack(f"{order}I", inline)[0])
+            payload = f.read(length)
+            f.seek(position)
+        tags[tag] = (payload.rstrip(b"\0").decode("latin-1"),) if code == "s" else \
+            struct.unpack(f"{order}{values}{code}", payload)
+    return tags
+
+
+def _dtype(tags, order):
+    bits = set(tags.get(BITS_PER_SAMPLE, (1,)))
+    formats = set(tags.get(SAMPLE_FORMAT, (1,)))
+    if len(bits) != 1 or len(formats) != 1:
+        raise ValueError("bands with different sample types are not supported")
+    kind = SAMPLE_KINDS.get(formats.pop())
+    if kind is None:
+        raise ValueError("unsupported SampleFormat")
+    return np.dtype(f"{'<' if order == '<' else '>'}{kind}{bits.pop() // 8}")
+
+
+def _transform(tags):
+    if MODEL_PIXEL_SCALE not in tags or MODEL_TIEPOINT not in tags:
+        return None
+    dx, dy = tags[MODEL_PIXEL_SCALE][:2]
+    i, j, _, x, y = tags[MODEL_TIEPOINT][:5]
+    return x - i * dx, dx, y + j * dy, -dy
+
+
+def open_raster(path, band_names=None):
+    """Open the first image of an uncompressed TIFF, memory-mapped when its data is contiguous"""
+    with open(path, "rb") as f:
+        magic = f.read(8)
+        if magic[:4] not in (b"II*\0", b"MM\0*"):
+            raise ValueError(f"{path} is not a classic TIFF file")
+        order = "<" if magic[:2] == b"II" else ">"
+        tags = _read_ifd(f, order, struct.unpack(f"{order}I", magic[4:])[0])
+        if tags.get(COMPRESSION, (1,))[0] != 1:
+            raise ValueError(f"{path} is compressed; request uncompressed TIFF output")
+        width = tags[IMAGE_WIDTH][0]
+        height = tags[IMAGE_LENGTH][0]
+        count = tags.get(SAMPLES_PER_PIXEL, (1,))[0]
+        planar = tags.get(PLANAR_CONFIGURATION, (1,))[0] == 2 and count > 1
+        dtype = _dtype(tags, order)
+        shape = (count, height, width) if planar else (height, width, count)
+        transform = _transform(tags)
+
+        if TILE_OFFSETS in tags:
+            data = _read_tiles(f, tags, dtype, shape, planar)
+        else:
+            offsets = tags[STRIP_OFFSETS]
+            counts = tags[STRIP_BYTE_COUNTS]
+            total = int(np.prod(shape)) * dtype.itemsize
+            contiguous = all(offsets[i] + counts[i] == offsets[i + 1] for i in range(len(offsets) - 1))
+            if contiguous and sum(counts) >= total:
+                data = np.memmap(path, dtype=dtype, mode="r", offset=offsets[0], shape=shape)
+            else:
+                buffer = bytearray()
+                for offset, length in zip(offsets, counts):
+                    f.seek(offset)
+                    buffer += f.read(length)
+                data = np.frombuffer(bytes(buffer[:total]), dtype=dtype).reshape(shape)
+    return Raster(data, transform, band_names, planar, path)
+
+
+def _read_tiles(f, tags, dtype, shape, planar):
+    """Assemble a tiled image into an in-memory array (tiles cannot be one memmap)"""
+    tile_width = tags[TILE_WIDTH][0]
+    tile_height = tags[TILE_LENGTH][0]
+    planes, height, width = shape if planar else (1,) + shape[:2]
+    samples = 1 if planar else shape[2]
+    across = -(-width // tile_width)
+    down = -(-height // tile_height)
+    data = np.empty(shape, dtype=dtype)
+    for index, (offset, length) in enumerate(zip(tags[TILE_OFFSETS], tags[TILE_BYTE_COUNTS])):
+        plane, rest = divmod(index, across * down)
+        row, col = divmod(rest, across)
+        f.seek(offset)
+        tile = np.frombuffer(f.read(length), dtype=dtype)[:tile_height * tile_width * samples]
+        tile = tile.reshape(tile_height, tile_width, samples)
+        rows = slice(row * tile_height, min(height, (row + 1) * tile_height))
+        cols = slice(col * tile_width, min(width, (col + 1) * tile_width))
+        block = tile[:rows.stop - rows.start, :cols.stop - cols.start]
+        if planar:
+            data[plane, rows, cols] = block[:, :, 0]
+        else:
+            data[rows, cols] = block
+    return data
+
+
+def encode_header(width, height, count, dtype, transform=None):
+    """Little-endian TIFF header and IFD for one chunky strip of pixel data that follows it directly"""
+    dtype = np.dtype(dtype)
+    sample_format = {"u": 1, "i": 2, "f": 3}[dtype.kind]
+    data_length = width * height * count * dtype.itemsize
+    tags = [
+        (IMAGE_WIDTH, 4, [width]),
+        (IMAGE_LENGTH, 4, [height]),
+        (BITS_PER_SAMPLE, 3, [dtype.itemsize * 8] * count),
+        (COMPRESSION, 3, [1]),
+        (PHOTOMETRIC, 3, [1]),  # min-is-black
+        (STRIP_OFFSETS, 4, [0]),  # patched below
+        (SAMPLES_PER_PIXEL, 3, [count]),
+        (ROWS_PER_STRIP, 4, [height]),
+        (STRIP_BYTE_COUNTS, 4, [data_length]),
+        (PLANAR_CONFIGURATION, 3, [1]),
+    ]
+    if count > 1:
+        tags.append((EXTRA_SAMPLES, 3, [0] * (count - 1)))
+    tags.append((SAMPLE_FORMAT, 3, [sample_format] * count))
+    if transform is not None:
+        x0, dx, y0, dy = transform
+        tags += [(MODEL_PIXEL_SCALE, 12, [dx, -dy, 0.0]),
+                 (MODEL_TIEPOINT, 12, [0.0, 0.0, 0.0, x0, y0, 0.0]),
+                 (GEO_KEY_DIRECTORY, 3, list(WGS84_GEO_KEYS))]
+    # Values that do not fit the 4-byte entry field go after the IFD, then the pixel data
+    ifd_end = 8 + 2 + 12 * len(tags) + 4
+    extra = b""
+    entries = []
+    for tag, field_type, values in tags:
+        code = FIELD_TYPES[field_type][0]
+        packed = struct.pack(f"<{len(values)}{code}", *values)
+        if len(packed) > 4:
+            entries.append((tag, field_type, len(values), struct.pack("<I", ifd_end + len(extra))))
+            extra += packed + b"\0" * (len(packed) % 2)
+        else:
+            entries.append((tag, field_type, len(values), packed.ljust(4, b"\0")))
+    data_offset = ifd_end + len(extra)
+    ifd = struct.pack("<H", len(entries))
+    for tag, field_type, values, inline in entries:
+        if tag == STRIP_OFFSETS:
+            inline = struct.pack("<I", data_offset)
+        ifd += struct.pack("<HHI", tag, field_type, values) + inline
+    return b"II*\0" + struct.pack("<I", 8) + ifd + struct.pack("<I", 0) + extra
+
+
+def encode(array, transform=None):
+    """Bytes of a TIFF holding a (height, width) or (height, width, bands) array"""
+    array = np.asarray(array)
+    if array.ndim == 2:
+        array = array[:, :, None]
+    height, width, count = array.shape
+    array = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder("<"))
+    return encode_header(width, height, count, array.dtype, transform) + array.tobytes()
+
+
+def save_raster(path, array, transform=None):
+    """Write a (height, width) or (height, width, bands) array as an uncompressed GeoTIFF"""
+    array = np.asarray(array)
+    if array.ndim == 2:
+        array = array[:, :, None]
+    height, width, count = array.shape
+    array = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder("<"))
+    temporary = f"{path}.tmp"
+    with open(temporary, "wb") as f:
+        f.write(encode_header(width, height, count, array.dtype, transform))
+        array.tofile(f)
+    os.replace(temporary, path)
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+Client-side preprocessing of crop-disease photos before PlantNet.
+
+Phone photos arrive as 4-12 MP JPEGs of several MB, with EXIF (GPS position,
+device, timestamps). PlantNet's recognizer works on a few hundred pixels per
+side, so prepare_image() shrinks the upload to what it can use:
+
+  1. decode at reduced scale (JPEG DCT scaling via Image.draft), then apply
+     the EXIF orientation so portrait shots stay upright
+  2. downscale to max_side pixels on the long edge
+  3. re-encode as optimized progressive JPEG (or WebP) at a tuned quality,
+     lowering it further if max_bytes is set, with no EXIF, XMP or ICC data
+  4. upload as multipart binary (plantnet_files) rather than base64 in JSON,
+     which adds a third to every byte
+
+An image that is already small, metadata-free and no larger than its
+re-encoding is passed through unchanged.
+
+    prepared = prepare_image(open("leaf.jpg", "rb").read())
+    response = session.post(plantnet_url, files=plantnet_files([prepared]), data={"organs": ["leaf"]})
+    prepared.bytes_saved, prepared.seconds
+
+    python image_prep.py --corpus photos/ --link-kbps 1000
+    python image_prep.py --stub
+"""
+
+import argparse
+import base64
+import io
+import os
+import sys
+import time
+
+from PIL import Image, ImageOps
+
+MAX_SIDE = 1280  # pixels on the long edge; PlantNet's models look at far fewer
+JPEG_QUALITY = 82
+WEBP_QUALITY = 80
+MIN_QUALITY = 50
+FORMATS = {"jpeg": ("JPEG", "image/jpeg", ".jpg"), "webp": ("WEBP", "image/webp", ".webp")}
+PASSTHROUGH_FORMATS = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+METADATA_KEYS = ("exif", "xmp", "XML:com.adobe.xmp", "icc_profile", "comment")
+LINK_KBPS = 1000  # a typical rural 3G uplink, kbit/s
+
+
+class PreparedImage:
+    """Encoded image ready for upload, with what preprocessing saved"""
+
+    def __init__(self, data, content_type, filename, size, original_bytes, original_size, seconds):
+        self.data = data
+        self.content_type = content_type
+        self.filename = filename
+        self.size = size
+        self.original_bytes = original_bytes
+        self.original_size = original_size
+        self.seconds = seconds
+
+    @property
+    def bytes_saved(self):
+        return self.original_bytes - len(self.data)
+
+    def base64(self):
+        """The image as base64 text, for JSON APIs that cannot take multipart"""
+        return base64.b64encode(self.data).decode("ascii")
+
+
+def _encode(image, image_format, quality):
+    buffer = io.BytesIO()
+    if image_format == "JPEG":
+        image.save(buffer, "JPEG", quality=quality, optimize=True, progressive=True)
+    else:
+        image.save(buffer, "WEBP", quality=quality, method=4)
+    return buffer.getvalue()
+
+
+def prepare_image(data, max_side=MAX_SIDE, image_format="jpeg", quality=None, max_bytes=None, name="image"):
+    """PreparedImage of raw image bytes: oriented, downscaled, metadata-free and re-encoded"""
+    started = time.perf_counter()
+    if image_format not in FORMATS:
+        raise ValueError(f"unsupported format {image_format!r}; expected one of {', '.join(FORMATS)}")
+    pil_format, content_type, extension = FORMATS[image_format]
+    image = Image.open(io.BytesIO(data))
+    source_format = image.format
+    original_size = image.size
+    has_metadata = any(image.info.get(key) for key in METADATA_KEYS) or bool(image.getexif())
+    if source_format == "JPEG":
+        # Let libjpeg decode at 1/2, 1/4 or 1/8 scale when that still covers max_side
+        image.draft("RGB", (max_side, max_side))
+    image = ImageOps.exif_transpose(image)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    if max(image.size) > max_side:
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+
+    quality = quality or (JPEG_QUALITY if pil_format == "JPEG" else WEBP_QUALITY)
+    encoded = _encode(image, pil_format, quality)
+    while max_bytes and len(encoded) > max_bytes and quality > MIN_QUALITY:
+        quality = max(MIN_QUALITY, quality - 10)
+        encoded = _encode(image, pil_format, quality)
+
+    if (len(encoded) >= len(data) and not has_metadata and max(original_size) <= max_side
+            and source_format in PASSTHROUGH_FORMATS):
+        # Re-encoding a small clean image would only make it bigger
+        encoded, content_type = data, PASSTHROUGH_FORMATS[source_format]
+        extension = ".png" if source_format == "PNG" else ".jpg" if source_format == "JPEG" else ".webp"
+        image_size = original_size
+    else:
+        image_size = image.size
+    return PreparedImage(encoded, content_type, f"{name}{extension}", image_size, len(data), original_size,
+                         time.perf_counter() - started)
+
+
+def plantnet_files(images):
+    """requests files= list posting every PreparedImage as an "images" part"""
+    return [("images", (image.filename, image.data, image.content_type)) for image in images]
+
+
+def identify(session, url, images, organs=("leaf",), **options):
+    """POST raw image bytes to PlantNet identify after preprocessing
+
+    Returns (response, prepared images, seconds spent preparing, seconds for the request).
+    """
+    started = time.perf_counter()
+    prepared = [prepare_image(data, name=f"image{i}", **options) for i, data in enumerate(images)]
+    prepared_at = time.perf_counter()
+    response = session.post(url, files=plantnet_files(prepared), data={"organs": list(organs)[:len(prepared)]},
+                            timeout=60)
+    return response, prepared, prepared_at - started, time.perf_counter() - prepared_at
+
+
+def synthetic_photo(width=4032, height=3024, seed=0, quality=95):
+    """A phone-like JPEG: leaf texture with lesions and sensor noise, plus EXIF with a GPS position"""
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    veins = np.abs(np.sin(x / 37.0 + np.sin(y / 211.0) * 3 + seed))
+    leaf = 0.55 + 0.25 * np.cos(y / 503.0 + seed) * np.sin(x / 701.0)
+    green = np.clip(leaf * 200 - veins * 40, 0, 255)
+    lesions = np.zeros((height, width), dtype=np.float32)
+    for cy, cx, radius in zip(rng.uniform(0, height, 25), rng.uniform(0, width, 25), rng.uniform(20, 140, 25)):
+        lesions += np.exp(-((y - cy) ** 2 + (x - cx) ** 2) / (2 * radius ** 2))
+    lesions = np.clip(lesions, 0, 1)
+    pixels = np.stack([green * 0.45 + lesions * 120, green * (1 - lesions * 0.5), green * 0.25 + lesions * 30], axis=2)
+    pixels += rng.normal(0, 6, pixels.shape).astype(np.float32)  # sensor noise
+    image = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+    exif = Image.Exif()
+    exif[0x010F] = "PhoneMaker"  # Make
+    exif[0x0110] = "Model X"  # Model
+    exif[0x0112] = 6  # Orientation: rotate 90 CW to display
+    exif[0x8825] = {1: "S", 2: (1.0, 17.0, 10.9), 3: "E", 4: (36.0, 49.0, 1.9)}  # GPS near Nairobi
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=quality, exif=exif)
+    return buffer.getvalue()
+
+
+def load_corpus(directory):
+    """Bytes of every image file in a directory"""
+    images = []
+    for name in sorted(os.listdir(directory)):
+        if os.path.splitext(name)[1].lower() in (".jpg", ".jpeg", ".png", ".webp", ".tif", ".tiff"):
+            with open(os.path.join(directory, name), "rb") as f:
+                images.append((name, f.read()))
+    return images
+
+
+def run_benchmark(images, link_kbps=LINK_KBPS, max_side=MAX_SIDE, url=None, session=None):
+    """Bytes and modelled upload time per image: base64 JSON, raw multipart and preprocessed multipart"""
+    transfer = lambda length: length * 8 / (link_kbps * 1000)  # seconds on the uplink
+    totals = {"base64 JSON": 0, "raw multipart": 0}
+    prepared_totals = {}
+    prepare_seconds = {}
+    for name, data in images:
+        totals["base64 JSON"] += len(base64.b64encode(data))
+        totals["raw multipart"] += len(data)
+        for image_format in FORMATS:
+            prepared = prepare_image(data, max_side=max_side, image_format=image_format)
+            assert not Image.open(io.BytesIO(prepared.data)).getexif().get(0x8825), "GPS EXIF left in upload"
+            label = f"prepared {image_format} multipart"
+            prepared_totals[label] = prepared_totals.get(label, 0) + len(prepared.data)
+            prepare_seconds[label] = prepare_seconds.get(label, 0.0) + prepared.seconds
+        print(f"  {name}: {len(data) / 1e6:.2f} MB {Image.open(io.BytesIO(data)).size} -> "
+              f"{len(prepared.data) / 1e3:.0f} kB webp {prepared.size}")
+
+    count = len(images)
+    print(f"{count} images, uplink {link_kbps} kbit/s (modelled), per image:")
+    for label, length in list(totals.items()) + list(prepared_totals.items()):
+        preparing = prepare_seconds.get(label, 0.0) / count
+        upload = transfer(length / count)
+        print(f"  {label:<26} {length / count / 1e3:8.0f} kB  prepare {preparing * 1000:5.0f}ms  "
+              f"upload {upload:6.2f}s  end-to-end {preparing + upload:6.2f}s  "
+              f"({100 * (1 - length / totals['base64 JSON']):.0f}% fewer bytes than base64)")
+
+    if url:
+        for label, options in (("raw", None), ("prepared", {"max_side": max_side})):
+            started = time.perf_counter()
+            for _, data in images:
+                if options is None:
+                    response = session.post(url, files=[("images", ("image.jpg", data, "image/jpeg"))],
+                                            data={"organs": ["leaf"]}, timeout=60)
+                else:
+                    response = identify(session, url, [data], **options)[0]
+                response.raise_for_status()
+            print(f"  measured round trips ({label}): {(time.perf_counter() - started) / count * 1000:.0f}ms per image")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", help="directory of photos (default: synthetic 12 MP phone photos)")
+    parser.add_argument("--count", type=int, default=6, help="synthetic photos to generate without --corpus")
+    parser.add_argument("--max-side", type=int, default=MAX_SIDE)
+    parser.add_argument("--link-kbps", type=float, default=LINK_KBPS, help="uplink speed for the upload time model")
+    parser.add_argument("--stub", action="store_true", help="also time real uploads to an in-process stub server")
+    args = parser.parse_args()
+
+    if args.corpus:
+        images = load_corpus(args.corpus)
+    else:
+        images = [(f"synthetic-{i}.jpg", synthetic_photo(seed=i)) for i in range(args.count)]
+    if not images:
+        print(f"No images found in {args.corpus}")
+        return 1
+
+    url = session = None
+    if args.stub:
+        import requests
+        from stub_server import start_stub_server
+
+        server, base_url = start_stub_server()
+        url = f"{base_url}/v2/identify/all?api-key=stub"
+        session = requests.Session()
+    run_benchmark(images, args.link_kbps, args.max_side, url, session)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
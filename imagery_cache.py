@@ -0,0 +1,470 @@
+#!/usr/bin/env python3
+"""
+Disk-backed, content-addressed cache for Sentinel Hub process API imagery.
+
+A process request is keyed by the SHA-256 of its canonical form: bounds
+(geometry or bbox, coordinates rounded to ~0.1 mm), data sources with their
+time range, the evalscript with indentation and blank lines normalised, and
+the output spec. The response body is stored as <root>/<k[:2]>/<k>.tif (or
+the response's own format), written atomically, so uncompressed TIFF tiles
+come back as read-only memmaps via geotiff.open_raster. Entries older than
+max_age are dropped and the least recently read ones are evicted once the
+cache grows past max_bytes; file mtime is the write time and atime the last
+read, so several processes can share one cache directory.
+
+TiledImagery fetches imagery for arbitrary fields through fixed tiles of a
+global lng/lat grid. Every field's request is split into the tiles covering
+it, each tile is a cacheable process request of its own, and the field's
+window is mosaicked from the memory-mapped tiles: fields that overlap or
+sit next to each other reuse the tiles already downloaded instead of paying
+processing units for the same pixels again.
+
+    cache = ImageryCache("data/imagery", max_bytes=2 << 30)
+    client = ProcessClient(token_manager, SENTINEL_HUB_URL, cache=cache)
+    body = client.process(payload)  # cached response bytes
+
+    tiles = TiledImagery(client, resolution=0.0001, time_range=("2024-05-01", "2024-05-31"))
+    raster = tiles.read(SAMPLE_FIELD_POLYGON)  # geotiff.Raster of the field's bbox
+
+    python imagery_cache.py --stub --fields 200
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+import geotiff
+from ndvi_engine import BANDS, BANDS_EVALSCRIPT
+
+CACHE_DIR = os.environ.get("IMAGERY_CACHE") or os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "cropgenius", "imagery")
+MAX_BYTES = 2 << 30
+MAX_AGE = 7 * 86400  # seconds; imagery for a closed time range never changes, open ones pick up new scenes
+TILE_SIZE = 256  # pixels per tile side
+RESOLUTION = 0.0001  # degrees per pixel (~11 m at the equator, Sentinel-2's 10 m bands)
+EXTENSIONS = {"image/tiff": ".tif", "image/png": ".png", "image/jpeg": ".jpg", "application/json": ".json",
+              "application/x-tar": ".tar"}
+
+
+def _round_coordinates(value):
+    if isinstance(value, float):
+        return round(value, 9)
+    if isinstance(value, (list, tuple)):
+        return [_round_coordinates(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _round_coordinates(item) for key, item in value.items()}
+    return value
+
+
+def normalize_evalscript(evalscript):
+    """Evalscript with trailing whitespace, blank lines and indentation removed"""
+    lines = (line.strip() for line in (evalscript or "").splitlines())
+    return "\n".join(line for line in lines if line)
+
+
+def request_key(payload):
+    """Content address of a process request: geometry, time range, evalscript and output spec"""
+    source = payload.get("input", {})
+    canonical = {
+        "bounds": _round_coordinates(source.get("bounds", {})),
+        "data": source.get("data", []),
+        "evalscript": normalize_evalscript(payload.get("evalscript")),
+        "output": payload.get("output", {}),
+    }
+    encoded = json.dumps(canonical, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def processing_units(payload):
+    """Approximate Sentinel Hub processing units of a process request (area, input bands, FLOAT32 output)"""
+    output = payload.get("output", {})
+    pixels = output.get("width", 256) * output.get("height", 256)
+    evalscript = payload.get("evalscript", "")
+    inputs = set(re.findall(r"['\"](B\d[\dA])['\"]", evalscript.split("output")[0]))
+    units = pixels / (512 * 512) * max(1.0, len(inputs) / 3)
+    if re.search(r"sampleType\s*:\s*['\"]FLOAT32['\"]", evalscript):
+        units *= 2
+    return max(0.005, units)
+
+
+def geometry_bounds(geometry):
+    """(min_lng, min_lat, max_lng, max_lat) of a polygon"""
+    from field_zonal import polygon_rings
+
+    points = np.concatenate(polygon_rings(geometry))
+    return (*points.min(axis=0).tolist(), *points.max(axis=0).tolist())
+
+
+class ImageryCache:
+    """Content-addressed response store with age and size based eviction"""
+
+    def __init__(self, root=CACHE_DIR, max_bytes=MAX_BYTES, max_age=MAX_AGE):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(root, exist_ok=True)
+        self.size = sum(entry.stat().st_size for entry in self._entries())
+
+    def path(self, key, content_type="image/tiff"):
+        return os.path.join(self.root, key[:2], key + EXTENSIONS.get(content_type, ".bin"))
+
+    def find(self, key):
+        """Path of a fresh entry for key (marked as just read), or None"""
+        directory = os.path.join(self.root, key[:2])
+        try:
+            names = [name for name in os.listdir(directory) if name.startswith(key) and not name.endswith(".tmp")]
+        except FileNotFoundError:
+            names = []
+        now = time.time()
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                written = os.stat(path).st_mtime
+                if now - written > self.max_age:
+                    self._remove(path)
+                    continue
+                os.utime(path, (now, written))
+            except FileNotFoundError:
+                continue
+            with self.lock:
+                self.hits += 1
+            return path
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def get(self, payload):
+        """Cached response bytes for a process request, or None"""
+        path = self.find(request_key(payload))
+        if path is None:
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def put(self, key, body, content_type="image/tiff"):
+        """Store a response body atomically under key; returns its path"""
+        path = self.path(key, content_type)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary, "wb") as f:
+            f.write(body)
+        replaced = os.path.getsize(path) if os.path.exists(path) else 0
+        os.replace(temporary, path)
+        with self.lock:
+            self.size += len(body) - replaced
+            over = self.size > self.max_bytes
+        if over:
+            self.evict()
+        return path
+
+    def open(self, key):
+        """geotiff.Raster of a cached uncompressed TIFF (memory-mapped), or None"""
+        path = self.find(key)
+        return geotiff.open_raster(path) if path else None
+
+    def evict(self):
+        """Drop expired entries, then the least recently read ones until the cache fits max_bytes"""
+        now = time.time()
+        entries = []
+        for entry in self._entries():
+            stat = entry.stat()
+            if now - stat.st_mtime > self.max_age:
+                self._remove(entry.path)
+            else:
+                entries.append((stat.st_atime, stat.st_size, entry.path))
+        entries.sort()
+        size = sum(entry[1] for entry in entries)
+        # Evict down to 90% so a full cache does not rescan on every write
+        target = self.max_bytes * 0.9
+        for _, length, path in entries:
+            if size <= target:
+                break
+            self._remove(path)
+            size -= length
+        with self.lock:
+            self.size = size
+
+    def clear(self):
+        for entry in list(self._entries()):
+            self._remove(entry.path)
+        with self.lock:
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "bytes": self.size}
+
+    def _entries(self):
+        for directory in os.scandir(self.root):
+            if directory.is_dir():
+                for entry in os.scandir(directory.path):
+                    if entry.is_file() and not entry.name.endswith(".tmp"):
+                        yield entry
+
+    def _remove(self, path):
+        try:
+            os.unlink(path)  # open memmaps keep their pages until closed
+        except FileNotFoundError:
+            return
+        with self.lock:
+            self.evictions += 1
+
+
+class ProcessClient:
+    """Sentinel Hub process API calls served from an ImageryCache when the same request was made before
+
+    Responses are always stored in cache, since process_path() hands out
+    paths of cached files.
+    """
+
+    def __init__(self, token_manager, base_url, cache, session=None, timeout=120, limiter=None, retries=3):
+        import requests
+
+        from insert_market_listings import AdaptiveThrottle
+
+        if cache is None:
+            raise ValueError("ProcessClient needs an ImageryCache to store responses in")
+        self.tokens = token_manager
+        self.url = f"{base_url.rstrip('/')}/api/v1/process"
+        self.cache = cache
+        self.session = session or requests.Session()
+        self.timeout = timeout
+        # limiter.acquire(payload) is called before every upstream request (e.g. a quota token bucket)
+        self.limiter = limiter
+        self.retries = retries
+        self.throttle = AdaptiveThrottle()
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.requests = 0
+        self.rejected = 0
+        self.units = 0.0
+        self.units_saved = 0.0
+
+    def process(self, payload):
+        """Response bytes of a process request"""
+        path = self.process_path(payload)
+        with open(path, "rb") as f:
+            return f.read()
+
+    def process_path(self, payload):
+        """Path of the cached response of a process request, downloading it on a miss
+
+        Concurrent misses for the same key wait for the first download instead of paying for it twice.
+        """
+        key = request_key(payload)
+        path = self.cache.find(key)
+        if path is not None:
+            with self.lock:
+                self.units_saved += processing_units(payload)
+            return path
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = threading.Event()
+        if not leader:
+            flight.wait()
+            return self.process_path(payload)
+        try:
+            body, content_type = self._post(payload)
+            return self.cache.put(key, body, content_type)
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.set()
+
+    def _post(self, payload):
+        """Response body and content type, retrying 401 once and 429/5xx with backoff"""
+        import requests
+
+        units = processing_units(payload)
+        renewed = False
+        for attempt in range(self.retries + 1):
+            if self.limiter is not None:
+                self.limiter.acquire(payload)
+            self.throttle.wait()
+            token = self.tokens.get_token()
+            response = self.session.post(self.url, json=payload, headers={"Authorization": f"Bearer {token}"},
+                                         timeout=self.timeout)
+            with self.lock:
+                self.requests += 1
+            if response.status_code == 401 and not renewed:
+                self.tokens.invalidate(token)
+                renewed = True
+                continue
+            if response.status_code == 429 or response.status_code >= 500:
+                with self.lock:
+                    self.rejected += response.status_code == 429
+                self.throttle.throttled(response.headers.get("Retry-After"))
+                if attempt < self.retries:
+                    continue
+            response.raise_for_status()
+            self.throttle.succeeded()
+            with self.lock:
+                self.units += units
+            return response.content, response.headers.get("Content-Type", "image/tiff").split(";")[0]
+        raise requests.HTTPError(f"{response.status_code} {response.reason}", response=response)
+
+
+class TiledImagery:
+    """Imagery for any bbox or polygon, assembled from cached tiles of a fixed global grid
+
+    Tile (col, row) covers lng -180 + col * size * resolution eastwards and
+    lat 90 - row * size * resolution southwards; its process request depends
+    only on the tile, evalscript and time range, so any field it touches
+    shares the cached copy.
+    """
+
+    def __init__(self, client, resolution=RESOLUTION, tile_size=TILE_SIZE, evalscript=BANDS_EVALSCRIPT,
+                 band_names=BANDS, time_range=None, collection="sentinel-2-l2a", workers=8):
+        self.client = client
+        self.resolution = resolution
+        self.tile_size = tile_size
+        self.evalscript = evalscript
+        self.band_names = band_names
+        self.time_range = time_range
+        self.collection = collection
+        self.workers = workers
+
+    def window(self, bounds):
+        """(col0, row0, col1, row1) global pixel window covering (min_lng, min_lat, max_lng, max_lat)"""
+        min_lng, min_lat, max_lng, max_lat = bounds
+        col0 = math.floor((min_lng + 180) / self.resolution)
+        col1 = max(col0 + 1, math.ceil((max_lng + 180) / self.resolution))
+        row0 = math.floor((90 - max_lat) / self.resolution)
+        row1 = max(row0 + 1, math.ceil((90 - min_lat) / self.resolution))
+        return col0, row0, col1, row1
+
+    def tiles(self, bounds):
+        """(col, row) of every tile covering bounds"""
+        col0, row0, col1, row1 = self.window(bounds)
+        size = self.tile_size
+        return [(col, row) for row in range(row0 // size, (row1 - 1) // size + 1)
+                for col in range(col0 // size, (col1 - 1) // size + 1)]
+
+    def tile_payload(self, col, row):
+        span = self.tile_size * self.resolution
+        min_lng = round(-180 + col * span, 9)
+        max_lat = round(90 - row * span, 9)
+        data_filter = {}
+        if self.time_range:
+            start, end = self.time_range
+            data_filter["timeRange"] = {"from": f"{start}T00:00:00Z", "to": f"{end}T23:59:59Z"}
+        return {
+            "input": {"bounds": {"bbox": [min_lng, round(max_lat - span, 9), round(min_lng + span, 9), max_lat]},
+                      "data": [{"type": self.collection, "dataFilter": data_filter}]},
+            "evalscript": self.evalscript,
+            "output": {"width": self.tile_size, "height": self.tile_size,
+                       "responses": [{"identifier": "default", "format": {"type": "image/tiff"}}]},
+        }
+
+    def tile(self, col, row):
+        """Memory-mapped geotiff.Raster of one tile, downloaded on a cache miss"""
+        return geotiff.open_raster(self.client.process_path(self.tile_payload(col, row)), self.band_names)
+
+    def read(self, geometry):
+        """geotiff.Raster of the pixels covering a polygon (anything field_zonal.polygon_rings accepts)"""
+        return self.read_bounds(geometry_bounds(geometry))
+
+    def read_bounds(self, bounds):
+        """geotiff.Raster of the pixels covering (min_lng, min_lat, max_lng, max_lat)"""
+        col0, row0, col1, row1 = self.window(bounds)
+        keys = self.tiles(bounds)
+        if self.workers > 1 and len(keys) > 1:
+            from concurrent.futures import ThreadPoolExecutor
+
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(keys))) as executor:
+                rasters = list(executor.map(lambda key: self.tile(*key), keys))
+        else:
+            rasters = [self.tile(*key) for key in keys]
+
+        size = self.tile_size
+        first = rasters[0]
+        if len(rasters) == 1 and (col0, row0, col1, row1) == (keys[0][0] * size, keys[0][1] * size,
+                                                              keys[0][0] * size + size, keys[0][1] * size + size):
+            mosaic = first.data
+        else:
+            mosaic = np.empty((row1 - row0, col1 - col0, first.count), dtype=first.data.dtype)
+            for (col, row), raster in zip(keys, rasters):
+                # Overlap of this tile with the window, in global pixel coordinates
+                top, bottom = max(row0, row * size), min(row1, row * size + size)
+                left, right = max(col0, col * size), min(col1, col * size + size)
+                pixels = raster.data if not raster.planar else np.moveaxis(raster.data, 0, -1)
+                mosaic[top - row0:bottom - row0, left - col0:right - col0] = \
+                    pixels[top - row * size:bottom - row * size, left - col * size:right - col * size]
+        transform = (-180 + col0 * self.resolution, self.resolution, 90 - row0 * self.resolution, -self.resolution)
+        return geotiff.Raster(mosaic, transform, self.band_names)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="https://services.sentinel-hub.com", help="Sentinel Hub base URL")
+    parser.add_argument("--stub", action="store_true", help="use an in-process stub server")
+    parser.add_argument("--stub-latency", type=float, default=0.1, help="seconds the stub adds to every request")
+    parser.add_argument("--cache-dir", help="cache directory (default: a fresh temporary one)")
+    parser.add_argument("--fields", type=int, default=200, help="fields clustered around SAMPLE_FIELD_POLYGON")
+    parser.add_argument("--spread", type=float, default=0.02, help="degrees the fields are scattered over")
+    parser.add_argument("--max-mb", type=float, default=512)
+    args = parser.parse_args()
+
+    from backend_test import SAMPLE_FIELD_POLYGON
+    from backend_test_new import SENTINEL_CLIENT_ID, SENTINEL_CLIENT_SECRET, SENTINEL_TOKEN_PATH
+    from sentinel_auth import SentinelTokenManager
+
+    base_url = args.url
+    if args.stub:
+        from stub_server import start_stub_server
+        server, base_url = start_stub_server(latency=args.stub_latency)
+    tokens = SentinelTokenManager(SENTINEL_CLIENT_ID, SENTINEL_CLIENT_SECRET, f"{base_url}{SENTINEL_TOKEN_PATH}",
+                                  cache_dir=None)
+    cache = ImageryCache(args.cache_dir or tempfile.mkdtemp(prefix="imagery_cache_"),
+                         max_bytes=int(args.max_mb * (1 << 20)))
+    client = ProcessClient(tokens, base_url, cache=cache)
+    tiles = TiledImagery(client, time_range=("2024-05-01", "2024-05-31"))
+
+    rng = np.random.default_rng(11)
+    fields = []
+    for _ in range(args.fields):
+        shift_lat, shift_lng = rng.uniform(-args.spread / 2, args.spread / 2, 2)
+        scale = rng.uniform(5, 40)  # the sample polygon is ~20 m across; real fields are larger
+        centre_lat = SAMPLE_FIELD_POLYGON[0]["lat"]
+        centre_lng = SAMPLE_FIELD_POLYGON[0]["lng"]
+        fields.append([{"lat": centre_lat + (p["lat"] - centre_lat) * scale + shift_lat,
+                        "lng": centre_lng + (p["lng"] - centre_lng) * scale + shift_lng}
+                       for p in SAMPLE_FIELD_POLYGON])
+
+    # Per-field requests, as test_sentinel_hub_api() makes them: one download each, every run
+    per_field_units = 0.0
+    for polygon in fields:
+        col0, row0, col1, row1 = tiles.window(geometry_bounds(polygon))
+        per_field_units += processing_units({"evalscript": BANDS_EVALSCRIPT,
+                                             "output": {"width": col1 - col0, "height": row1 - row0}})
+
+    for label in ("cold cache", "warm cache"):
+        requests_before, units_before = client.requests, client.units
+        started = time.perf_counter()
+        pixels = sum(int(np.prod(tiles.read(polygon).shape)) for polygon in fields)
+        elapsed = time.perf_counter() - started
+        print(f"{label}: {len(fields)} fields ({pixels} pixels) in {elapsed:.2f}s, "
+              f"{client.requests - requests_before} tile requests, "
+              f"~{client.units - units_before:.2f} processing units")
+    print(f"  one request per field would cost ~{per_field_units:.2f} processing units on every run")
+    print(f"  cache: {cache.stats()}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+"""
+Sustained load generator for the CropGenius Supabase edge functions.
+
+Replays a weighted mix of weather, field-analysis, fn-crop-disease,
+market-analysis and selling-opportunities calls with farm locations drawn
+around the AFRICAN_COORDINATES regions, either:
+  - open loop: requests start at a fixed target rate (--rps), and latency is
+    measured from each request's scheduled start so a slow server cannot
+    hide queueing delay (coordinated omission), or
+  - closed loop: --users virtual users each send a request, wait for the
+    answer and an optional think time, and repeat.
+
+Latencies go into HDR-style log-linear histograms (fixed number of counters,
+~1% precision), so memory stays constant however long the run is. Every
+--interval seconds a line with throughput, error rate and p50/p95/p99 is
+printed; the run ends with a per-endpoint summary.
+
+    python load_test.py --stub --rps 200 --duration 30
+    python load_test.py --users 50 --duration 300 --mix weather=5,market-analysis=3
+"""
+
+import argparse
+import csv
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from backend_test import AFRICAN_COORDINATES, SUPABASE_URL
+from insert_market_listings import SUPABASE_ANON_KEY, create_session
+
+DEFAULT_MIX = {
+    "weather": 40,
+    "market-analysis": 25,
+    "selling-opportunities": 15,
+    "fn-crop-disease": 10,
+    "field-analysis": 10,
+}
+# field-analysis answers 404 "Field not found" for the synthetic field ids
+EXPECTED_STATUS = {"field-analysis": (200, 404)}
+REGION_SPREAD = 0.75  # degrees (standard deviation) around each region centre
+CROPS = ("maize", "beans", "tomato", "cassava", "rice", "sorghum")
+SAMPLE_IMAGE_BASE64 = "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg=="
+REQUEST_TIMEOUT = 30
+
+SUB_BUCKET_BITS = 7  # 128 linear sub-buckets per power of two: <0.8% relative error
+MAX_EXPONENT = 26  # values up to ~2^33 us (2.4 hours)
+
+
+class LatencyHistogram:
+    """Log-linear histogram of microsecond values with a fixed number of counters"""
+
+    SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+    SIZE = SUB_BUCKETS * (MAX_EXPONENT + 2)
+
+    def __init__(self):
+        self.counts = [0] * self.SIZE
+        self.count = 0
+        self.total = 0
+        self.minimum = None
+        self.maximum = 0
+
+    @classmethod
+    def index(cls, value):
+        if value < cls.SUB_BUCKETS:
+            return value
+        exponent = min(value.bit_length() - SUB_BUCKET_BITS - 1, MAX_EXPONENT)
+        sub_bucket = min(value >> exponent, 2 * cls.SUB_BUCKETS - 1)
+        return cls.SUB_BUCKETS * (exponent + 1) + sub_bucket - cls.SUB_BUCKETS
+
+    @classmethod
+    def value_at(cls, index):
+        """Midpoint of the values that map to a counter"""
+        if index < cls.SUB_BUCKETS:
+            return index
+        exponent = index // cls.SUB_BUCKETS - 1
+        sub_bucket = index % cls.SUB_BUCKETS + cls.SUB_BUCKETS
+        return (sub_bucket << exponent) + (1 << exponent) // 2
+
+    def record(self, seconds):
+        value = max(0, int(seconds * 1e6))
+        self.counts[self.index(value)] += 1
+        self.count += 1
+        self.total += value
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = max(self.maximum, value)
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        if other.minimum is not None:
+            self.minimum = other.minimum if self.minimum is None else min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+
+    def percentile(self, p):
+        """Value at percentile p in milliseconds"""
+        if not self.count:
+            return None
+        rank = max(1, int(p / 100 * self.count + 0.5))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.value_at(index), self.maximum) / 1000
+        return self.maximum / 1000
+
+    @property
+    def mean(self):
+        return self.total / self.count / 1000 if self.count else None
+
+
+class LoadStats:
+    """Interval and whole-run counters shared by the request threads"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.interval = LatencyHistogram()
+        self.interval_requests = 0
+        self.interval_errors = 0
+        self.endpoints = {}
+        self.errors = {}
+        self.total = LatencyHistogram()
+        self.requests = 0
+        self.dropped = 0
+        self.timeline = []
+
+    def record(self, endpoint, seconds, error=None):
+        with self.lock:
+            self.interval.record(seconds)
+            self.interval_requests += 1
+            self.requests += 1
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = [LatencyHistogram(), 0]
+            stats[0].record(seconds)
+            if error:
+                self.interval_errors += 1
+                stats[1] += 1
+                self.errors[error] = self.errors.get(error, 0) + 1
+
+    def rotate(self, elapsed, interval):
+        """Close the current interval, append it to the timeline and return it"""
+        with self.lock:
+            histogram, self.interval = self.interval, LatencyHistogram()
+            requests_done, errors = self.interval_requests, self.interval_errors
+            self.interval_requests = self.interval_errors = 0
+        self.total.merge(histogram)
+        point = {
+            "elapsed": round(elapsed, 1),
+            "requests": requests_done,
+            "rps": requests_done / interval,
+            "error_rate": errors / requests_done if requests_done else 0.0,
+            "p50_ms": histogram.percentile(50),
+            "p95_ms": histogram.percentile(95),
+            "p99_ms": histogram.percentile(99),
+            "max_ms": histogram.maximum / 1000 if histogram.count else None,
+        }
+        self.timeline.append(point)
+        return point
+
+
+def _ms(value):
+    return "     -" if value is None else f"{value:6.1f}"
+
+
+def random_location(rng):
+    """A farm location near one of the AFRICAN_COORDINATES regions"""
+    centre = AFRICAN_COORDINATES[rng.choice(sorted(AFRICAN_COORDINATES))]
+    lat = max(-90.0, min(90.0, rng.gauss(centre["lat"], REGION_SPREAD)))
+    lng = (rng.gauss(centre["lng"], REGION_SPREAD) + 180) % 360 - 180
+    return round(lat, 6), round(lng, 6)
+
+
+def build_request(name, rng, base_url):
+    """(method, url, request kwargs) of one call to an edge function"""
+    lat, lng = random_location(rng)
+    url = f"{base_url}/functions/v1/{name}"
+    if name == "weather":
+        return "GET", f"{url}?lat={lat}&lon={lng}", {}
+    if name == "market-analysis":
+        return "GET", f"{url}/{rng.choice(CROPS)}?lat={lat}&lng={lng}", {}
+    if name == "selling-opportunities":
+        crops = rng.sample(CROPS, rng.randint(1, 3))
+        return "POST", url, {"json": {"farmer_location": {"lat": lat, "lng": lng}, "farmer_crops": crops}}
+    if name == "fn-crop-disease":
+        return "POST", url, {"json": {"imageBase64": SAMPLE_IMAGE_BASE64, "cropType": rng.choice(CROPS),
+                                      "location": {"latitude": lat, "longitude": lng}}}
+    if name == "field-analysis":
+        return "POST", url, {"json": {"fieldId": f"load-test-field-{rng.randrange(10000)}"}}
+    raise ValueError(f"unknown edge function: {name}")
+
+
+def parse_mix(text):
+    """Parse 'weather=5,market-analysis=3' into {name: weight}"""
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in DEFAULT_MIX:
+            raise ValueError(f"unknown edge function in mix: {name}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+class LoadGenerator:
+    """Issues the request mix from worker threads, each with its own keep-alive session"""
+
+    def __init__(self, base_url=SUPABASE_URL, api_key=SUPABASE_ANON_KEY, mix=None, seed=None):
+        self.base_url = base_url
+        self.api_key = api_key
+        mix = mix or DEFAULT_MIX
+        self.names = list(mix)
+        self.weights = [mix[name] for name in self.names]
+        self.seed = seed
+        self.stats = LoadStats()
+        self._local = threading.local()
+        self._seeds = random.Random(seed)
+        self._seed_lock = threading.Lock()
+
+    def _thread_state(self):
+        state = getattr(self._local, "state", None)
+        if state is None:
+            with self._seed_lock:
+                rng = random.Random(self._seeds.random())
+            state = self._local.state = (create_session(self.api_key, pool_size=1), rng)
+        return state
+
+    def issue(self, scheduled=None):
+        """Send one request; latency counts from `scheduled` (perf_counter) when given"""
+        session, rng = self._thread_state()
+        name = rng.choices(self.names, self.weights)[0]
+        method, url, kwargs = build_request(name, rng, self.base_url)
+        started = time.perf_counter() if scheduled is None else scheduled
+        error = None
+        try:
+            response = session.request(method, url, timeout=REQUEST_TIMEOUT, **kwargs)
+            response.content
+            if response.status_code not in EXPECTED_STATUS.get(name, (200,)):
+                error = f"{name}: HTTP {response.status_code}"
+        except requests.RequestException as e:
+            error = f"{name}: {type(e).__name__}"
+        self.stats.record(name, time.perf_counter() - started, error)
+
+    def run_open_loop(self, rps, duration, max_in_flight=256, stop=None):
+        """Start requests at a fixed rate; requests that cannot start within the backlog are dropped"""
+        backlog = threading.BoundedSemaphore(max_in_flight * 4)
+        period = 1.0 / rps
+        started = time.perf_counter()
+
+        def task(scheduled):
+            try:
+                self.issue(scheduled)
+            finally:
+                backlog.release()
+
+        with ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="load") as executor:
+            sent = 0
+            while not (stop and stop.is_set()):
+                scheduled = started + sent * period
+                if scheduled - started >= duration:
+                    break
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                if backlog.acquire(blocking=False):
+                    executor.submit(task, scheduled)
+                else:
+                    with self.stats.lock:
+                        self.stats.dropped += 1
+                sent += 1
+
+    def run_closed_loop(self, users, duration, think_time=0.0, stop=None):
+        """Run `users` virtual users back to back for `duration` seconds"""
+        end = time.perf_counter() + duration
+
+        def user():
+            while time.perf_counter() < end and not (stop and stop.is_set()):
+                self.issue()
+                if think_time:
+                    time.sleep(think_time)
+
+        threads = [threading.Thread(target=user, daemon=True) for _ in range(users)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+
+def _report_intervals(stats, interval, done, writer=None):
+    started = time.perf_counter()
+    last = started
+    print(f"{'time':>6} {'req/s':>8} {'errors':>7} {'p50 ms':>7} {'p95 ms':>7} {'p99 ms':>7} {'max ms':>7}")
+    while True:
+        finished = done.wait(max(0.0, last + interval - time.perf_counter()))
+        now = time.perf_counter()
+        point = stats.rotate(now - started, now - last)
+        if finished and now - last < interval / 10:
+            # A sliver left over at the end: its requests are in the totals, but its rate is noise
+            stats.timeline.pop()
+            return
+        last = now
+        print(f"{point['elapsed']:>5.0f}s {point['rps']:>8.1f} {point['error_rate']:>6.1%} {_ms(point['p50_ms'])}  "
+              f"{_ms(point['p95_ms'])}  {_ms(point['p99_ms'])}  {_ms(point['max_ms'])}")
+        if writer:
+            writer.writerow(point)
+        if finished:
+            return
+
+
+def run_load(generator, rps=None, users=None, duration=60, interval=5.0, think_time=0.0, max_in_flight=256,
+             csv_path=None):
+    """Run an open-loop (rps) or closed-loop (users) test and print interval and summary reports"""
+    done = threading.Event()
+    csv_file = open(csv_path, "w", newline="") if csv_path else None
+    writer = None
+    if csv_file:
+        writer = csv.DictWriter(csv_file, ["elapsed", "requests", "rps", "error_rate", "p50_ms", "p95_ms",
+                                           "p99_ms", "max_ms"])
+        writer.writeheader()
+    reporter = threading.Thread(target=_report_intervals, args=(generator.stats, interval, done, writer))
+    reporter.start()
+    started = time.perf_counter()
+    try:
+        if rps:
+            generator.run_open_loop(rps, duration, max_in_flight)
+        else:
+            generator.run_closed_loop(users, duration, think_time)
+    finally:
+        done.set()
+        reporter.join()
+        if csv_file:
+            csv_file.close()
+    elapsed = time.perf_counter() - started
+
+    stats = generator.stats
+    total = stats.total
+    errors = sum(stats.errors.values())
+    print(f"\n{stats.requests} requests in {elapsed:.1f}s: {stats.requests / elapsed:.1f} req/s, "
+          f"{errors / max(1, stats.requests):.2%} errors, {stats.dropped} dropped (client saturated)")
+    print(f"Latency ms: mean {_ms(total.mean)}  p50 {_ms(total.percentile(50))}  p95 {_ms(total.percentile(95))}  "
+          f"p99 {_ms(total.percentile(99))}  p99.9 {_ms(total.percentile(99.9))}  max {_ms(total.maximum / 1000)}")
+    print(f"\n{'endpoint':<24} {'requests':>8} {'errors':>7} {'p50 ms':>7} {'p95 ms':>7} {'p99 ms':>7}")
+    for name, (histogram, endpoint_errors) in sorted(stats.endpoints.items()):
+        print(f"{name:<24} {histogram.count:>8} {endpoint_errors / histogram.count:>6.1%} "
+              f"{_ms(histogram.percentile(50))}  {_ms(histogram.percentile(95))}  {_ms(histogram.percentile(99))}")
+    for error, count in sorted(stats.errors.items(), key=lambda item: -item[1])[:10]:
+        print(f"  {count:>6} x {error}")
+    return stats
+
+
+def main():
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default=SUPABASE_URL, help="Supabase (or stub server) base URL")
+    parser.add_argument("--stub", action="store_true", help="run against an in-process stub server")
+    parser.add_argument("--stub-latency", type=float, default=0.0, help="seconds the stub adds to every request")
+    load = parser.add_mutually_exclusive_group()
+    load.add_argument("--rps", type=float, help="open-loop target request rate")
+    load.add_argument("--users", type=int, help="closed-loop virtual users")
+    parser.add_argument("--think-time", type=float, default=0.0, help="seconds each closed-loop user waits")
+    parser.add_argument("--duration", type=float, default=60.0, help="seconds to run")
+    parser.add_argument("--interval", type=float, default=5.0, help="seconds between progress lines")
+    parser.add_argument("--mix", help="request weights, e.g. weather=5,market-analysis=3 (default: built-in mix)")
+    parser.add_argument("--max-in-flight", type=int, default=256, help="open-loop concurrent requests")
+    parser.add_argument("--seed", type=int, help="seed for reproducible request sequences")
+    parser.add_argument("--csv", help="write the per-interval timeline to this CSV file")
+    args = parser.parse_args()
+
+    base_url = args.url
+    if args.stub:
+        from market_schema import seed_listings
+        from stub_server import start_stub_server
+        server, base_url = start_stub_server(latency=args.stub_latency)
+        server.state.insert("market_listings", [listing.to_dict() for listing in seed_listings()])
+        print(f"Stub server on {base_url}")
+
+    try:
+        mix = parse_mix(args.mix) if args.mix else None
+    except ValueError as e:
+        print(f"Error: {str(e)}")
+        return 2
+    generator = LoadGenerator(base_url, mix=mix, seed=args.seed)
+    mode = f"open loop at {args.rps:g} req/s" if args.rps else f"closed loop with {args.users or 10} users"
+    print(f"Load test against {base_url}: {mode} for {args.duration:g}s")
+    stats = run_load(generator, args.rps, args.users or 10, args.duration, args.interval, args.think_time,
+                     args.max_in_flight, args.csv)
+    return 1 if sum(stats.errors.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
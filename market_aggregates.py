@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+"""
+Incremental price aggregates per crop x region cell x day for market_listings.
+
+Every active listing contributes to exactly one bucket keyed by its crop
+(case-folded), the geohash cell of its location (REGION_PRECISION characters)
+and the UTC day of its harvest_date. A bucket holds count, sum, min/max,
+volume and price * volume sums plus a log-binned sketch of the prices, so
+mean, volume-weighted price and an approximate median (relative error
+SKETCH_ACCURACY) come out of a handful of buckets instead of every listing.
+
+Buckets are maintained incrementally: add/remove/update apply single-row
+deltas, and observe() plugs into insert_market_listings.ingest() so inserts
+and upserted updates flow straight from the ingestion stream. Bulk loads of
+existing listings go through a vectorized NumPy path.
+
+Min and max are exact while a bucket only grows; when a delete removes a
+bucket's current extreme they fall back to the sketch (same relative error).
+
+    aggregates = PriceAggregates()
+    index = MarketIndex.from_rows(listings)
+    ingest(rows, upsert=True, observers=[aggregates.observe, index.observe])
+    aggregates.stats("maize", lat=-1.286389, lng=36.817223, start="2025-06-01")
+"""
+
+import argparse
+import math
+import time
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+from insert_market_listings import SUPABASE_URL
+from market_columnar import MarketSnapshot
+from market_feed_loader import peak_rss_mb
+from market_spatial import BITS, cell, cell_geohash, encode_many
+
+REGION_PRECISION = 4  # geohash characters; a ~39 x 20 km cell
+SKETCH_ACCURACY = 0.01  # relative error of the approximate median
+DAY_COLUMNS = ("harvest_date", "created_at")  # first non-null one dates a listing
+EPOCH = date(1970, 1, 1)
+DAY_BITS = 20
+BIN_OFFSET = 1 << 20
+BIN_BITS = 22
+ZERO_BIN = -BIN_OFFSET
+
+
+def _crop_key(crop):
+    return (crop or "").strip().casefold()
+
+
+def _day(value):
+    """Days since 1970-01-01 of a date, datetime or ISO-8601 string"""
+    if value is None:
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, datetime):
+        value = value.date()
+    elif not isinstance(value, date):
+        value = date.fromisoformat(str(value)[:10])
+    return (value - EPOCH).days
+
+
+def _number(value):
+    return None if value is None else float(value)
+
+
+class Bucket:
+    """Running price statistics of one crop x cell x day"""
+
+    __slots__ = ("count", "total", "minimum", "maximum", "volume", "weighted", "bins")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.volume = 0.0
+        self.weighted = 0.0
+        self.bins = {}
+
+    def add(self, price, quantity, price_bin):
+        self.count += 1
+        self.total += price
+        self.minimum = price if self.minimum is None else min(self.minimum, price)
+        self.maximum = price if self.maximum is None else max(self.maximum, price)
+        if quantity:
+            self.volume += quantity
+            self.weighted += price * quantity
+        self.bins[price_bin] = self.bins.get(price_bin, 0) + 1
+
+    def remove(self, price, quantity, price_bin, sketch):
+        remaining = self.bins.get(price_bin, 0) - 1
+        if remaining < 0:
+            return False
+        if remaining:
+            self.bins[price_bin] = remaining
+        else:
+            del self.bins[price_bin]
+        self.count -= 1
+        self.total -= price
+        if quantity:
+            self.volume -= quantity
+            self.weighted -= price * quantity
+        if not self.count:
+            self.total = self.volume = self.weighted = 0.0
+            self.minimum = self.maximum = None
+        elif price <= self.minimum or price >= self.maximum:
+            if price <= self.minimum:
+                self.minimum = sketch.value(min(self.bins))
+            if price >= self.maximum:
+                self.maximum = sketch.value(max(self.bins))
+        return True
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        if other.minimum is not None:
+            self.minimum = other.minimum if self.minimum is None else min(self.minimum, other.minimum)
+            self.maximum = other.maximum if self.maximum is None else max(self.maximum, other.maximum)
+        self.volume += other.volume
+        self.weighted += other.weighted
+        for price_bin, count in other.bins.items():
+            self.bins[price_bin] = self.bins.get(price_bin, 0) + count
+
+
+class LogSketch:
+    """Log-spaced price bins: any price maps to a bin whose value is within accuracy of it"""
+
+    def __init__(self, accuracy=SKETCH_ACCURACY):
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+
+    def bin(self, price):
+        return math.ceil(math.log(price) / self.log_gamma) if price > 0 else ZERO_BIN
+
+    def bins(self, prices):
+        """Vectorized bin() over a NumPy array"""
+        with np.errstate(divide="ignore", invalid="ignore"):
+            bins = np.ceil(np.log(prices) / self.log_gamma)
+        return np.where(prices > 0, bins, ZERO_BIN).astype(np.int64)
+
+    def value(self, price_bin):
+        return 0.0 if price_bin == ZERO_BIN else 2 * self.gamma ** price_bin / (self.gamma + 1)
+
+    def quantile(self, bins, q, count):
+        rank = q * (count - 1)
+        seen = 0
+        for price_bin in sorted(bins):
+            seen += bins[price_bin]
+            if seen > rank:
+                return self.value(price_bin)
+        return None
+
+
+class PriceAggregates:
+    """Materialized crop x region cell x day price buckets"""
+
+    def __init__(self, precision=REGION_PRECISION, accuracy=SKETCH_ACCURACY):
+        self.precision = precision
+        self.sketch = LogSketch(accuracy)
+        # (crop, cell) -> {day: Bucket}
+        self.cells = {}
+        self.crop_cells = {}
+        self.listings = 0
+
+    def __len__(self):
+        return sum(len(days) for days in self.cells.values())
+
+    def _key(self, listing):
+        """(crop, cell, day) of a listing, or None if it does not contribute"""
+        if listing is None or listing.get("is_active") is False:
+            return None
+        lat = listing.get("location_lat")
+        lng = listing.get("location_lng")
+        price = listing.get("price_per_unit")
+        day = next((listing.get(column) for column in DAY_COLUMNS if listing.get(column)), None)
+        if lat is None or lng is None or price is None or day is None:
+            return None
+        return _crop_key(listing.get("crop_type")), cell(float(lat), float(lng), self.precision), _day(day)
+
+    def _bucket(self, crop, cell_id, day):
+        days = self.cells.get((crop, cell_id))
+        if days is None:
+            days = self.cells[(crop, cell_id)] = {}
+            self.crop_cells.setdefault(crop, set()).add(cell_id)
+        bucket = days.get(day)
+        if bucket is None:
+            bucket = days[day] = Bucket()
+        return bucket
+
+    def add(self, listing):
+        """Add one listing (dict or MarketListing); return False if it does not contribute"""
+        key = self._key(listing)
+        if key is None:
+            return False
+        price = float(listing.get("price_per_unit"))
+        self._bucket(*key).add(price, _number(listing.get("quantity_available")), self.sketch.bin(price))
+        self.listings += 1
+        return True
+
+    def remove(self, listing):
+        """Remove a previously added listing; return False if it was not counted"""
+        key = self._key(listing)
+        if key is None:
+            return False
+        crop, cell_id, day = key
+        days = self.cells.get((crop, cell_id))
+        bucket = days.get(day) if days else None
+        price = float(listing.get("price_per_unit"))
+        if bucket is None or not bucket.remove(price, _number(listing.get("quantity_available")),
+                                               self.sketch.bin(price), self.sketch):
+            return False
+        if not bucket.count:
+            del days[day]
+            if not days:
+                del self.cells[(crop, cell_id)]
+                self.crop_cells[crop].discard(cell_id)
+        self.listings -= 1
+        return True
+
+    def update(self, old, new):
+        self.remove(old)
+        self.add(new)
+
+    def observe(self, old_rows, new_rows):
+        """Ingestion observer: apply (old, new) row deltas of a written batch"""
+        for old, new in zip(old_rows, new_rows):
+            if old is not None:
+                self.remove(old)
+            self.add(new)
+
+    def bulk_load(self, crop_names, crop_codes, lat, lng, price, quantity, day, active=None):
+        """Vectorized load of column arrays (crop codes index crop_names, day is days since epoch)"""
+        names = sorted({_crop_key(name) for name in crop_names})
+        remap = np.array([names.index(_crop_key(name)) for name in crop_names], dtype=np.int64)
+        keep = ~(np.isnan(lat) | np.isnan(lng) | np.isnan(price))
+        if active is not None:
+            keep &= active
+        rows = np.flatnonzero(keep)
+        if not len(rows):
+            return 0
+        days = np.asarray(day)[rows].astype(np.int64)
+        first_day = int(days.min())
+        if int(days.max()) - first_day >= 1 << DAY_BITS:
+            raise ValueError("day range too wide for one bulk load")
+        cell_bits = 5 * self.precision
+        cells = (encode_many(lat[rows], lng[rows]) >> np.uint64(2 * BITS - cell_bits)).astype(np.int64)
+        keys = (remap[crop_codes[rows]] << (cell_bits + DAY_BITS)) | (cells << DAY_BITS) | (days - first_day)
+
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+        prices = price[rows][order]
+        quantities = np.nan_to_num(quantity[rows][order]) if quantity is not None else np.zeros(len(rows))
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        counts = np.diff(np.r_[starts, len(keys)])
+        totals = np.add.reduceat(prices, starts)
+        minima = np.minimum.reduceat(prices, starts)
+        maxima = np.maximum.reduceat(prices, starts)
+        volumes = np.add.reduceat(quantities, starts)
+        weighted = np.add.reduceat(prices * quantities, starts)
+
+        group = np.repeat(np.arange(len(starts)), counts)
+        pairs, pair_counts = np.unique((group << BIN_BITS) | (self.sketch.bins(prices) + BIN_OFFSET),
+                                       return_counts=True)
+        pair_groups = pairs >> BIN_BITS
+        pair_bins = ((pairs & ((1 << BIN_BITS) - 1)) - BIN_OFFSET).tolist()
+        pair_counts = pair_counts.tolist()
+        bounds = np.searchsorted(pair_groups, np.arange(len(starts) + 1)).tolist()
+
+        group_keys = keys[starts]
+        crops = (group_keys >> (cell_bits + DAY_BITS)).tolist()
+        group_cells = ((group_keys >> DAY_BITS) & ((1 << cell_bits) - 1)).tolist()
+        group_days = ((group_keys & ((1 << DAY_BITS) - 1)) + first_day).tolist()
+        columns = zip(crops, group_cells, group_days, counts.tolist(), totals.tolist(), minima.tolist(),
+                      maxima.tolist(), volumes.tolist(), weighted.tolist())
+        for i, (crop, cell_id, day_value, count, total, minimum, maximum, volume, weight) in enumerate(columns):
+            loaded = Bucket()
+            loaded.count, loaded.total, loaded.minimum, loaded.maximum = count, total, minimum, maximum
+            loaded.volume, loaded.weighted = volume, weight
+            loaded.bins = dict(zip(pair_bins[bounds[i]:bounds[i + 1]], pair_counts[bounds[i]:bounds[i + 1]]))
+            bucket = self._bucket(names[crop], cell_id, day_value)
+            if bucket.count:
+                bucket.merge(loaded)
+            else:
+                self.cells[(names[crop], cell_id)][day_value] = loaded
+        self.listings += len(rows)
+        return len(rows)
+
+    @classmethod
+    def from_snapshot(cls, snapshot, precision=REGION_PRECISION, accuracy=SKETCH_ACCURACY):
+        aggregates = cls(precision, accuracy)
+        c = snapshot.columns
+        # Same rule as _key(): the first of DAY_COLUMNS that is set dates a listing
+        dates = np.full(len(snapshot), np.datetime64("NaT"), dtype="datetime64[s]")
+        for column in DAY_COLUMNS:
+            if column in c:
+                dates = np.where(np.isnat(dates), c[column], dates)
+        dated = ~np.isnat(dates)
+        days = np.where(dated, dates.astype("datetime64[D]").astype(np.int64), 0)
+        aggregates.bulk_load(snapshot.dictionaries["crop_type"], c["crop_type"].astype(np.int64),
+                             c["location_lat"], c["location_lng"], c["price_per_unit"],
+                             c["quantity_available"], days, c["is_active"] & dated)
+        return aggregates
+
+    def _buckets(self, crop, lat=None, lng=None, region=None, start=None, end=None):
+        crop = _crop_key(crop)
+        if region is not None:
+            cells = [region]
+        elif lat is not None and lng is not None:
+            cells = [cell(lat, lng, self.precision)]
+        else:
+            cells = self.crop_cells.get(crop, ())
+        first = _day(start)
+        last = _day(end)
+        for cell_id in cells:
+            for day_value, bucket in self.cells.get((crop, cell_id), {}).items():
+                if (first is None or day_value >= first) and (last is None or day_value <= last):
+                    yield day_value, bucket
+
+    def _describe(self, bucket):
+        if not bucket.count:
+            return {"count": 0}
+        return {
+            "count": bucket.count,
+            "mean": bucket.total / bucket.count,
+            "min": bucket.minimum,
+            "max": bucket.maximum,
+            "median": self.sketch.quantile(bucket.bins, 0.5, bucket.count),
+            "vwap": bucket.weighted / bucket.volume if bucket.volume else None,
+            "volume": bucket.volume,
+        }
+
+    def stats(self, crop, lat=None, lng=None, region=None, start=None, end=None):
+        """Merged statistics for a crop over one cell (lat/lng or region id) or all cells, start..end inclusive"""
+        merged = Bucket()
+        for _, bucket in self._buckets(crop, lat, lng, region, start, end):
+            merged.merge(bucket)
+        return self._describe(merged)
+
+    def daily(self, crop, lat=None, lng=None, region=None, start=None, end=None):
+        """[(ISO date, statistics)] per day, oldest first"""
+        days = {}
+        for day_value, bucket in self._buckets(crop, lat, lng, region, start, end):
+            days.setdefault(day_value, Bucket()).merge(bucket)
+        return [((EPOCH + timedelta(days=d)).isoformat(), self._describe(days[d])) for d in sorted(days)]
+
+    def regions(self, crop):
+        """Geohash strings of the cells holding a crop"""
+        return sorted(cell_geohash(cell_id, self.precision) for cell_id in self.crop_cells.get(_crop_key(crop), ()))
+
+
+def synthetic_columns(size, markets=400, days=90, seed=11):
+    """Market-clustered listings as column arrays, for benchmarks"""
+    rng = np.random.default_rng(seed)
+    crops = ["Maize", "Tomato", "Beans", "Cassava", "Yam", "Rice", "Cocoa", "Plantain",
+             "Coffee", "Matooke", "Teff", "Sorghum"]
+    site_lat = rng.uniform(-15, 15, markets)
+    site_lng = rng.uniform(-5, 45, markets)
+    site = rng.integers(0, markets, size)
+    crop_codes = rng.integers(0, len(crops), size)
+    base_price = rng.uniform(0.2, 3.0, len(crops))
+    return {
+        "crop_names": crops,
+        "crop_codes": crop_codes,
+        "lat": site_lat[site] + rng.normal(0, 0.01, size),
+        "lng": site_lng[site] + rng.normal(0, 0.01, size),
+        "price": np.round(base_price[crop_codes] * rng.lognormal(0, 0.25, size), 2),
+        "quantity": rng.integers(50, 5000, size).astype(np.float64),
+        "day": (_day(date(2025, 1, 1)) + rng.integers(0, days, size)).astype(np.int64),
+    }
+
+
+def run_benchmark(size=10_000_000, deltas=100_000, queries=200):
+    """Bulk-load, apply incremental deltas and compare bucket reads with raw recomputation"""
+    columns = synthetic_columns(size)
+    aggregates = PriceAggregates()
+    started = time.perf_counter()
+    aggregates.bulk_load(**columns)
+    load = time.perf_counter() - started
+    print(f"{size} listings -> {len(aggregates)} buckets in {load:.1f}s "
+          f"({size / load:,.0f} rows/sec), peak RSS {peak_rss_mb():.0f} MiB")
+
+    rng = np.random.default_rng(3)
+    crops = columns["crop_names"]
+    samples = rng.integers(0, size, deltas)
+    rows = [{"crop_type": crops[columns["crop_codes"][i]], "location_lat": columns["lat"][i],
+             "location_lng": columns["lng"][i], "price_per_unit": columns["price"][i],
+             "quantity_available": columns["quantity"][i],
+             "harvest_date": (EPOCH + timedelta(days=int(columns["day"][i]))).isoformat()} for i in samples.tolist()]
+    changed = [dict(row, price_per_unit=round(row["price_per_unit"] * 1.05, 2)) for row in rows]
+    started = time.perf_counter()
+    aggregates.observe([None] * len(rows), rows)
+    aggregates.observe(rows, changed)
+    incremental = time.perf_counter() - started
+    print(f"{2 * deltas} incremental deltas ({deltas} inserts, {deltas} updates): "
+          f"{2 * deltas / incremental:,.0f} deltas/sec")
+    # Undo the deltas so the raw columns are the ground truth again
+    aggregates.observe(changed, [None] * len(changed))
+
+    probes = rng.integers(0, size, queries).tolist()
+    window = (_day(date(2025, 2, 1)), _day(date(2025, 3, 2)))
+    started = time.perf_counter()
+    results = [aggregates.stats(crops[columns["crop_codes"][i]], columns["lat"][i], columns["lng"][i],
+                                start=window[0], end=window[1]) for i in probes]
+    bucket_read = (time.perf_counter() - started) / queries
+
+    cell_bits = 5 * REGION_PRECISION
+    all_cells = encode_many(columns["lat"], columns["lng"]) >> np.uint64(2 * BITS - cell_bits)
+    checked = min(queries, 10)
+    worst_median = 0.0
+    started = time.perf_counter()
+    for i, result in zip(probes[:checked], results):
+        matched = np.flatnonzero((columns["crop_codes"] == columns["crop_codes"][i]) & (all_cells == all_cells[i]) &
+                                 (columns["day"] >= window[0]) & (columns["day"] <= window[1]))
+        prices = columns["price"][matched]
+        assert len(matched) == result["count"]
+        assert abs(prices.mean() - result["mean"]) < 1e-6 * max(1.0, prices.mean())
+        median = float(np.sort(prices)[(len(prices) - 1) // 2])
+        worst_median = max(worst_median, abs(result["median"] - median) / median)
+    raw = (time.perf_counter() - started) / checked
+
+    print(f"30-day crop x cell stats: {bucket_read * 1e6:.0f} us from buckets vs {raw * 1e3:.0f} ms "
+          f"recomputed from raw listings; worst median error {worst_median:.2%}")
+
+
+def main():
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description="Price aggregates per crop, region cell and day")
+    parser.add_argument("--url", default=SUPABASE_URL, help="Supabase (or stub server) base URL")
+    parser.add_argument("--snapshot", help="load listings from this .npz snapshot instead of the REST API")
+    parser.add_argument("--crop", default="maize")
+    parser.add_argument("--lat", type=float, help="restrict to the region cell of this point")
+    parser.add_argument("--lng", type=float)
+    parser.add_argument("--days", type=int, default=30, help="trailing window in days")
+    parser.add_argument("--benchmark", action="store_true", help="time a synthetic load and queries")
+    parser.add_argument("--rows", type=int, default=10_000_000, help="synthetic listings in benchmark mode")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        run_benchmark(args.rows)
+        return
+
+    snapshot = MarketSnapshot.load(args.snapshot) if args.snapshot else MarketSnapshot.from_rest(args.url)
+    aggregates = PriceAggregates.from_snapshot(snapshot)
+    end = date.today()
+    start = end - timedelta(days=args.days)
+    print(f"{aggregates.listings} listings in {len(aggregates)} buckets; "
+          f"{args.crop} regions: {', '.join(aggregates.regions(args.crop)) or 'none'}")
+    stats = aggregates.stats(args.crop, args.lat, args.lng, start=start, end=end)
+    print(f"{args.crop} {start}..{end}: {stats}")
+    for day_value, day_stats in aggregates.daily(args.crop, args.lat, args.lng, start=start, end=end):
+        print(f"  {day_value}: {day_stats['count']} listings, median {day_stats['median']:.2f}, "
+              f"vwap {day_stats['vwap'] or 0:.2f}")
+
+
+if __name__ == "__main__":
+    main()
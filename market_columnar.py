@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+Columnar in-memory snapshot of public.market_listings.
+
+Listings are held as one NumPy array per column, with crop_type, source and
+location_name dictionary-encoded to small integer codes. Any combination of
+bounding box, price range, minimum quality and crop/source filters is
+answered with vectorized boolean masks instead of one REST query per filter.
+Rows are kept sorted by (crop_type, location_lat), so crop and latitude
+filters reduce to binary-searched windows before any mask is evaluated.
+
+    snapshot = MarketSnapshot.from_rest()
+    hits = snapshot.filter(bbox=(-2, 0, 36, 38), price=(0.5, 2.0), min_quality=4, crops=["maize"])
+    snapshot.rows(hits)
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+import requests
+
+from insert_market_listings import SUPABASE_ANON_KEY, SUPABASE_URL, TABLE_PATH
+
+SNAPSHOT_COLUMNS = ("id", "crop_type", "variety", "price_per_unit", "unit", "quantity_available", "location_name",
+                    "location_lat", "location_lng", "source", "quality_rating", "harvest_date", "created_at", "is_active")
+PAGE_SIZE = 1000
+NO_RATING = 0
+
+
+def _encode(values):
+    """Dictionary-encode strings into (codes, dictionary)"""
+    dictionary = {}
+    codes = np.fromiter((dictionary.setdefault(value, len(dictionary)) for value in values), dtype=np.int32)
+    return codes, list(dictionary)
+
+
+class MarketSnapshot:
+    """Column arrays for a set of market listings"""
+
+    def __init__(self, columns, dictionaries):
+        order = np.lexsort((columns["location_lat"], columns["crop_type"]))
+        self.columns = {name: values[order] for name, values in columns.items()}
+        self.dictionaries = dictionaries
+        self.size = len(order)
+        # crop_offsets[code]:crop_offsets[code + 1] is the slice holding that crop
+        self.crop_offsets = np.searchsorted(self.columns["crop_type"],
+                                            np.arange(len(dictionaries["crop_type"]) + 1), side="left")
+        self._lookup = {}
+
+    def __len__(self):
+        return self.size
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Build a snapshot from dicts or MarketListing rows"""
+        rows = [row if isinstance(row, dict) else row.to_dict() for row in rows]
+        columns = {}
+        dictionaries = {}
+        for name in ("crop_type", "source", "location_name", "variety", "unit"):
+            columns[name], dictionaries[name] = _encode(row.get(name) for row in rows)
+        for name in ("price_per_unit", "quantity_available", "location_lat", "location_lng"):
+            columns[name] = np.array([np.nan if row.get(name) is None else float(row[name]) for row in rows],
+                                     dtype=np.float64)
+        columns["quality_rating"] = np.array([row.get("quality_rating") or NO_RATING for row in rows], dtype=np.int8)
+        columns["is_active"] = np.array([row.get("is_active", True) is not False for row in rows], dtype=bool)
+        for name in ("harvest_date", "created_at"):
+            columns[name] = np.array(
+                [np.datetime64(str(row[name])[:19]) if row.get(name) else np.datetime64("NaT") for row in rows],
+                dtype="datetime64[s]")
+        columns["id"] = np.array([row.get("id") for row in rows], dtype=object)
+        return cls(columns, dictionaries)
+
+    @classmethod
+    def from_rest(cls, base_url=SUPABASE_URL, api_key=SUPABASE_ANON_KEY, page_size=PAGE_SIZE, active_only=True):
+        """Download market_listings page by page and build a snapshot
+
+        Pages are ordered by id; PostgREST gives no stable order otherwise,
+        so limit/offset pages could skip or repeat listings.
+        """
+        session = requests.Session()
+        session.headers.update({"apikey": api_key, "Authorization": f"Bearer {api_key}"})
+        url = f"{base_url}{TABLE_PATH}?select={','.join(SNAPSHOT_COLUMNS)}&order=id"
+        if active_only:
+            url += "&is_active=eq.true"
+        rows = []
+        while True:
+            response = session.get(f"{url}&limit={page_size}&offset={len(rows)}", timeout=60)
+            response.raise_for_status()
+            page = response.json()
+            rows.extend(page)
+            if len(page) < page_size:
+                break
+        return cls.from_rows(rows)
+
+    @classmethod
+    def synthetic(cls, size, seed=0):
+        """Random snapshot with realistic value ranges, for benchmarks"""
+        rng = np.random.default_rng(seed)
+        crops = ["Maize", "Tomato", "Beans", "Cassava", "Yam", "Rice", "Cocoa", "Plantain",
+                 "Coffee", "Matooke", "Teff", "Sorghum"]
+        sources = ["user_input", "api_integration", "web_scraped", "partner_feed"]
+        columns = {
+            "crop_type": rng.integers(0, len(crops), size, dtype=np.int32),
+            "source": rng.integers(0, len(sources), size, dtype=np.int32),
+            "location_name": np.zeros(size, dtype=np.int32),
+            "variety": np.zeros(size, dtype=np.int32),
+            "unit": np.zeros(size, dtype=np.int32),
+            "price_per_unit": np.round(rng.uniform(0.1, 4.0, size), 2),
+            "quantity_available": rng.integers(50, 5000, size).astype(np.float64),
+            "location_lat": rng.uniform(-15, 15, size),
+            "location_lng": rng.uniform(-5, 45, size),
+            "quality_rating": rng.integers(1, 6, size, dtype=np.int8),
+            "is_active": rng.random(size) < 0.95,
+            "harvest_date": np.datetime64("2025-01-01", "s") + rng.integers(0, 365 * 86400, size).astype("timedelta64[s]"),
+            "created_at": np.datetime64("2025-01-01", "s") + rng.integers(0, 400 * 86400, size).astype("timedelta64[s]"),
+            "id": np.full(size, None, dtype=object),
+        }
+        dictionaries = {"crop_type": crops, "source": sources, "location_name": [None], "variety": [None],
+                        "unit": ["kg"]}
+        return cls(columns, dictionaries)
+
+    def codes(self, column, values):
+        """Dictionary codes for the given values (case-insensitive)"""
+        if column not in self._lookup:
+            lookup = {}
+            for code, value in enumerate(self.dictionaries[column]):
+                if value is not None:
+                    lookup.setdefault(value.casefold(), []).append(code)
+            self._lookup[column] = lookup
+        lookup = self._lookup[column]
+        return np.array([code for value in values for code in lookup.get(value.casefold(), ())], dtype=np.int32)
+
+    def mask(self, bbox=None, price=None, min_quality=None, crops=None, sources=None, active_only=True):
+        """Boolean mask of listings matching every given filter
+
+        bbox is (lat_min, lat_max, lng_min, lng_max) and price is (low, high);
+        both use strict bounds like the gt./lt. REST filters they replace.
+        """
+        c = self.columns
+        mask = c["is_active"].copy() if active_only else np.ones(self.size, dtype=bool)
+        if bbox is not None:
+            lat_min, lat_max, lng_min, lng_max = bbox
+            lat = c["location_lat"]
+            lng = c["location_lng"]
+            mask &= (lat > lat_min) & (lat < lat_max) & (lng > lng_min) & (lng < lng_max)
+        if price is not None:
+            low, high = price
+            prices = c["price_per_unit"]
+            if low is not None:
+                mask &= prices > low
+            if high is not None:
+                mask &= prices < high
+        if min_quality is not None:
+            mask &= c["quality_rating"] >= min_quality
+        if crops is not None:
+            mask &= np.isin(c["crop_type"], self.codes("crop_type", crops))
+        if sources is not None:
+            mask &= np.isin(c["source"], self.codes("source", sources))
+        return mask
+
+    def filter(self, bbox=None, price=None, min_quality=None, crops=None, sources=None, active_only=True):
+        """Indices of listings matching the filters (same semantics as mask())
+
+        Only the crop slices, narrowed to the bbox latitude band by binary
+        search, are scanned; the remaining predicates are vectorized over
+        that window.
+        """
+        c = self.columns
+        if crops is None:
+            crop_codes = range(len(self.dictionaries["crop_type"]))
+        else:
+            crop_codes = sorted(set(self.codes("crop_type", crops).tolist()))
+        lat = c["location_lat"]
+        windows = []
+        for code in crop_codes:
+            start, end = self.crop_offsets[code], self.crop_offsets[code + 1]
+            if bbox is not None:
+                segment = lat[start:end]
+                start, end = (start + np.searchsorted(segment, bbox[0], side="right"),
+                              start + np.searchsorted(segment, bbox[1], side="left"))
+            if end > start:
+                windows.append(np.arange(start, end))
+        if not windows:
+            return np.empty(0, dtype=np.int64)
+        candidates = np.concatenate(windows)
+
+        keep = c["is_active"][candidates] if active_only else np.ones(len(candidates), dtype=bool)
+        if bbox is not None:
+            lng = c["location_lng"][candidates]
+            keep &= (lng > bbox[2]) & (lng < bbox[3])
+        if price is not None:
+            prices = c["price_per_unit"][candidates]
+            if price[0] is not None:
+                keep &= prices > price[0]
+            if price[1] is not None:
+                keep &= prices < price[1]
+        if min_quality is not None:
+            keep &= c["quality_rating"][candidates] >= min_quality
+        if sources is not None:
+            keep &= np.isin(c["source"][candidates], self.codes("source", sources))
+        return candidates[keep]
+
+    def rows(self, indices, limit=None):
+        """Decode the given listings back into dicts"""
+        indices = np.asarray(indices)[:limit]
+        c = self.columns
+        decoded = []
+        for i in indices:
+            row = {"id": c["id"][i]}
+            for name in ("crop_type", "variety", "unit", "location_name", "source"):
+                row[name] = self.dictionaries[name][c[name][i]]
+            for name in ("price_per_unit", "quantity_available", "location_lat", "location_lng"):
+                value = c[name][i]
+                row[name] = None if np.isnan(value) else float(value)
+            rating = int(c["quality_rating"][i])
+            row["quality_rating"] = None if rating == NO_RATING else rating
+            for name in ("harvest_date", "created_at"):
+                value = c[name][i] if name in c else np.datetime64("NaT")
+                row[name] = None if np.isnat(value) else str(value)
+            row["is_active"] = bool(c["is_active"][i])
+            decoded.append(row)
+        return decoded
+
+    def save(self, path):
+        """Write the snapshot to an .npz file"""
+        arrays = {f"col_{name}": values for name, values in self.columns.items() if name != "id"}
+        arrays.update({f"dict_{name}": np.array(values, dtype=object) for name, values in self.dictionaries.items()})
+        arrays["col_id"] = self.columns["id"]
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=True) as data:
+            columns = {key[4:]: data[key] for key in data.files if key.startswith("col_")}
+            dictionaries = {key[5:]: list(data[key]) for key in data.files if key.startswith("dict_")}
+        return cls(columns, dictionaries)
+
+
+def run_benchmark(size=1_000_000, repeats=50):
+    """Time the combined bbox + price + quality + crop filter on a synthetic snapshot"""
+    snapshot = MarketSnapshot.synthetic(size)
+    filters = {"bbox": (-2, 0, 36, 38), "price": (0.5, 2.0), "min_quality": 4, "crops": ["maize", "beans"]}
+    expected = np.flatnonzero(snapshot.mask(**filters))
+    started = time.perf_counter()
+    for _ in range(repeats):
+        snapshot.mask(**filters)
+    full_scan = (time.perf_counter() - started) / repeats
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        hits = snapshot.filter(**filters)
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    assert np.array_equal(np.sort(hits), expected)
+    print(f"{size} listings, {len(hits)} matches: median {timings[len(timings) // 2] * 1e6:.0f} us, "
+          f"best {timings[0] * 1e6:.0f} us per combined filter (full-scan masks: {full_scan * 1e6:.0f} us)")
+
+
+def main():
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description="Query a local columnar snapshot of market_listings")
+    parser.add_argument("--url", default=SUPABASE_URL, help="Supabase (or stub server) base URL")
+    parser.add_argument("--snapshot", help="load/save the snapshot from/to this .npz file")
+    parser.add_argument("--refresh", action="store_true", help="re-download even if --snapshot exists")
+    parser.add_argument("--bbox", type=float, nargs=4, metavar=("LAT_MIN", "LAT_MAX", "LNG_MIN", "LNG_MAX"))
+    parser.add_argument("--price", type=float, nargs=2, metavar=("LOW", "HIGH"))
+    parser.add_argument("--min-quality", type=int)
+    parser.add_argument("--crop", action="append", dest="crops")
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--benchmark", action="store_true", help="time filters on a synthetic snapshot")
+    parser.add_argument("--rows", type=int, default=1_000_000, help="synthetic listings in benchmark mode")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        for size in (10_000, 100_000, args.rows):
+            run_benchmark(size)
+        return
+
+    if args.snapshot and os.path.exists(args.snapshot) and not args.refresh:
+        snapshot = MarketSnapshot.load(args.snapshot)
+    else:
+        snapshot = MarketSnapshot.from_rest(args.url)
+        if args.snapshot:
+            snapshot.save(args.snapshot)
+
+    started = time.perf_counter()
+    hits = snapshot.filter(bbox=args.bbox, price=args.price, min_quality=args.min_quality, crops=args.crops)
+    elapsed = time.perf_counter() - started
+    print(f"{len(hits)} of {len(snapshot)} listings match ({elapsed * 1e6:.0f} us)")
+    for row in snapshot.rows(hits, args.limit):
+        print(f"  {row['crop_type']} - {row['location_name']}: {row['price_per_unit']}/{row['unit']}, "
+              f"quality {row['quality_rating']}")
+
+
+if __name__ == "__main__":
+    main()
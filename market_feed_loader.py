@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""
+Streaming loader for partner market feeds (CSV, NDJSON, optionally gzipped).
+
+Rows are read, validated against the market_listings schema and handed to the
+bulk writer in insert_market_listings.py one generator stage at a time, so
+memory stays bounded by a single batch no matter how large the feed is.
+"""
+
+import argparse
+import csv
+import gzip
+import io
+import json
+import re
+import resource
+import sys
+from datetime import datetime
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+from insert_market_listings import DEFAULT_BATCH_SIZE, SUPABASE_URL, ingest
+from market_schema import COLUMNS, COLUMNS_BY_NAME, MarketListing
+
+GZIP_MAGIC = b"\x1f\x8b"
+MAX_REJECT_DETAILS = 20
+
+# DECIMAL(precision, scale) columns of public.market_listings
+DECIMAL_COLUMNS = {column.name: (column.precision, column.scale) for column in COLUMNS if column.precision}
+COORDINATE_RANGES = {
+    "location_lat": 90,
+    "location_lng": 180,
+}
+TEXT_COLUMNS = ("variety", "location_name")
+TRUE_VALUES = {"true", "t", "1", "yes", "y"}
+FALSE_VALUES = {"false", "f", "0", "no", "n"}
+# Bytes that are not valid UTF-8 decode to lone surrogates under errors="surrogateescape"
+UNDECODABLE = re.compile("[\udc80-\udcff]")
+
+
+class RowError(ValueError):
+    """Raised when a feed row violates the market_listings schema"""
+
+
+def open_feed(path):
+    """Open a feed file as text, transparently decompressing gzip
+
+    Invalid UTF-8 is kept as lone surrogates instead of raising, so
+    read_rows() can reject just the affected rows.
+    """
+    raw = sys.stdin.buffer if path == "-" else open(path, "rb")
+    stream = io.BufferedReader(raw) if not hasattr(raw, "peek") else raw
+    if stream.peek(2)[:2] == GZIP_MAGIC:
+        stream = gzip.GzipFile(fileobj=stream)
+    return io.TextIOWrapper(stream, encoding="utf-8-sig", errors="surrogateescape", newline="")
+
+
+def detect_format(path):
+    """Guess the feed format from the file name"""
+    name = path.lower()
+    if name.endswith(".gz"):
+        name = name[:-3]
+    if name.endswith((".ndjson", ".jsonl", ".json")):
+        return "ndjson"
+    return "csv"
+
+
+def read_rows(path, feed_format=None):
+    """Yield (line_number, raw_row) pairs from a CSV or NDJSON feed
+
+    Lines that are not valid UTF-8, malformed CSV and invalid JSON are
+    yielded as RowError values, so one bad line rejects only its row.
+    """
+    feed_format = feed_format or detect_format(path)
+    with open_feed(path) as stream:
+        if feed_format == "csv":
+            reader = csv.DictReader(stream)
+            while True:
+                try:
+                    row = next(reader)
+                except StopIteration:
+                    break
+                except csv.Error as e:
+                    # line_num is only advanced for rows that parsed
+                    yield reader.line_num + 1, RowError(f"malformed CSV: {e}")
+                    continue
+                if any(UNDECODABLE.search(text) for text in row.values() if isinstance(text, str)):
+                    yield reader.line_num, RowError("invalid UTF-8")
+                    continue
+                yield reader.line_num, row
+        else:
+            for line_number, line in enumerate(stream, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                if UNDECODABLE.search(line):
+                    yield line_number, RowError("invalid UTF-8")
+                    continue
+                try:
+                    yield line_number, json.loads(line)
+                except ValueError as e:
+                    yield line_number, RowError(f"invalid JSON: {e}")
+
+
+def _blank(value):
+    return value is None or (isinstance(value, str) and not value.strip())
+
+
+def parse_decimal(column, value):
+    """Round a value to the column's DECIMAL scale and check it fits its precision"""
+    precision, scale = DECIMAL_COLUMNS[column]
+    try:
+        number = Decimal(str(value).strip())
+    except InvalidOperation:
+        raise RowError(f"{column}: not a number: {value!r}")
+    if not number.is_finite():
+        raise RowError(f"{column}: not a finite number: {value!r}")
+    number = number.quantize(Decimal(1).scaleb(-scale), rounding=ROUND_HALF_UP)
+    if abs(number) >= Decimal(10) ** (precision - scale):
+        raise RowError(f"{column}: {value} overflows DECIMAL({precision}, {scale})")
+    limit = COORDINATE_RANGES.get(column)
+    if limit is not None and abs(number) > limit:
+        raise RowError(f"{column}: {value} out of range")
+    return number
+
+
+def parse_bool(column, value):
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in TRUE_VALUES:
+        return True
+    if text in FALSE_VALUES:
+        return False
+    raise RowError(f"{column}: not a boolean: {value!r}")
+
+
+def parse_timestamp(column, value):
+    text = str(value).strip()
+    try:
+        return datetime.fromisoformat(text.replace("Z", "+00:00")).isoformat()
+    except ValueError:
+        raise RowError(f"{column}: not an ISO-8601 timestamp: {value!r}")
+
+
+def validate_listing(raw):
+    """Coerce a raw feed row into a market_listings row or raise RowError"""
+    if not isinstance(raw, dict):
+        raise RowError("row is not an object")
+
+    crop_type = raw.get("crop_type")
+    if _blank(crop_type):
+        raise RowError("crop_type: required")
+    if _blank(raw.get("price_per_unit")):
+        raise RowError("price_per_unit: required")
+
+    # Feed text columns are low-cardinality, so interning shares one string per distinct value
+    listing = {
+        "crop_type": sys.intern(str(crop_type).strip()),
+        "unit": sys.intern(str(raw.get("unit") or COLUMNS_BY_NAME["unit"].python_default).strip()),
+        "source": sys.intern(str(raw.get("source") or COLUMNS_BY_NAME["source"].python_default).strip()),
+    }
+    for column in TEXT_COLUMNS:
+        value = raw.get(column)
+        listing[column] = None if _blank(value) else sys.intern(str(value).strip())
+    # Values are checked and rounded as Decimal, then kept as float: every DECIMAL(10, s) value has
+    # at most 10 significant digits, so the float round-trips exactly and is a quarter of the size
+    for column in DECIMAL_COLUMNS:
+        value = raw.get(column)
+        listing[column] = None if _blank(value) else float(parse_decimal(column, value))
+
+    rating = raw.get("quality_rating")
+    if _blank(rating):
+        listing["quality_rating"] = None
+    else:
+        try:
+            number = Decimal(str(rating).strip())
+        except InvalidOperation:
+            raise RowError(f"quality_rating: not a number: {rating!r}")
+        if number != number.to_integral_value() or not 1 <= number <= 5:
+            raise RowError(f"quality_rating: {rating} violates CHECK (quality_rating BETWEEN 1 AND 5)")
+        listing["quality_rating"] = int(number)
+
+    harvest_date = raw.get("harvest_date")
+    listing["harvest_date"] = None if _blank(harvest_date) else sys.intern(parse_timestamp("harvest_date", harvest_date))
+    is_active = raw.get("is_active")
+    listing["is_active"] = True if _blank(is_active) else parse_bool("is_active", is_active)
+    return MarketListing(**listing)
+
+
+class LoadStats:
+    """Counters for the validation stage of a feed load"""
+
+    def __init__(self):
+        self.read = 0
+        self.valid = 0
+        self.rejected = 0
+        self.rejects = []
+
+
+def validated_rows(rows, stats, rejects_file=None):
+    """Yield valid listings from (line_number, raw_row) pairs, recording rejects"""
+    for line_number, raw in rows:
+        stats.read += 1
+        try:
+            if isinstance(raw, RowError):
+                raise raw
+            listing = validate_listing(raw)
+        except RowError as e:
+            stats.rejected += 1
+            if len(stats.rejects) < MAX_REJECT_DETAILS:
+                stats.rejects.append((line_number, str(e)))
+            if rejects_file:
+                rejects_file.write(json.dumps({"line": line_number, "error": str(e), "row": raw}, default=str) + "\n")
+            continue
+        stats.valid += 1
+        yield listing
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MiB"""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage / (1024 * 1024) if sys.platform == "darwin" else usage / 1024
+
+
+def load_feed(path, feed_format=None, batch_size=DEFAULT_BATCH_SIZE, base_url=SUPABASE_URL,
+              dry_run=False, rejects_path=None, verbose=True, concurrency=1, upsert=False):
+    """Stream a feed file into market_listings and return (stats, report)"""
+    stats = LoadStats()
+    rejects_file = open(rejects_path, "w") if rejects_path else None
+    try:
+        rows = validated_rows(read_rows(path, feed_format), stats, rejects_file)
+        if dry_run:
+            for _ in rows:
+                pass
+            report = None
+        else:
+            report = ingest(rows, batch_size, concurrency, base_url, verbose, upsert)
+    finally:
+        if rejects_file:
+            rejects_file.close()
+
+    print(f"Read {stats.read} rows: {stats.valid} valid, {stats.rejected} rejected")
+    for line_number, error in stats.rejects:
+        print(f"  line {line_number}: {error}")
+    if report:
+        print(report.summary())
+    print(f"Peak RSS: {peak_rss_mb():.1f} MiB")
+    return stats, report
+
+
+def main():
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description="Stream a partner market feed into market_listings")
+    parser.add_argument("path", help="CSV or NDJSON feed, optionally gzipped ('-' for stdin)")
+    parser.add_argument("--format", choices=("csv", "ndjson"), help="override format detection")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="rows per array payload")
+    parser.add_argument("--concurrency", type=int, default=1, help="batch requests kept in flight")
+    parser.add_argument("--upsert", action="store_true", help="upsert on the natural key instead of inserting")
+    parser.add_argument("--url", default=SUPABASE_URL, help="Supabase (or stub server) base URL")
+    parser.add_argument("--rejects", help="write rejected rows as NDJSON to this file")
+    parser.add_argument("--dry-run", action="store_true", help="validate only, do not insert")
+    parser.add_argument("--quiet", action="store_true", help="do not print per-batch progress")
+    args = parser.parse_args()
+
+    stats, report = load_feed(args.path, args.format, args.batch_size, args.url,
+                              args.dry_run, args.rejects, not args.quiet, args.concurrency, args.upsert)
+    failed = stats.rejected + (report.rows_failed if report else 0)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
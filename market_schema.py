@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+"""
+Single source of truth for the public.market_listings schema.
+
+Generates the DDL (table, comments, RLS, indexes, policies, trigger), the
+seed data as SQL and as Python rows, and the compact __slots__ row class used
+by the ingestion scripts instead of per-row dicts.
+
+Regenerate the bundled migration after editing this module:
+
+    python market_schema.py --write
+"""
+
+import argparse
+import os
+from datetime import datetime, timedelta, timezone
+
+TABLE = "public.market_listings"
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SETUP_SQL_PATH = os.path.join(BASE_DIR, "database", "setup_market_listings.sql")
+SEED_SQL_PATH = os.path.join(BASE_DIR, "database", "seed_market_listings.sql")
+
+
+class Column:
+    """One market_listings column and the metadata the generators need"""
+
+    def __init__(self, name, sql_type, not_null=False, default=None, python_default=None, check=None,
+                 references=None, comment=None, precision=None, scale=None, primary_key=False, writable=True):
+        self.name = name
+        self.sql_type = sql_type
+        self.not_null = not_null
+        self.default = default
+        self.python_default = python_default
+        self.check = check
+        self.references = references
+        self.comment = comment
+        self.precision = precision
+        self.scale = scale
+        self.primary_key = primary_key
+        # Writable columns become slots of MarketListing
+        self.writable = writable
+
+    def ddl(self):
+        parts = [self.name, self.sql_type]
+        if self.primary_key:
+            parts.append("PRIMARY KEY")
+        if self.not_null:
+            parts.append("NOT NULL")
+        if self.default is not None:
+            parts.append(f"DEFAULT {self.default}")
+        if self.check:
+            parts.append(f"CHECK ({self.check})")
+        if self.references:
+            parts.append(f"REFERENCES {self.references}")
+        return " ".join(parts)
+
+
+COLUMNS = [
+    Column("id", "UUID", primary_key=True, default="gen_random_uuid()", writable=False),
+    Column("crop_type", "TEXT", not_null=True, comment="Type of crop (Maize, Cassava, Beans, etc.)"),
+    Column("variety", "TEXT"),
+    Column("price_per_unit", "DECIMAL(10, 2)", not_null=True, precision=10, scale=2),
+    Column("unit", "TEXT", not_null=True, default="'kg'", python_default="kg"),
+    Column("quantity_available", "DECIMAL(10, 2)", precision=10, scale=2),
+    Column("location_name", "TEXT"),
+    Column("location_lat", "DECIMAL(10, 6)", precision=10, scale=6),
+    Column("location_lng", "DECIMAL(10, 6)", precision=10, scale=6),
+    Column("source", "TEXT", not_null=True, default="'user_input'", python_default="user_input",
+           comment="Data source: user_input, api_integration, web_scraped, partner_feed"),
+    Column("quality_rating", "SMALLINT", check="quality_rating BETWEEN 1 AND 5",
+           comment="Quality rating from 1-5 (5 being highest quality)"),
+    Column("harvest_date", "TIMESTAMP WITH TIME ZONE"),
+    Column("created_at", "TIMESTAMP WITH TIME ZONE", default="now()", writable=False),
+    Column("updated_at", "TIMESTAMP WITH TIME ZONE", default="now()", writable=False),
+    Column("created_by", "UUID", references="auth.users(id) ON DELETE SET NULL"),
+    Column("is_active", "BOOLEAN", default="true", python_default=True),
+    Column("natural_key", "TEXT",
+           comment="Client-side hash of (crop_type, variety, location, harvest_date) used for idempotent upserts"),
+    Column("content_hash", "TEXT", comment="Client-side hash of the mutable columns, used to skip unchanged rows"),
+]
+COLUMNS_BY_NAME = {column.name: column for column in COLUMNS}
+
+TABLE_COMMENT = "Market price listings for crops across African markets"
+
+# (name, columns, unique)
+INDEXES = [
+    ("idx_market_listings_crop_type", "crop_type", False),
+    ("idx_market_listings_location", "location_lat, location_lng", False),
+    ("idx_market_listings_created_at", "created_at DESC", False),
+    ("idx_market_listings_active", "is_active", False),
+    ("idx_market_listings_price", "price_per_unit", False),
+    ("idx_market_listings_natural_key", "natural_key", True),
+]
+
+# (name, description, command, using, with_check)
+POLICIES = [
+    ("market_listings_read_active", "Allow all users to read active market listings",
+     "SELECT", "is_active = true", None),
+    ("market_listings_insert_own", "Allow authenticated users to insert their own listings",
+     "INSERT", None, "auth.role() = 'authenticated' AND auth.uid() = created_by"),
+    ("market_listings_update_own", "Allow users to update their own listings",
+     "UPDATE", "auth.uid() = created_by", "auth.uid() = created_by"),
+    ("market_listings_read_own_inactive", "Allow users to view their own inactive listings",
+     "SELECT", "auth.uid() = created_by AND is_active = false", None),
+]
+
+TRIGGER_SQL = """-- Create trigger function for updating updated_at timestamp
+CREATE OR REPLACE FUNCTION public.update_updated_at_column()
+RETURNS TRIGGER AS $$
+BEGIN
+    NEW.updated_at = now();
+    RETURN NEW;
+END;
+$$ language 'plpgsql';
+
+-- Create trigger for market_listings
+DROP TRIGGER IF EXISTS update_market_listings_updated_at ON public.market_listings;
+CREATE TRIGGER update_market_listings_updated_at
+    BEFORE UPDATE ON public.market_listings
+    FOR EACH ROW
+    EXECUTE FUNCTION public.update_updated_at_column();
+"""
+
+SEED_COLUMNS = ("crop_type", "variety", "price_per_unit", "unit", "quantity_available", "location_name",
+                "location_lat", "location_lng", "source", "quality_rating")
+
+# Seed harvest dates are fixed so natural_key() of every seed row is the same on every run
+SEED_HARVEST_ANCHOR = datetime(2025, 6, 1, tzinfo=timezone.utc)
+
+# Seed listings grouped by country; the last field is the harvest age in days before SEED_HARVEST_ANCHOR
+SEED_DATA = [
+    ("Kenya", [
+        ("Maize", "Yellow Dent", 0.35, "kg", 2500, "Nairobi Central Market", -1.286389, 36.817223, "api_integration", 4, 30),
+        ("Tomato", "Roma", 0.80, "kg", 500, "Mombasa Market", -4.043477, 39.658871, "user_input", 5, 7),
+        ("Beans", "Kidney Beans", 1.10, "kg", 800, "Kisumu Market", -0.091702, 34.767956, "partner_feed", 4, 14),
+    ]),
+    ("Nigeria", [
+        ("Cassava", "Sweet Cassava", 0.25, "kg", 1800, "Lagos State Market", 6.5244, 3.3792, "user_input", 3, 14),
+        ("Yam", "White Yam", 0.45, "kg", 1200, "Kano Market", 12.0022, 8.5920, "web_scraped", 4, 21),
+        ("Rice", "Local Rice", 0.95, "kg", 3000, "Port Harcourt Market", 4.8156, 7.0498, "api_integration", 3, 45),
+    ]),
+    ("Ghana", [
+        ("Cocoa", "Trinitario", 2.20, "kg", 500, "Accra Central Market", 5.6037, -0.1870, "partner_feed", 5, 7),
+        ("Plantain", "False Horn", 0.60, "kg", 1500, "Kumasi Market", 6.6885, -1.6244, "user_input", 4, 10),
+    ]),
+    ("Uganda", [
+        ("Coffee", "Arabica", 3.50, "kg", 200, "Kampala Market", 0.3476, 32.5825, "api_integration", 5, 21),
+        ("Matooke", "Green Bananas", 0.40, "kg", 800, "Jinja Market", 0.4236, 33.2042, "user_input", 4, 5),
+    ]),
+    ("Ethiopia", [
+        ("Teff", "White Teff", 1.80, "kg", 600, "Addis Ababa Market", 9.1450, 40.4897, "web_scraped", 4, 28),
+        ("Sorghum", "Red Sorghum", 0.55, "kg", 1000, "Dire Dawa Market", 9.5915, 41.8661, "partner_feed", 3, 35),
+    ]),
+]
+
+
+def make_row_class(name, columns):
+    """Build a __slots__ row class for the given columns
+
+    Instances cost one pointer per column instead of a per-row dict, which is
+    what keeps the ingestion path's memory flat.
+    """
+    slots = tuple(column.name for column in columns)
+    defaults = tuple(column.python_default for column in columns)
+    # Only sent when set, so plain inserts work against tables without them
+    optional = frozenset(("natural_key", "content_hash")) & frozenset(slots)
+
+    def __init__(self, **values):
+        for slot, default in zip(slots, defaults):
+            setattr(self, slot, values.pop(slot, default))
+        if values:
+            raise TypeError(f"unknown {name} columns: {', '.join(sorted(values))}")
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def copy(self):
+        clone = object.__new__(type(self))
+        for slot in slots:
+            setattr(clone, slot, getattr(self, slot))
+        return clone
+
+    def to_dict(self):
+        return {slot: getattr(self, slot) for slot in slots
+                if slot not in optional or getattr(self, slot) is not None}
+
+    def __eq__(self, other):
+        return type(other) is type(self) and all(getattr(self, s) == getattr(other, s) for s in slots)
+
+    def __repr__(self):
+        fields = ", ".join(f"{slot}={getattr(self, slot)!r}" for slot in slots if getattr(self, slot) is not None)
+        return f"{name}({fields})"
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(**{key: value for key, value in values.items() if key in slots})
+
+    @classmethod
+    def coerce(cls, value):
+        """Return a copy of value as a row object, accepting rows or dicts"""
+        return value.copy() if isinstance(value, cls) else cls.from_dict(value)
+
+    namespace = {
+        "__slots__": slots,
+        "__init__": __init__,
+        "__eq__": __eq__,
+        "__hash__": None,
+        "__repr__": __repr__,
+        "get": get,
+        "copy": copy,
+        "to_dict": to_dict,
+        "from_dict": from_dict,
+        "coerce": coerce,
+        "columns": slots,
+    }
+    return type(name, (), namespace)
+
+
+MarketListing = make_row_class("MarketListing", [column for column in COLUMNS if column.writable])
+
+
+def seed_harvest_date(age_days, anchor=SEED_HARVEST_ANCHOR):
+    """ISO-8601 harvest date of a seed listing harvested age_days before anchor"""
+    return (anchor - timedelta(days=age_days)).isoformat()
+
+
+def seed_listings(anchor=SEED_HARVEST_ANCHOR):
+    """Return the seed data as MarketListing rows
+
+    Harvest dates are fixed offsets from anchor, the same dates as the seed
+    SQL, so re-running an upsert of the seed rows on a later day matches the
+    rows already stored instead of inserting them again.
+    """
+    rows = []
+    for _, listings in SEED_DATA:
+        for values in listings:
+            row = MarketListing(**dict(zip(SEED_COLUMNS, values[:-1])))
+            row.harvest_date = seed_harvest_date(values[-1], anchor)
+            rows.append(row)
+    return rows
+
+
+def _sql_value(value):
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def create_table_sql():
+    """CREATE TABLE statement for market_listings"""
+    columns = ",\n".join(f"  {column.ddl()}" for column in COLUMNS)
+    # A table created by an older version of this script gets any missing columns;
+    # NOT NULL columns without a default could not be added to a populated table
+    added = "\n".join(f"ALTER TABLE {TABLE} ADD COLUMN IF NOT EXISTS {column.ddl()};" for column in COLUMNS
+                      if not column.primary_key and not (column.not_null and column.default is None))
+    return f"CREATE TABLE IF NOT EXISTS {TABLE} (\n{columns}\n);\n{added}\n"
+
+
+def comments_sql():
+    lines = [f"COMMENT ON TABLE {TABLE} IS {_sql_value(TABLE_COMMENT)};"]
+    for column in COLUMNS:
+        if column.comment:
+            lines.append(f"COMMENT ON COLUMN {TABLE}.{column.name} IS {_sql_value(column.comment)};")
+    return "\n".join(lines) + "\n"
+
+
+def indexes_sql():
+    lines = []
+    for name, columns, unique in INDEXES:
+        kind = "UNIQUE INDEX" if unique else "INDEX"
+        lines.append(f"CREATE {kind} IF NOT EXISTS {name} ON {TABLE}({columns});")
+    return "\n".join(lines) + "\n"
+
+
+def policies_sql():
+    blocks = []
+    for number, (name, description, command, using, with_check) in enumerate(POLICIES, 1):
+        lines = [f"-- Policy {number}: {description}", f'DROP POLICY IF EXISTS "{name}" ON {TABLE};',
+                 f'CREATE POLICY "{name}" ', f"ON {TABLE} ", f"FOR {command} "]
+        if using:
+            lines.append(f"USING ({using}) ")
+        if with_check:
+            lines.append(f"WITH CHECK ({with_check}) ")
+        lines[-1] = lines[-1].rstrip() + ";"
+        blocks.append("\n".join(lines))
+    return "\n\n".join(blocks) + "\n"
+
+
+def seed_sql():
+    """Statements adding the seed data, with the same fixed harvest dates as seed_listings()
+
+    Seed rows carry the natural_key and content_hash insert_market_listings
+    computes for seed_listings(), so an --upsert of the seed after this SQL
+    skips every row. Seed rows an older version stored without a key (same
+    crop, variety, market and harvest day) get theirs first, and rows whose
+    natural_key is present are not inserted again, so the seed migration
+    can be re-applied.
+    """
+    from insert_market_listings import content_hash, natural_key  # that module imports this one
+
+    columns = SEED_COLUMNS + ("harvest_date", "is_active", "natural_key", "content_hash")
+    listings = iter(seed_listings())
+    groups = []
+    for country, seeds in SEED_DATA:
+        rows = []
+        for values in seeds:
+            listing = next(listings)
+            literals = ", ".join(_sql_value(value) for value in values[:-1])
+            harvest_date = _sql_value(seed_harvest_date(values[-1]))
+            rows.append(f"  ({literals}, TIMESTAMP WITH TIME ZONE {harvest_date}, true, "
+                        f"{_sql_value(natural_key(listing))}, {_sql_value(content_hash(listing))})")
+        groups.append(f"  -- {country} Markets\n" + ",\n".join(rows))
+    column_list = ", ".join(columns)
+    seed = "(VALUES \n" + ",\n  \n".join(groups) + f"\n) AS seed ({column_list})"
+    return ("-- Key seed rows stored without a natural_key\n"
+            f"UPDATE {TABLE} AS listing SET natural_key = seed.natural_key, content_hash = seed.content_hash\n"
+            f"FROM {seed}\n"
+            f"WHERE listing.id = (\n  SELECT existing.id FROM {TABLE} existing\n"
+            "  WHERE existing.natural_key IS NULL AND existing.crop_type = seed.crop_type\n"
+            "    AND existing.variety IS NOT DISTINCT FROM seed.variety\n"
+            "    AND existing.location_name IS NOT DISTINCT FROM seed.location_name\n"
+            "    AND (existing.harvest_date AT TIME ZONE 'UTC')::date = (seed.harvest_date AT TIME ZONE 'UTC')::date\n"
+            "  ORDER BY existing.id LIMIT 1\n)\n"
+            f"AND NOT EXISTS (SELECT 1 FROM {TABLE} keyed WHERE keyed.natural_key = seed.natural_key);\n\n"
+            "-- Insert sample African market data\n"
+            f"INSERT INTO {TABLE} ({column_list})\n"
+            f"SELECT {', '.join(f'seed.{column}' for column in columns)}\nFROM {seed}\n"
+            f"WHERE NOT EXISTS (SELECT 1 FROM {TABLE} existing WHERE existing.natural_key = seed.natural_key);\n")
+
+
+def setup_sql():
+    """Full setup script: table, comments, RLS, indexes, policies and trigger
+
+    Every statement is safe to re-run, since migration_runner.py re-applies
+    the file whenever its checksum changes.
+    """
+    return "\n".join([
+        "-- CropGenius Market Intelligence Database Setup",
+        "-- Generated by market_schema.py - edit the schema there and run `python market_schema.py --write`",
+        "-- Execute this SQL in Supabase SQL Editor or apply it with migration_runner.py",
+        "",
+        "-- Create market_listings table",
+        create_table_sql(),
+        "-- Add helpful comments",
+        comments_sql(),
+        "-- Enable Row Level Security",
+        f"ALTER TABLE {TABLE} ENABLE ROW LEVEL SECURITY;",
+        "",
+        "-- Create indexes for performance",
+        indexes_sql(),
+        "-- RLS Policies for Market Intelligence",
+        "",
+        policies_sql(),
+        TRIGGER_SQL,
+    ])
+
+
+def seed_migration_sql():
+    """Seed data migration, applied after the setup script"""
+    return "\n".join([
+        "-- CropGenius Market Intelligence sample data",
+        "-- Generated by market_schema.py - edit the schema there and run `python market_schema.py --write`",
+        "-- Inserts only seed listings whose natural_key is not present yet, so it is safe to run more than once",
+        "",
+        seed_sql(),
+    ])
+
+
+GENERATED_FILES = ((SETUP_SQL_PATH, setup_sql), (SEED_SQL_PATH, seed_migration_sql))
+
+
+def main():
+    """Print or write the generated setup and seed SQL"""
+    parser = argparse.ArgumentParser(description="Generate market_listings SQL from the schema module")
+    parser.add_argument("--write", action="store_true",
+                        help=f"write {', '.join(os.path.relpath(path, BASE_DIR) for path, _ in GENERATED_FILES)}")
+    parser.add_argument("--check", action="store_true", help="exit 1 if the bundled SQL is out of date")
+    args = parser.parse_args()
+
+    if args.check:
+        stale = False
+        for path, generate in GENERATED_FILES:
+            current = None
+            if os.path.exists(path):
+                with open(path, encoding="utf-8") as f:
+                    current = f.read()
+            if current != generate():
+                print(f"{path} is out of date; run `python market_schema.py --write`")
+                stale = True
+        return 1 if stale else 0
+    for path, generate in GENERATED_FILES:
+        if args.write:
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(generate())
+            print(f"Wrote {path}")
+        else:
+            print(generate(), end="")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+"""
+Geohash spatial index for nearest-market lookups over market_listings.
+
+Each listing's location_lat/location_lng is quantized to a 52-bit geohash
+(26 bits per axis, longitude first, so the top 5*n bits are the n-character
+geohash). Listings are kept per crop in blocked lists sorted by that code
+and maintained incrementally with bisect, so a geohash cell at any
+precision is one contiguous run found in O(log n), and an insert or remove
+only shifts one block.
+
+A within-radius query picks the finest cell level whose cells are at least
+the radius wide and tall, reads the 3x3 block of cells around the point and
+filters the candidates by haversine distance. A k-nearest query finds the
+finest cell around the point holding at least k listings, takes the distance
+to the k-th nearest of them as the radius and answers one within-radius
+query, which makes the result exact.
+
+MarketIndex.observe() plugs into insert_market_listings.ingest() next to
+PriceAggregates.observe, so inserts and upserted updates keep the index
+current without rebuilding it.
+
+    index = MarketIndex.from_rows(listings)
+    ingest(rows, upsert=True, observers=[aggregates.observe, index.observe])
+    index.nearest(-1.286389, 36.817223, k=5, crop="maize")
+    selling_opportunities(index, {"lat": -1.286389, "lng": 36.817223}, ["maize", "beans"])
+"""
+
+import argparse
+import math
+import threading
+import time
+from bisect import bisect_left, bisect_right
+
+import numpy as np
+
+from insert_market_listings import SUPABASE_URL, natural_key
+from market_columnar import MarketSnapshot
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+HALF_CIRCUMFERENCE_KM = math.pi * EARTH_RADIUS_KM
+BITS = 26  # per axis; 2 * BITS = 52 bits fits a 10-character geohash
+CELLS = 1 << BITS
+BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+BLOCK_SIZE = 512  # points per sorted block of a GeohashIndex
+
+
+def _quantize(value, low, span):
+    return min(CELLS - 1, max(0, int((value - low) / span * CELLS)))
+
+
+def _spread(x):
+    """Insert a zero bit between each of the low 32 bits of x"""
+    x = (x | (x << 16)) & 0x0000FFFF0000FFFF
+    x = (x | (x << 8)) & 0x00FF00FF00FF00FF
+    x = (x | (x << 4)) & 0x0F0F0F0F0F0F0F0F
+    x = (x | (x << 2)) & 0x3333333333333333
+    return (x | (x << 1)) & 0x5555555555555555
+
+
+def _interleave(lng_cell, lat_cell):
+    return (_spread(lng_cell) << 1) | _spread(lat_cell)
+
+
+def encode(lat, lng):
+    """52-bit geohash code of a point"""
+    return _interleave(_quantize(lng, -180.0, 360.0), _quantize(lat, -90.0, 180.0))
+
+
+def encode_many(lat, lng):
+    """Vectorized encode() over NumPy coordinate arrays"""
+    lat_cell = np.clip(((lat + 90.0) / 180.0 * CELLS).astype(np.int64), 0, CELLS - 1).astype(np.uint64)
+    lng_cell = np.clip(((lng + 180.0) / 360.0 * CELLS).astype(np.int64), 0, CELLS - 1).astype(np.uint64)
+    return (_spread(lng_cell) << np.uint64(1)) | _spread(lat_cell)
+
+
+def cell(lat, lng, precision=6):
+    """Integer id of the geohash cell of a point (the top 5 * precision bits of its code)"""
+    return encode(lat, lng) >> (2 * BITS - 5 * precision)
+
+
+def cell_geohash(cell_id, precision=6):
+    """Base32 geohash string of an integer cell id"""
+    return "".join(BASE32[(cell_id >> (5 * (precision - 1 - i))) & 31] for i in range(precision))
+
+
+def geohash(lat, lng, precision=6):
+    """Base32 geohash string of a point (precision <= 10)"""
+    return cell_geohash(cell(lat, lng, precision), precision)
+
+
+def _compact(x):
+    """Inverse of _spread: gather the even bits of x"""
+    x &= 0x5555555555555555
+    x = (x | (x >> 1)) & 0x3333333333333333
+    x = (x | (x >> 2)) & 0x0F0F0F0F0F0F0F0F
+    x = (x | (x >> 4)) & 0x00FF00FF00FF00FF
+    x = (x | (x >> 8)) & 0x0000FFFF0000FFFF
+    return (x | (x >> 16)) & 0x00000000FFFFFFFF
+
+
+def cell_centre(cell_id, precision=6):
+    """(lat, lng) of the centre of a geohash cell"""
+    code = cell_id << (2 * BITS - 5 * precision)
+    lng_bits = (5 * precision + 1) // 2
+    lat_bits = 5 * precision // 2
+    lat = (_compact(code) / CELLS + 0.5 / (1 << lat_bits)) * 180.0 - 90.0
+    lng = (_compact(code >> 1) / CELLS + 0.5 / (1 << lng_bits)) * 360.0 - 180.0
+    return lat, lng
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """Great-circle distance between two points in km"""
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2 +
+         math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def cover(lat, lng, radius_km):
+    """Sorted, merged [start, stop) code ranges whose cells cover a circle"""
+    if radius_km >= HALF_CIRCUMFERENCE_KM / 2:
+        return [(0, 1 << (2 * BITS))]
+    dlat = radius_km / KM_PER_DEGREE
+    widest = min(89.9, abs(lat) + dlat)
+    dlng = dlat / math.cos(math.radians(widest))
+    if dlng >= 180:
+        return [(0, 1 << (2 * BITS))]
+    # Finest level at which one cell spans the radius on both axes
+    level = max(0, min(BITS, int(math.floor(math.log2(min(180.0 / dlat, 360.0 / dlng))))))
+    size = 1 << level
+    shift = 2 * (BITS - level)
+    lat_cell = _quantize(lat, -90.0, 180.0) >> (BITS - level)
+    lng_cell = _quantize(lng, -180.0, 360.0) >> (BITS - level)
+    prefixes = set()
+    for i in range(lat_cell - 1, lat_cell + 2):
+        if 0 <= i < size:
+            for j in range(lng_cell - 1, lng_cell + 2):
+                prefixes.add(_interleave(j % size, i))
+    ranges = []
+    for prefix in sorted(prefixes):
+        start, stop = prefix << shift, (prefix + 1) << shift
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], stop)
+        else:
+            ranges.append((start, stop))
+    return ranges
+
+
+class GeohashIndex:
+    """Points sorted by geohash code, with incremental insert/remove
+
+    The sorted order is split into blocks of block_size to 2 * block_size
+    points, so insert/remove shift one block (O(block_size)) instead of the
+    whole list; the block holding a code is found by bisecting the blocks'
+    first codes.
+    """
+
+    def __init__(self, block_size=BLOCK_SIZE):
+        self.block_size = block_size
+        self.firsts = []  # first code of each block
+        self.blocks = []  # (codes, entries) per block
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def _find(self, code):
+        """(block, position) of the first point whose code is >= code"""
+        block = max(0, bisect_left(self.firsts, code) - 1)
+        while block < len(self.blocks):
+            position = bisect_left(self.blocks[block][0], code)
+            if position < len(self.blocks[block][0]):
+                return block, position
+            block += 1
+        return block, 0
+
+    def _scan(self, start, stop):
+        """Yield (code, entry) for codes in [start, stop), in order"""
+        block, position = self._find(start)
+        for codes, entries in self.blocks[block:]:
+            for index in range(position, len(codes)):
+                if codes[index] >= stop:
+                    return
+                yield codes[index], entries[index]
+            position = 0
+
+    def insert(self, lat, lng, value):
+        code = encode(lat, lng)
+        if not self.blocks:
+            self.firsts.append(code)
+            self.blocks.append(([code], [(lat, lng, value)]))
+            self.size = 1
+            return
+        block = max(0, bisect_right(self.firsts, code) - 1)
+        codes, entries = self.blocks[block]
+        position = bisect_right(codes, code)
+        codes.insert(position, code)
+        entries.insert(position, (lat, lng, value))
+        self.firsts[block] = codes[0]
+        self.size += 1
+        if len(codes) > 2 * self.block_size:
+            half = len(codes) // 2
+            self.blocks[block:block + 1] = [(codes[:half], entries[:half]), (codes[half:], entries[half:])]
+            self.firsts[block:block + 1] = [codes[0], codes[half]]
+
+    def remove(self, lat, lng, value, key=None):
+        """Remove a point inserted with the same coordinates; return False if absent
+
+        Without key the stored value must be value itself or equal to it;
+        with key, any stored value for which key() gives key(value) matches.
+        """
+        code = encode(lat, lng)
+        wanted = value if key is None else key(value)
+        block, position = self._find(code)
+        while block < len(self.blocks):
+            codes, entries = self.blocks[block]
+            for position in range(position, len(codes)):
+                if codes[position] != code:
+                    return False
+                stored = entries[position][2]
+                if stored is value or (stored if key is None else key(stored)) == wanted:
+                    del codes[position]
+                    del entries[position]
+                    self.size -= 1
+                    if codes:
+                        self.firsts[block] = codes[0]
+                    else:
+                        del self.blocks[block]
+                        del self.firsts[block]
+                    return True
+            block, position = block + 1, 0
+        return False
+
+    def bulk_load(self, codes, entries):
+        """Replace the contents with (codes, entries) already sorted by code"""
+        codes = list(codes)
+        entries = list(entries)
+        self.blocks = [(codes[start:start + self.block_size], entries[start:start + self.block_size])
+                       for start in range(0, len(codes), self.block_size)]
+        self.firsts = [block[0][0] for block in self.blocks]
+        self.size = len(codes)
+
+    def within(self, lat, lng, radius_km):
+        """[(distance_km, value)] for points within radius_km, nearest first"""
+        found = []
+        for start, stop in cover(lat, lng, radius_km):
+            for _, (point_lat, point_lng, value) in self._scan(start, stop):
+                distance = haversine_km(lat, lng, point_lat, point_lng)
+                if distance <= radius_km:
+                    found.append((distance, len(found), value))
+        found.sort()
+        return [(distance, value) for distance, _, value in found]
+
+    def nearest(self, lat, lng, k=5, max_km=None):
+        """[(distance_km, value)] for the k nearest points, optionally capped at max_km"""
+        if not self.size or k <= 0:
+            return []
+        radius = HALF_CIRCUMFERENCE_KM
+        if self.size > k:
+            code = encode(lat, lng)
+            for shift in range(0, 2 * BITS + 1, 2):
+                start = (code >> shift) << shift
+                cell = [entry for _, entry in self._scan(start, start + (1 << shift))]
+                if len(cell) >= k:
+                    # k points lie within the k-th smallest distance, so that radius holds the k nearest
+                    distances = sorted(haversine_km(lat, lng, point_lat, point_lng)
+                                       for point_lat, point_lng, _ in cell)
+                    radius = distances[k - 1]
+                    break
+        if max_km is not None:
+            radius = min(radius, max_km)
+        return self.within(lat, lng, radius)[:k]
+
+
+def _crop_key(crop):
+    return (crop or "").casefold()
+
+
+def _listing_key(listing):
+    """natural_key of a listing, computed for rows written without one
+
+    Rows read back over REST are dicts while ingested rows are MarketListing
+    objects, so indexed listings are matched by key and not by equality.
+    """
+    return listing.get("natural_key") or natural_key(listing)
+
+
+class MarketIndex:
+    """Per-crop geohash indexes over active market listings"""
+
+    def __init__(self):
+        self.crops = {}
+        self.all = GeohashIndex()
+        self.lock = threading.Lock()  # ingestion workers call observe() concurrently
+
+    def __len__(self):
+        return len(self.all)
+
+    @staticmethod
+    def _location(listing):
+        lat = listing.get("location_lat")
+        lng = listing.get("location_lng")
+        if lat is None or lng is None or listing.get("is_active") is False:
+            return None
+        return float(lat), float(lng)
+
+    def insert(self, listing):
+        """Index a dict or MarketListing; inactive or unlocated listings are ignored"""
+        location = self._location(listing)
+        if location is None:
+            return False
+        self.all.insert(location[0], location[1], listing)
+        self.crops.setdefault(_crop_key(listing.get("crop_type")), GeohashIndex()).insert(
+            location[0], location[1], listing)
+        return True
+
+    def remove(self, listing):
+        """Drop the indexed listing with the same natural_key; return False if none was indexed"""
+        location = self._location(listing)
+        if location is None:
+            return False
+        crop_index = self.crops.get(_crop_key(listing.get("crop_type")))
+        if crop_index is not None:
+            crop_index.remove(location[0], location[1], listing, _listing_key)
+        return self.all.remove(location[0], location[1], listing, _listing_key)
+
+    def update(self, old, new):
+        """Re-index a listing whose location, crop or is_active changed
+
+        Returns (removed, inserted) so callers can tell when old was not indexed.
+        """
+        return self.remove(old), self.insert(new)
+
+    def observe(self, old_rows, new_rows):
+        """Ingestion observer: apply (old, new) row deltas of a written batch"""
+        with self.lock:
+            for old, new in zip(old_rows, new_rows):
+                if old is not None:
+                    self.remove(old)
+                if new is not None:
+                    self.insert(new)
+
+    @classmethod
+    def from_rows(cls, rows):
+        index = cls()
+        for row in rows:
+            index.insert(row)
+        return index
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """Bulk-build from a MarketSnapshot; indexed values are snapshot row positions"""
+        c = snapshot.columns
+        keep = np.flatnonzero(c["is_active"] & ~np.isnan(c["location_lat"]) & ~np.isnan(c["location_lng"]))
+        codes = encode_many(c["location_lat"][keep], c["location_lng"][keep])
+        order = np.argsort(codes, kind="stable")
+        keep, codes = keep[order], codes[order]
+        lats = c["location_lat"][keep].tolist()
+        lngs = c["location_lng"][keep].tolist()
+        positions = keep.tolist()
+        crop_codes = c["crop_type"][keep]
+
+        index = cls()
+        index.all.bulk_load(codes.tolist(), zip(lats, lngs, positions))
+        for crop_code, crop in enumerate(snapshot.dictionaries["crop_type"]):
+            members = np.flatnonzero(crop_codes == crop_code)
+            if len(members):
+                crop_index = index.crops.setdefault(_crop_key(crop), GeohashIndex())
+                crop_index.bulk_load(codes[members].tolist(),
+                                     ((lats[m], lngs[m], positions[m]) for m in members.tolist()))
+        return index
+
+    def _index(self, crop):
+        return self.all if crop is None else self.crops.get(_crop_key(crop), GeohashIndex())
+
+    def within(self, lat, lng, radius_km, crop=None):
+        return self._index(crop).within(lat, lng, radius_km)
+
+    def nearest(self, lat, lng, k=5, crop=None, max_km=None):
+        return self._index(crop).nearest(lat, lng, k, max_km)
+
+
+def _describe(listing, distance):
+    return {
+        "crop_type": listing.get("crop_type"),
+        "location_name": listing.get("location_name"),
+        "price_per_unit": listing.get("price_per_unit"),
+        "unit": listing.get("unit"),
+        "quality_rating": listing.get("quality_rating"),
+        "distance_km": round(distance, 2),
+    }
+
+
+def selling_opportunities(index, farmer_location, farmer_crops, k=5, max_distance_km=None, resolve=None):
+    """Nearest candidate markets for each of a farmer's crops
+
+    Mirrors the selling-opportunities payload ({"lat", "lng"} plus a crop
+    list). resolve maps indexed values back to listings, e.g.
+    snapshot.rows for an index built with from_snapshot().
+    """
+    lat, lng = farmer_location["lat"], farmer_location["lng"]
+    opportunities = []
+    for crop in farmer_crops:
+        found = index.nearest(lat, lng, k, crop, max_distance_km)
+        listings = [value for _, value in found]
+        if resolve is not None:
+            listings = resolve(listings)
+        markets = [_describe(listing, distance) for (distance, _), listing in zip(found, listings)]
+        best = max(markets, key=lambda m: m["price_per_unit"] or 0, default=None)
+        opportunities.append({"crop": crop, "markets": markets, "best_price": best})
+    return opportunities
+
+
+def run_benchmark(size=1_000_000, queries=200, k=5, seed=7):
+    """Compare kNN lookups with brute-force haversine scans on a synthetic snapshot"""
+    snapshot = MarketSnapshot.synthetic(size)
+    started = time.perf_counter()
+    index = MarketIndex.from_snapshot(snapshot)
+    build = time.perf_counter() - started
+
+    rng = np.random.default_rng(seed)
+    points = list(zip(rng.uniform(-14, 14, queries).tolist(), rng.uniform(-4, 44, queries).tolist()))
+    crops = snapshot.dictionaries["crop_type"]
+
+    started = time.perf_counter()
+    results = [index.nearest(lat, lng, k, crops[i % len(crops)]) for i, (lat, lng) in enumerate(points)]
+    indexed = (time.perf_counter() - started) / queries
+
+    c = snapshot.columns
+    lat_rad = np.radians(c["location_lat"])
+    lng_rad = np.radians(c["location_lng"])
+    checked = min(queries, 20)
+    started = time.perf_counter()
+    for i, (lat, lng) in enumerate(points[:checked]):
+        candidates = np.flatnonzero((c["crop_type"] == i % len(crops)) & c["is_active"])
+        phi = math.radians(lat)
+        a = (np.sin((lat_rad[candidates] - phi) / 2) ** 2 +
+             math.cos(phi) * np.cos(lat_rad[candidates]) * np.sin((lng_rad[candidates] - math.radians(lng)) / 2) ** 2)
+        distances = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+        expected = candidates[np.argsort(distances, kind="stable")[:k]]
+        assert sorted(expected.tolist()) == sorted(value for _, value in results[i]), (lat, lng)
+    brute = (time.perf_counter() - started) / checked
+
+    started = time.perf_counter()
+    for lat, lng in points:
+        index.within(lat, lng, 25.0)
+    radius = (time.perf_counter() - started) / queries
+
+    moved = [(lat, lng, -1 - i) for i, (lat, lng) in enumerate(points)]
+    started = time.perf_counter()
+    for lat, lng, value in moved:
+        index.all.insert(lat, lng, value)
+    for lat, lng, value in moved:
+        index.all.remove(lat, lng, value)
+    update = (time.perf_counter() - started) / (2 * queries)
+
+    print(f"{size} listings: index built in {build:.2f}s; {k}-nearest per crop {indexed * 1e6:.0f} us "
+          f"(brute-force scan {brute * 1e3:.1f} ms), 25 km radius {radius * 1e6:.0f} us, "
+          f"insert/remove {update * 1e6:.1f} us")
+
+
+def main():
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description="Nearest-market lookups over market_listings")
+    parser.add_argument("--url", default=SUPABASE_URL, help="Supabase (or stub server) base URL")
+    parser.add_argument("--snapshot", help="build the index from this .npz snapshot instead of the REST API")
+    parser.add_argument("--lat", type=float, default=-1.286389, help="farmer latitude (default: Nairobi)")
+    parser.add_argument("--lng", type=float, default=36.817223, help="farmer longitude")
+    parser.add_argument("--crop", action="append", dest="crops", help="crop to sell (repeatable)")
+    parser.add_argument("-k", type=int, default=5, help="markets per crop")
+    parser.add_argument("--max-km", type=float, help="ignore markets farther than this")
+    parser.add_argument("--benchmark", action="store_true", help="time lookups on a synthetic snapshot")
+    parser.add_argument("--rows", type=int, default=1_000_000, help="synthetic listings in benchmark mode")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        for size in (10_000, 100_000, args.rows):
+            run_benchmark(size)
+        return
+
+    snapshot = MarketSnapshot.load(args.snapshot) if args.snapshot else MarketSnapshot.from_rest(args.url)
+    index = MarketIndex.from_snapshot(snapshot)
+    crops = args.crops or ["maize", "beans", "tomato"]
+    started = time.perf_counter()
+    opportunities = selling_opportunities(index, {"lat": args.lat, "lng": args.lng}, crops, args.k, args.max_km,
+                                          resolve=snapshot.rows)
+    elapsed = time.perf_counter() - started
+    print(f"Resolved {len(crops)} crops against {len(index)} indexed listings in {elapsed * 1e3:.2f} ms")
+    for opportunity in opportunities:
+        print(f"\n{opportunity['crop']}:")
+        for market in opportunity["markets"]:
+            print(f"  {market['location_name']}: {market['price_per_unit']}/{market['unit']} "
+                  f"at {market['distance_km']} km")
+        if not opportunity["markets"]:
+            print("  no markets found")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+Local vegetation index engine over downloaded Sentinel-2 bands.
+
+Instead of one process API call per index (the NDVI evalscript in
+backend_test.py), the bands are fetched once as an uncompressed GeoTIFF
+(BANDS_EVALSCRIPT: B02, B03, B04, B08 and dataMask) and every index is
+derived locally:
+
+  NDVI = (NIR - RED) / (NIR + RED)
+  EVI  = 2.5 * (NIR - RED) / (NIR + 6 * RED - 7.5 * BLUE + 1)
+  NDWI = (GREEN - NIR) / (GREEN + NIR)          (McFeeters, open water)
+  SAVI = 1.5 * (NIR - RED) / (NIR + RED + 0.5)
+
+The tile is memory-mapped (geotiff.open_raster) and processed in row blocks,
+so only one block of each band is ever converted to float32; outputs are
+NaN where dataMask is 0 or an index is undefined. zonal_stats() reduces an
+index over a label image (0 = background, 1..n = fields) with bincount in a
+single pass.
+
+    raster = geotiff.open_raster("tile.tif", band_names=BANDS)
+    indices = compute_indices(raster)
+    stats = zonal_stats(indices["ndvi"], labels)
+
+    python ndvi_engine.py --stub --size 512 --bench-size 4096
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import geotiff
+
+BANDS = ("B02", "B03", "B04", "B08", "dataMask")
+BANDS_EVALSCRIPT = """
+//VERSION=3
+function setup() {
+  return {
+    input: [{bands: ["B02", "B03", "B04", "B08", "dataMask"]}],
+    output: { bands: 5, sampleType: 'FLOAT32' }
+  };
+}
+function evaluatePixel(sample) {
+  return [sample.B02, sample.B03, sample.B04, sample.B08, sample.dataMask];
+}
+"""
+DN_SCALE = 1 / 10000  # Sentinel-2 L2A digital numbers to reflectance, for UINT16 output
+BLOCK_ROWS = 256
+SAVI_L = 0.5
+
+# index -> bands it needs (blue, green, red, nir roles)
+INDEX_BANDS = {
+    "ndvi": ("red", "nir"),
+    "evi": ("blue", "red", "nir"),
+    "ndwi": ("green", "nir"),
+    "savi": ("red", "nir"),
+}
+ROLES = {"blue": "B02", "green": "B03", "red": "B04", "nir": "B08"}
+
+
+def _ratio(numerator, denominator):
+    """numerator / denominator, NaN where the denominator is 0"""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(denominator != 0, numerator / denominator, np.float32(np.nan))
+
+
+def ndvi(red, nir):
+    return _ratio(nir - red, nir + red)
+
+
+def evi(blue, red, nir):
+    return _ratio(np.float32(2.5) * (nir - red), nir + np.float32(6) * red - np.float32(7.5) * blue + np.float32(1))
+
+
+def ndwi(green, nir):
+    return _ratio(green - nir, green + nir)
+
+
+def savi(red, nir):
+    return _ratio(np.float32(1 + SAVI_L) * (nir - red), nir + red + np.float32(SAVI_L))
+
+
+INDEX_FUNCTIONS = {"ndvi": ndvi, "evi": evi, "ndwi": ndwi, "savi": savi}
+
+
+def compute_indices(raster, indices=tuple(INDEX_FUNCTIONS), block_rows=BLOCK_ROWS, scale=None, out=None):
+    """{index: float32 (height, width) array} computed block by block from a geotiff.Raster
+
+    Integer bands are multiplied by scale (default DN_SCALE); float bands are
+    taken as reflectance. Pixels with dataMask 0 are NaN in every index. Pass
+    out={index: array or np.memmap} to write results into preallocated storage.
+    """
+    names = raster.band_names or BANDS
+    roles = {role for index in indices for role in INDEX_BANDS[index]}
+    missing = [ROLES[role] for role in roles if ROLES[role] not in names]
+    if missing:
+        raise KeyError(f"raster has no {', '.join(missing)} band for {', '.join(indices)}")
+    bands = {role: raster.band(names.index(ROLES[role])) for role in roles}
+    mask = raster.band(names.index("dataMask")) if "dataMask" in names else None
+    integer = not np.issubdtype(next(iter(bands.values())).dtype, np.floating)
+    factor = np.float32(DN_SCALE if scale is None and integer else scale or 1.0)
+
+    height, width = raster.shape
+    out = out or {}
+    results = {index: out.get(index, np.empty((height, width), dtype=np.float32)) for index in indices}
+    for start in range(0, height, block_rows):
+        rows = slice(start, min(height, start + block_rows))
+        block = {role: band[rows].astype(np.float32) for role, band in bands.items()}
+        if factor != 1:
+            for values in block.values():
+                values *= factor
+        invalid = (mask[rows] == 0) if mask is not None else None
+        for index in indices:
+            values = INDEX_FUNCTIONS[index](*(block[role] for role in INDEX_BANDS[index]))
+            if invalid is not None:
+                values[invalid] = np.nan
+            results[index][rows] = values
+    return results
+
+
+def zonal_stats(values, labels, count=None):
+    """Per-label statistics of an index over a label image, in one pass
+
+    Returns {"pixels", "valid", "valid_ratio", "mean", "std", "min", "max"},
+    each an array indexed by label (entry 0 is the background). NaN values
+    (nodata) count towards pixels but not valid.
+    """
+    labels = np.asarray(labels).ravel()
+    values = np.asarray(values).ravel()
+    count = int(labels.max()) + 1 if count is None else count
+    valid = np.isfinite(values)
+    pixels = np.bincount(labels, minlength=count)
+    good_labels = labels[valid]
+    good = values[valid].astype(np.float64)
+    n = np.bincount(good_labels, minlength=count)
+    total = np.bincount(good_labels, weights=good, minlength=count)
+    squares = np.bincount(good_labels, weights=good * good, minlength=count)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = total / n
+        std = np.sqrt(np.maximum(squares / n - mean * mean, 0.0))
+        ratio = n / pixels
+    minimum = np.full(count, np.nan)
+    maximum = np.full(count, np.nan)
+    present = n > 0
+    # Sorting by label lets reduceat take each field's min and max in one call; stable sort
+    # of 16-bit keys is a radix sort
+    keys = good_labels.astype(np.uint16) if count <= 1 << 16 else good_labels
+    order = np.argsort(keys, kind="stable")
+    starts = np.concatenate(([0], np.cumsum(n)[:-1]))[present]
+    if len(order):
+        ordered = good[order]
+        minimum[present] = np.minimum.reduceat(ordered, starts)
+        maximum[present] = np.maximum.reduceat(ordered, starts)
+    return {"pixels": pixels, "valid": n, "valid_ratio": ratio, "mean": mean, "std": std,
+            "min": minimum, "max": maximum}
+
+
+def fetch_bands(path, bbox, width, height, token_manager, base_url, session=None, time_range=None):
+    """Download BANDS for a bbox (min_lng, min_lat, max_lng, max_lat) into an uncompressed GeoTIFF at path"""
+    import requests
+
+    session = session or requests.Session()
+    data_filter = {"timeRange": time_range} if time_range else {}
+    payload = {
+        "input": {"bounds": {"bbox": list(bbox)},
+                  "data": [{"type": "sentinel-2-l2a", "dataFilter": data_filter}]},
+        "evalscript": BANDS_EVALSCRIPT,
+        "output": {"width": width, "height": height,
+                   "responses": [{"identifier": "default", "format": {"type": "image/tiff"}}]},
+    }
+    headers = {"Authorization": f"Bearer {token_manager.get_token()}", "Content-Type": "application/json",
+               "Accept": "image/tiff"}
+    response = session.post(f"{base_url}/api/v1/process", json=payload, headers=headers, timeout=120)
+    response.raise_for_status()
+    with open(path, "wb") as f:
+        for chunk in response.iter_content(1 << 20):
+            f.write(chunk)
+    return geotiff.open_raster(path, BANDS)
+
+
+def grid_labels(height, width, fields_per_side):
+    """Label image of fields_per_side^2 rectangular fields with 2-pixel boundaries (label 0)"""
+    rows = np.arange(height) * fields_per_side // height
+    cols = np.arange(width) * fields_per_side // width
+    labels = (rows[:, None] * fields_per_side + cols[None, :] + 1).astype(np.int32)
+    edge_rows = np.diff(rows, prepend=-1) != 0
+    edge_cols = np.diff(cols, prepend=-1) != 0
+    labels[edge_rows | np.roll(edge_rows, 1)] = 0
+    labels[:, edge_cols | np.roll(edge_cols, 1)] = 0
+    return labels
+
+
+def run_benchmark(size=4096, fields_per_side=40, block_rows=BLOCK_ROWS, directory=None):
+    """Time the index engine on a synthetic size x size UINT16 tile written to disk"""
+    from stub_apis import _band, _vegetation
+
+    if directory is None:
+        with tempfile.TemporaryDirectory(prefix="ndvi_engine_") as directory:
+            return run_benchmark(size, fields_per_side, block_rows, directory)
+    path = os.path.join(directory, "bench.tif")
+    vegetation = _vegetation(size, size, 7)
+    tile = np.empty((size, size, len(BANDS)), dtype=np.uint16)
+    for index, name in enumerate(BANDS):
+        values = _band(name, vegetation, index, 7)
+        tile[:, :, index] = values if name == "dataMask" else np.rint(values * 10000)
+    del vegetation
+    geotiff.save_raster(path, tile, (36.0, 1e-4, -1.0, -1e-4))
+    del tile
+    megapixels = size * size / 1e6
+
+    raster = geotiff.open_raster(path, BANDS)
+    started = time.perf_counter()
+    indices = compute_indices(raster, block_rows=block_rows)
+    elapsed = time.perf_counter() - started
+    print(f"{size}x{size} UINT16 tile (memory-mapped, {os.path.getsize(path) / 1e6:.0f} MB): "
+          f"4 indices in {elapsed:.2f}s ({4 * megapixels / elapsed:.0f} Mpx-index/s)")
+
+    # Reference: whole-tile float64 arithmetic without blocking, NDVI only
+    started = time.perf_counter()
+    red = raster.band("B04") / 10000.0
+    nir = raster.band("B08") / 10000.0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        reference = (nir - red) / (nir + red)
+    reference[raster.band("dataMask") == 0] = np.nan
+    naive = time.perf_counter() - started
+    assert np.allclose(reference, indices["ndvi"], equal_nan=True, atol=1e-5)
+    print(f"  unblocked float64 NDVI alone: {naive:.2f}s (engine: {elapsed / 4:.2f}s per index)")
+
+    labels = grid_labels(size, size, fields_per_side)
+    started = time.perf_counter()
+    stats = zonal_stats(indices["ndvi"], labels)
+    zonal = time.perf_counter() - started
+    fields = fields_per_side * fields_per_side
+    print(f"  zonal stats for {fields} fields in {zonal * 1000:.0f}ms; median field NDVI "
+          f"{np.nanmedian(stats['mean'][1:]):.3f}, {np.sum(stats['valid_ratio'][1:] < 1)} fields partly nodata")
+    os.unlink(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="https://services.sentinel-hub.com", help="Sentinel Hub base URL")
+    parser.add_argument("--stub", action="store_true", help="fetch bands from an in-process stub server")
+    parser.add_argument("--stub-latency", type=float, default=0.5, help="seconds the stub adds to every request")
+    parser.add_argument("--bbox", default="36.80,-1.30,36.83,-1.27", help="min_lng,min_lat,max_lng,max_lat")
+    parser.add_argument("--size", type=int, default=512, help="width and height of the fetched tile")
+    parser.add_argument("--bench-size", type=int, default=4096, help="synthetic tile for the compute benchmark (0 to skip)")
+    parser.add_argument("--block-rows", type=int, default=BLOCK_ROWS)
+    args = parser.parse_args()
+
+    from backend_test_new import SENTINEL_CLIENT_ID, SENTINEL_CLIENT_SECRET, SENTINEL_TOKEN_PATH
+    from sentinel_auth import SentinelTokenManager
+
+    base_url = args.url
+    if args.stub:
+        from stub_server import start_stub_server
+        server, base_url = start_stub_server(latency=args.stub_latency)
+    tokens = SentinelTokenManager(SENTINEL_CLIENT_ID, SENTINEL_CLIENT_SECRET, f"{base_url}{SENTINEL_TOKEN_PATH}")
+    bbox = [float(value) for value in args.bbox.split(",")]
+    with tempfile.TemporaryDirectory(prefix="ndvi_engine_") as directory:
+        started = time.perf_counter()
+        raster = fetch_bands(os.path.join(directory, "bands.tif"), bbox, args.size, args.size, tokens, base_url)
+        fetched = time.perf_counter() - started
+        started = time.perf_counter()
+        indices = compute_indices(raster, block_rows=args.block_rows)
+        computed = time.perf_counter() - started
+        print(f"Fetched {raster.count} bands ({os.path.getsize(raster.path) / 1e6:.1f} MB) in {fetched:.2f}s, "
+              f"derived {len(indices)} indices locally in {computed * 1000:.0f}ms "
+              f"(one process call per index: ~{len(indices) * fetched:.2f}s)")
+        labels = grid_labels(*raster.shape, 4)
+        stats = zonal_stats(indices["ndvi"], labels)
+        for name, values in indices.items():
+            field = zonal_stats(values, labels)
+            print(f"  {name}: field means {np.round(field['mean'][1:5], 3).tolist()}  "
+                  f"nodata {np.isnan(values).mean():.1%}")
+        print(f"  field valid-pixel ratios: {np.round(stats['valid_ratio'][1:], 2).tolist()}")
+
+    if args.bench_size:
+        run_benchmark(args.bench_size, block_rows=args.block_rows)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+"""
+Persistent per-field NDVI time-series store with incremental updates.
+
+Each field's daily Sentinel Hub statistics live in one small .npy file of a
+structured array (day as days since 1970-01-01, mean, min, max, std, sample
+and nodata counts), sorted by day and memory-mappable. index.json records
+per field the last day already checked upstream, so update() asks the
+statistics API only for the days after it (plus RECHECK_DAYS for scenes
+ingested late): acquisition-free and cloudy days are not requested again,
+and a repeated call on the same day costs nothing.
+Trend, anomaly and season-to-date queries run locally on the stored series.
+
+    store = NDVIStore("data/ndvi")
+    client = StatisticsClient(token_manager, SENTINEL_HUB_URL)
+    store.update("field-1", SAMPLE_FIELD_POLYGON, client.fetch)
+    store.trend("field-1", days=30)
+    store.anomaly("field-1")
+    store.season_to_date("field-1", "2024-03-01")
+
+    python ndvi_timeseries.py --stub --fields 200
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+OBSERVATION = np.dtype([("day", "<i4"), ("mean", "<f4"), ("min", "<f4"), ("max", "<f4"), ("std", "<f4"),
+                        ("samples", "<i4"), ("nodata", "<i4")])
+EPOCH = date(1970, 1, 1)
+HISTORY_DAYS = 365  # days fetched for a field seen for the first time
+MAX_RANGE_DAYS = 366  # days per statistics request
+RECHECK_DAYS = 2  # already checked days requested again on the next day's update
+MIN_VALID = 0.5  # fraction of non-nodata pixels an observation needs to be used in queries
+ANOMALY_WINDOW = 15  # +/- days of year compared across earlier years
+
+STATISTICS_EVALSCRIPT = """
+//VERSION=3
+function setup() {
+  return {
+    input: [{bands: ["B04", "B08", "dataMask"]}],
+    output: [{id: "default", bands: 1, sampleType: "FLOAT32"}, {id: "dataMask", bands: 1, sampleType: "UINT8"}]
+  };
+}
+function evaluatePixel(sample) {
+  const ndvi = (sample.B08 - sample.B04) / (sample.B08 + sample.B04);
+  return {default: [ndvi], dataMask: [sample.dataMask]};
+}
+"""
+
+
+def to_day(value):
+    """Days since 1970-01-01 of a date, datetime or ISO string"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if isinstance(value, datetime):
+        value = value.date()
+    return (value - EPOCH).days
+
+
+def from_day(day):
+    return EPOCH + timedelta(days=int(day))
+
+
+def _file_name(field_id):
+    """Filesystem-safe, collision-free name for a field id"""
+    safe = re.sub(r"[^A-Za-z0-9_.-]", "_", str(field_id))
+    return safe if safe == str(field_id) else f"{safe}-{zlib.crc32(str(field_id).encode('utf-8')):08x}"
+
+
+class StatisticsClient:
+    """Fetches daily NDVI statistics for a field geometry from the Sentinel Hub statistics API"""
+
+    def __init__(self, token_manager, base_url, session=None, evalscript=STATISTICS_EVALSCRIPT):
+        import requests
+
+        self.tokens = token_manager
+        self.url = f"{base_url.rstrip('/')}/api/v1/statistics"
+        self.session = session or requests.Session()
+        self.evalscript = evalscript
+        self.requests = 0
+        self.days_requested = 0
+
+    def fetch(self, geometry, first_day, last_day):
+        """Observations (OBSERVATION array) for days first_day..last_day inclusive"""
+        from field_zonal import polygon_rings
+
+        rings = [ring.tolist() for ring in polygon_rings(geometry)]
+        if rings[0][0] != rings[0][-1]:
+            rings[0].append(rings[0][0])
+        payload = {
+            "input": {"bounds": {"geometry": {"type": "Polygon", "coordinates": rings}},
+                      "data": [{"type": "sentinel-2-l2a"}]},
+            "aggregation": {
+                "timeRange": {"from": f"{from_day(first_day).isoformat()}T00:00:00Z",
+                              "to": f"{from_day(last_day + 1).isoformat()}T00:00:00Z"},
+                "aggregationInterval": {"of": "P1D"},
+                "evalscript": self.evalscript,
+            },
+            "calculations": {"default": {"statistics": {"default": {"stats": ["mean", "min", "max", "stDev"]}}}},
+        }
+        token = self.tokens.get_token()
+        response = self.session.post(self.url, json=payload, headers={"Authorization": f"Bearer {token}"}, timeout=60)
+        if response.status_code == 401:
+            self.tokens.invalidate(token)
+            response = self.session.post(self.url, json=payload,
+                                         headers={"Authorization": f"Bearer {self.tokens.get_token()}"}, timeout=60)
+        self.requests += 1
+        self.days_requested += last_day - first_day + 1
+        response.raise_for_status()
+        return parse_statistics(response.json())
+
+
+def parse_statistics(body):
+    """OBSERVATION array from a statistics API response (intervals without statistics are skipped)"""
+    rows = []
+    for interval in body.get("data", []):
+        bands = interval.get("outputs", {}).get("default", {}).get("bands", {})
+        stats = next(iter(bands.values()), {}).get("stats", {})
+        if stats.get("mean") is None or stats.get("mean") == "NaN":
+            continue
+        rows.append((to_day(interval["interval"]["from"]), stats["mean"], stats.get("min", np.nan),
+                     stats.get("max", np.nan), stats.get("stDev", np.nan), stats.get("sampleCount", 0),
+                     stats.get("noDataCount", 0)))
+    return np.array(rows, dtype=OBSERVATION)
+
+
+class NDVIStore:
+    """Directory of per-field columnar NDVI series plus an index of what has been fetched"""
+
+    def __init__(self, root, history_days=HISTORY_DAYS, max_range_days=MAX_RANGE_DAYS, recheck_days=RECHECK_DAYS):
+        self.root = root
+        self.history_days = history_days
+        self.max_range_days = max_range_days
+        self.recheck_days = recheck_days
+        os.makedirs(root, exist_ok=True)
+        self.index_path = os.path.join(root, "index.json")
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, encoding="utf-8") as f:
+                self.index = json.load(f)
+        self._cache = {}
+
+    def _path(self, field_id):
+        return os.path.join(self.root, f"{_file_name(field_id)}.npy")
+
+    def series(self, field_id, start=None, end=None, min_valid=0.0):
+        """Stored observations of a field, optionally limited to [start, end] and to well-covered days"""
+        observations = self._cache.get(field_id)
+        if observations is None:
+            path = self._path(field_id)
+            observations = np.load(path, mmap_mode="r") if os.path.exists(path) else np.empty(0, OBSERVATION)
+            self._cache[field_id] = observations
+        if start is not None or end is not None:
+            days = observations["day"]
+            low = np.searchsorted(days, to_day(start)) if start is not None else 0
+            high = np.searchsorted(days, to_day(end), side="right") if end is not None else len(days)
+            observations = observations[low:high]
+        if min_valid:
+            samples = np.maximum(observations["samples"], 1)
+            observations = observations[(samples - observations["nodata"]) / samples >= min_valid]
+        return observations
+
+    def checked_through(self, field_id):
+        """Last day (days since epoch) already requested upstream for a field, or None"""
+        entry = self.index.get(str(field_id))
+        return entry["checked_through"] if entry else None
+
+    def append(self, field_id, observations, checked_through):
+        """Merge new observations into a field's file (newer values win on the same day)"""
+        existing = np.asarray(self.series(field_id))
+        merged = np.concatenate([existing, observations]) if len(existing) else np.asarray(observations)
+        if len(merged):
+            # Keep the last occurrence of every day, sorted by day
+            order = np.argsort(merged["day"], kind="stable")[::-1]
+            days, first = np.unique(merged["day"][order], return_index=True)
+            merged = merged[order[first]]
+        path = self._path(field_id)
+        temporary = f"{path}.tmp.npy"
+        np.save(temporary, merged)
+        os.replace(temporary, path)
+        self._cache.pop(field_id, None)
+        self.index[str(field_id)] = {"checked_through": int(checked_through), "observations": int(len(merged))}
+
+    def pending(self, field_id, today=None):
+        """(first, last) days update() would request for a field, or None when it is up to date"""
+        today = to_day(today or date.today())
+        last = self.checked_through(field_id)
+        if last is None:
+            return today - self.history_days + 1, today
+        if last >= today:
+            return None
+        # Re-request the last few checked days: scenes can be ingested a day or two late
+        return max(last + 1 - self.recheck_days, today - self.history_days + 1), today
+
+    def _fetch_range(self, geometry, fetch, first, last):
+        chunks = [fetch(geometry, start, min(last, start + self.max_range_days - 1))
+                  for start in range(first, last + 1, self.max_range_days)]
+        return np.concatenate(chunks) if chunks else np.empty(0, OBSERVATION)
+
+    def update(self, field_id, geometry, fetch, today=None, flush=True):
+        """Fetch a field's days after its last checked day up to today; returns days requested"""
+        span = self.pending(field_id, today)
+        if span is None:
+            return 0
+        self.append(field_id, self._fetch_range(geometry, fetch, *span), span[1])
+        if flush:
+            self.flush()
+        return span[1] - span[0] + 1
+
+    def update_many(self, fields, fetch, today=None, workers=8):
+        """update() every {field_id: geometry} with concurrent fetches, writing the index once
+
+        Returns the total number of field-days requested.
+        """
+        spans = {field_id: self.pending(field_id, today) for field_id in fields}
+        spans = {field_id: span for field_id, span in spans.items() if span is not None}
+        requested = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(self._fetch_range, fields[field_id], fetch, *span): field_id
+                       for field_id, span in spans.items()}
+            for future in as_completed(futures):
+                field_id = futures[future]
+                first, last = spans[field_id]
+                self.append(field_id, future.result(), last)
+                requested += last - first + 1
+        self.flush()
+        return requested
+
+    def flush(self):
+        temporary = f"{self.index_path}.tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump(self.index, f)
+        os.replace(temporary, self.index_path)
+
+    def trend(self, field_id, days=30, end=None, min_valid=MIN_VALID):
+        """Least-squares NDVI slope per day over the last `days` days (to end or the latest observation)"""
+        observations = self.series(field_id, min_valid=min_valid)
+        if end is not None:
+            observations = observations[observations["day"] <= to_day(end)]
+        if not len(observations):
+            return {"slope_per_day": None, "change": None, "observations": 0}
+        last = int(observations["day"][-1]) if end is None else to_day(end)
+        window = observations[observations["day"] > last - days]
+        if len(window) < 2:
+            return {"slope_per_day": None, "change": None, "observations": len(window)}
+        x = window["day"].astype(np.float64)
+        y = window["mean"].astype(np.float64)
+        slope, intercept = np.polyfit(x - x[0], y, 1)
+        return {"slope_per_day": float(slope), "change": float(slope * days), "observations": len(window),
+                "latest": float(y[-1]), "latest_date": from_day(window["day"][-1]).isoformat()}
+
+    def anomaly(self, field_id, day=None, window=ANOMALY_WINDOW, min_valid=MIN_VALID):
+        """z-score of the observation on (or last before) day against the same season in earlier years
+
+        With less than two earlier-year observations in the +/- window, the
+        reference is the preceding 60 days instead.
+        """
+        observations = self.series(field_id, min_valid=min_valid)
+        if day is not None:
+            observations = observations[observations["day"] <= to_day(day)]
+        if not len(observations):
+            return None
+        current = observations[-1]
+        days = observations["day"]
+        values = observations["mean"].astype(np.float64)
+        earlier = days < current["day"] - 300
+        offset = (days - current["day"]) % 365.25
+        seasonal = earlier & (np.minimum(offset, 365.25 - offset) <= window)
+        if seasonal.sum() >= 2:
+            reference, basis = values[seasonal], "seasonal"
+        else:
+            recent = (days < current["day"]) & (days >= current["day"] - 60)
+            reference, basis = values[recent], "recent"
+        if len(reference) < 2:
+            return {"date": from_day(current["day"]).isoformat(), "value": float(current["mean"]), "z": None,
+                    "basis": basis, "reference": len(reference)}
+        std = reference.std(ddof=1) or 1e-6
+        return {"date": from_day(current["day"]).isoformat(), "value": float(current["mean"]),
+                "expected": float(reference.mean()), "z": float((current["mean"] - reference.mean()) / std),
+                "basis": basis, "reference": len(reference)}
+
+    def season_to_date(self, field_id, season_start, end=None, min_valid=MIN_VALID):
+        """Mean, peak and time-integrated NDVI (NDVI-days, trapezoidal) since season_start"""
+        observations = self.series(field_id, season_start, end, min_valid=min_valid)
+        if not len(observations):
+            return {"observations": 0}
+        days = observations["day"].astype(np.float64)
+        values = observations["mean"].astype(np.float64)
+        peak = int(np.argmax(values))
+        integrated = float(np.sum((values[1:] + values[:-1]) / 2 * np.diff(days))) if len(values) > 1 else 0.0
+        return {"observations": len(observations), "mean": float(values.mean()), "peak": float(values[peak]),
+                "peak_date": from_day(observations["day"][peak]).isoformat(), "integrated": integrated,
+                "first_date": from_day(observations["day"][0]).isoformat(),
+                "last_date": from_day(observations["day"][-1]).isoformat()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="https://services.sentinel-hub.com", help="Sentinel Hub base URL")
+    parser.add_argument("--stub", action="store_true", help="use an in-process stub server")
+    parser.add_argument("--stub-latency", type=float, default=0.05, help="seconds the stub adds to every request")
+    parser.add_argument("--store", help="store directory (default: a fresh temporary one)")
+    parser.add_argument("--fields", type=int, default=200)
+    parser.add_argument("--days", type=int, default=7, help="days between the first and the follow-up update")
+    args = parser.parse_args()
+
+    from backend_test import SAMPLE_FIELD_POLYGON
+    from backend_test_new import SENTINEL_CLIENT_ID, SENTINEL_CLIENT_SECRET, SENTINEL_TOKEN_PATH
+    from sentinel_auth import SentinelTokenManager
+
+    base_url = args.url
+    if args.stub:
+        from stub_server import start_stub_server
+        server, base_url = start_stub_server(latency=args.stub_latency)
+    tokens = SentinelTokenManager(SENTINEL_CLIENT_ID, SENTINEL_CLIENT_SECRET, f"{base_url}{SENTINEL_TOKEN_PATH}")
+    client = StatisticsClient(tokens, base_url)
+    store = NDVIStore(args.store or tempfile.mkdtemp(prefix="ndvi_store_"))
+    rng = np.random.default_rng(7)
+    fields = {}
+    for i in range(args.fields):
+        shift_lat, shift_lng = rng.normal(0, 0.05, 2)
+        fields[f"field-{i}"] = [{"lat": p["lat"] + shift_lat, "lng": p["lng"] + shift_lng}
+                                for p in SAMPLE_FIELD_POLYGON]
+
+    today = date.today()
+    rounds = [("initial backfill", today - timedelta(days=args.days)), ("same day again", today - timedelta(days=args.days)),
+              (f"{args.days} days later", today)]
+    for label, day in rounds:
+        requests_before = client.requests
+        started = time.perf_counter()
+        days = store.update_many(fields, client.fetch, day)
+        elapsed = time.perf_counter() - started
+        full = len(fields) * store.history_days
+        print(f"{label}: {client.requests - requests_before} requests, {days} field-days fetched "
+              f"(full-range recompute: {full}) in {elapsed:.2f}s")
+
+    started = time.perf_counter()
+    trends = [store.trend(field_id) for field_id in fields]
+    anomalies = [store.anomaly(field_id) for field_id in fields]
+    seasons = [store.season_to_date(field_id, today - timedelta(days=120)) for field_id in fields]
+    elapsed = time.perf_counter() - started
+    print(f"Local queries (trend, anomaly, season-to-date) for {len(fields)} fields in {elapsed * 1000:.0f}ms")
+    print(f"  field-0: trend {trends[0]}")
+    print(f"  field-0: anomaly {anomalies[0]}")
+    print(f"  field-0: season {seasons[0]}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+"""
+Concurrent probe runner for the backend smoke tests.
+
+Independent probe functions run in a thread pool and share one pooled
+keep-alive ProbeSession. Every probe has a deadline: requests made while it
+runs get a timeout no longer than the time it has left, and the runner stops
+waiting for it once the deadline passes. The suite therefore finishes in
+roughly the time of its slowest probe instead of the sum of all of them.
+
+The session records every request per endpoint (method, host and path):
+total latency percentiles, DNS / TCP connect / TLS / time-to-first-byte
+breakdown from instrumented urllib3 connections, and payload size. Output a
+probe prints is buffered per thread and flushed as one block when it ends,
+so parallel probes do not interleave their logs. A probe abandoned at its
+deadline keeps running in the background; its output is discarded and
+probe_abandoned() tells its code not to record results.
+
+    session = ProbeSession()
+    results = run_probes([Probe("weather", test_weather)], workers=8, deadline=30)
+    print(session.stats.report())
+"""
+
+import math
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from io import StringIO
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+DEFAULT_TIMEOUT = 30  # seconds per request, capped by the probe's remaining deadline
+DEFAULT_DEADLINE = 60  # seconds per probe, from when it starts running
+QUEUE_POLL = 0.05  # seconds between checks while every pending probe is still queued
+DEFAULT_POOL_SIZE = 16
+PERCENTILES = (50, 95, 99)
+
+# Per-thread state: the timings of the request in flight, the running probe's deadline, its output buffer
+# and the event set when the runner stops waiting for it
+_local = threading.local()
+
+
+class ProbeDeadlineExceeded(requests.Timeout):
+    """Raised when a probe issues a request after its deadline has passed"""
+
+
+class _TimedConnectionMixin:
+    """Records DNS, TCP connect, TLS handshake and time-to-first-byte of a urllib3 connection"""
+
+    def _new_conn(self):
+        timings = getattr(_local, "timings", None)
+        host = self._dns_host
+        started = time.perf_counter()
+        try:
+            addresses = [info[4][0] for info in socket.getaddrinfo(host, self.port, 0, socket.SOCK_STREAM)]
+        except socket.gaierror:
+            # Let urllib3 raise its usual NameResolutionError
+            return super()._new_conn()
+        resolved = time.perf_counter()
+        error = None
+        try:
+            for address in dict.fromkeys(addresses):
+                self._dns_host = address
+                try:
+                    sock = super()._new_conn()
+                    break
+                except (NewConnectionError, ConnectTimeoutError) as e:
+                    error = e
+            else:
+                raise error
+        finally:
+            self._dns_host = host
+        if timings is not None:
+            timings["dns"] = resolved - started
+            timings["connect"] = time.perf_counter() - resolved
+        return sock
+
+    def connect(self):
+        started = time.perf_counter()
+        super().connect()
+        timings = getattr(_local, "timings", None)
+        if timings is not None:
+            timings["tls"] = max(0.0, time.perf_counter() - started - timings["dns"] - timings["connect"])
+
+    def request(self, *args, **kwargs):
+        self._request_started = time.perf_counter()
+        return super().request(*args, **kwargs)
+
+    def getresponse(self, *args, **kwargs):
+        response = super().getresponse(*args, **kwargs)
+        timings = getattr(_local, "timings", None)
+        if timings is not None:
+            timings["ttfb"] = time.perf_counter() - self._request_started
+        return response
+
+
+class TimedHTTPConnection(_TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(_TimedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedAdapter(HTTPAdapter):
+    """HTTPAdapter whose pools use the instrumented connection classes"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": TimedHTTPConnectionPool,
+                                                   "https": TimedHTTPSConnectionPool}
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+class EndpointStats:
+    """Samples of one endpoint"""
+
+    def __init__(self):
+        self.latencies = []
+        self.dns = []
+        self.connect = []
+        self.tls = []
+        self.ttfb = []
+        self.bytes = 0
+        self.statuses = {}
+        self.errors = 0
+        self.new_connections = 0
+
+
+class LatencyStats:
+    """Per-endpoint latency, timing breakdown and payload size of every request"""
+
+    def __init__(self):
+        self.endpoints = {}
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, elapsed, timings, size=0, status=None):
+        with self.lock:
+            stats = self.endpoints.setdefault(endpoint, EndpointStats())
+            stats.latencies.append(elapsed)
+            if timings.get("ttfb") is not None:
+                stats.ttfb.append(timings["ttfb"])
+            if "dns" in timings:
+                stats.new_connections += 1
+                stats.dns.append(timings["dns"])
+                stats.connect.append(timings["connect"])
+                stats.tls.append(timings.get("tls", 0.0))
+            stats.bytes += size
+            if status is None:
+                stats.errors += 1
+            else:
+                stats.statuses[status] = stats.statuses.get(status, 0) + 1
+
+    def summary(self):
+        """{endpoint: {count, p50/p95/p99, dns/connect/tls/ttfb medians, bytes, statuses}} in milliseconds"""
+        summary = {}
+        with self.lock:
+            for endpoint, stats in self.endpoints.items():
+                latencies = sorted(stats.latencies)
+                entry = {"count": len(latencies), "errors": stats.errors, "statuses": dict(stats.statuses),
+                         "new_connections": stats.new_connections,
+                         "avg_bytes": stats.bytes / max(1, len(latencies) - stats.errors)}
+                for p in PERCENTILES:
+                    entry[f"p{p}_ms"] = percentile(latencies, p) * 1000
+                for name in ("dns", "connect", "tls", "ttfb"):
+                    values = sorted(getattr(stats, name))
+                    entry[f"{name}_ms"] = percentile(values, 50) * 1000 if values else None
+                summary[endpoint] = entry
+        return summary
+
+    def report(self):
+        def ms(value):
+            return "-" if value is None else f"{value:.0f}"
+
+        lines = [f"{'endpoint':<70} {'n':>3} {'p50':>6} {'p95':>6} {'p99':>6} {'dns':>5} {'conn':>5} "
+                 f"{'tls':>5} {'ttfb':>6} {'bytes':>8}"]
+        for endpoint, entry in sorted(self.summary().items(), key=lambda item: -item[1]["p50_ms"]):
+            lines.append(f"{endpoint[:70]:<70} {entry['count']:>3} {ms(entry['p50_ms']):>6} {ms(entry['p95_ms']):>6} "
+                         f"{ms(entry['p99_ms']):>6} {ms(entry['dns_ms']):>5} {ms(entry['connect_ms']):>5} "
+                         f"{ms(entry['tls_ms']):>5} {ms(entry['ttfb_ms']):>6} {entry['avg_bytes']:>8.0f}")
+        return "\n".join(lines)
+
+
+def endpoint_name(method, url):
+    parts = urlsplit(url)
+    return f"{method} {parts.netloc}{parts.path}"
+
+
+class ProbeSession(requests.Session):
+    """Thread-safe pooled keep-alive session that times every request and honours probe deadlines"""
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT, stats=None):
+        super().__init__()
+        self.timeout = timeout
+        self.stats = stats or LatencyStats()
+        adapter = TimedAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        deadline = getattr(_local, "deadline", None)
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise ProbeDeadlineExceeded(f"probe deadline exceeded before {method} {url}")
+            timeout = kwargs["timeout"]
+            if isinstance(timeout, tuple):
+                kwargs["timeout"] = tuple(min(t, remaining) if t else remaining for t in timeout)
+            else:
+                kwargs["timeout"] = min(timeout, remaining)
+        return super().request(method, url, **kwargs)
+
+    def send(self, request, **kwargs):
+        timings = {}
+        _local.timings = timings
+        started = time.perf_counter()
+        try:
+            response = super().send(request, **kwargs)
+        except requests.RequestException:
+            self.stats.record(endpoint_name(request.method, request.url), time.perf_counter() - started, timings)
+            raise
+        finally:
+            _local.timings = None
+        size = len(response.content) if not kwargs.get("stream") else int(response.headers.get("Content-Length", 0))
+        self.stats.record(endpoint_name(request.method, request.url), time.perf_counter() - started, timings,
+                          size, response.status_code)
+        return response
+
+
+class _ThreadOutput:
+    """sys.stdout stand-in that sends writes from probe threads to their own buffer"""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        buffer = getattr(_local, "output", None)
+        return (buffer or self.stream).write(text)
+
+    def flush(self):
+        if getattr(_local, "output", None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def probe_abandoned():
+    """True in a probe thread the runner has given up on after its deadline"""
+    abandoned = getattr(_local, "abandoned", None)
+    return abandoned is not None and abandoned.is_set()
+
+
+class Probe:
+    """A named zero-argument check with its own deadline in seconds"""
+
+    def __init__(self, name, func, deadline=None):
+        self.name = name
+        self.func = func
+        self.deadline = deadline
+
+
+class ProbeResult:
+    def __init__(self, name, status, elapsed, error=None):
+        self.name = name
+        self.status = status  # "ok", "error" or "timeout"
+        self.elapsed = elapsed
+        self.error = error
+
+
+def _run_probe(probe, budget, abandoned=None, deadlines=None):
+    """Run one probe with budget seconds from now, publishing its deadline in deadlines[probe.name]"""
+    deadline = time.monotonic() + budget
+    if deadlines is not None:
+        deadlines[probe.name] = deadline
+    _local.deadline = deadline
+    _local.output = StringIO()
+    _local.abandoned = abandoned
+    started = time.perf_counter()
+    try:
+        probe.func()
+        status, error = "ok", None
+    except Exception as e:
+        status, error = "error", e
+        print(f"Probe {probe.name} raised: {str(e)}")
+    finally:
+        _local.deadline = None
+        output, _local.output = _local.output.getvalue(), None
+    return ProbeResult(probe.name, status, time.perf_counter() - started, error), output
+
+
+def run_probes(probes, workers=None, deadline=DEFAULT_DEADLINE):
+    """Run probes concurrently and return their ProbeResults in input order
+
+    Each probe's buffered output is printed as soon as it finishes. A
+    probe's deadline starts when it starts running, not while it waits for
+    a worker, and a probe still running at its deadline is reported as
+    "timeout"; its outstanding
+    requests are already bounded by the same deadline, and its output is
+    dropped. While such a probe may still be running, sys.stdout stays
+    wrapped so its prints keep going to its own (discarded) buffer.
+    """
+    probes = list(probes)
+    results = {}
+    deadlines = {}  # probe name -> deadline, set by _run_probe when the probe starts
+    stdout = sys.stdout
+    wrapped = isinstance(stdout, _ThreadOutput)
+    if not wrapped:
+        sys.stdout = _ThreadOutput(stdout)
+    real_stdout = sys.stdout.stream
+    abandoned_any = False
+    executor = ThreadPoolExecutor(max_workers=workers or len(probes) or 1, thread_name_prefix="probe")
+    try:
+        futures = {}
+        for probe in probes:
+            abandoned = threading.Event()
+            futures[executor.submit(_run_probe, probe, probe.deadline or deadline, abandoned, deadlines)] = (
+                probe, abandoned)
+        pending = set(futures)
+        while pending:
+            running = [deadlines[futures[f][0].name] for f in pending if futures[f][0].name in deadlines]
+            # Queued probes have no deadline yet; poll until one starts
+            timeout = max(0.0, min(running) - time.monotonic()) if running else QUEUE_POLL
+            done, pending = wait(pending, timeout=timeout, return_when="FIRST_COMPLETED")
+            for future in done:
+                result, output = future.result()
+                results[result.name] = result
+                real_stdout.write(output)
+            now = time.monotonic()
+            for future in [f for f in pending if deadlines.get(futures[f][0].name, now + 1) <= now]:
+                probe, abandoned = futures[future]
+                abandoned.set()
+                abandoned_any = True
+                pending.discard(future)
+                budget = probe.deadline or deadline
+                results[probe.name] = ProbeResult(probe.name, "timeout", now - deadlines[probe.name] + budget)
+                real_stdout.write(f"\n⏱ Probe {probe.name} exceeded its {probe.deadline or deadline:g}s deadline\n")
+    finally:
+        if not wrapped and not abandoned_any:
+            sys.stdout = stdout
+        executor.shutdown(wait=False, cancel_futures=True)
+    return [results[probe.name] for probe in probes]
+
+
+def run_sequential(probes, deadline=DEFAULT_DEADLINE):
+    """Run probes one after another (same deadlines and stats), for comparison"""
+    results = []
+    for probe in probes:
+        result, output = _run_probe(probe, probe.deadline or deadline)
+        sys.stdout.write(output)
+        results.append(result)
+    return results
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+Sentinel Hub OAuth2 client-credentials token manager shared across processes.
+
+A token is reused until `margin` seconds before its expires_in runs out.
+Lookups are served from memory; on a miss one thread per process takes the
+refresh (the others wait for its result), and that thread first checks an
+on-disk cache under an exclusive fcntl lock, so concurrent workers perform a
+single auth handshake between them and pick up each other's tokens. The
+cache file holds the token and its absolute expiry, is written atomically
+with mode 0600 and is keyed by token URL and client id. Optionally a daemon
+thread refreshes the token `refresh_ahead` seconds before expiry so callers
+never wait on the round trip; invalidate() drops a token the API rejected.
+
+    tokens = SentinelTokenManager(SENTINEL_CLIENT_ID, SENTINEL_CLIENT_SECRET, SENTINEL_TOKEN_URL)
+    headers = {"Authorization": f"Bearer {tokens.get_token()}"}
+
+    python sentinel_auth.py --stub --processes 8 --calls 100
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to per-process caching only
+    fcntl = None
+
+SENTINEL_TOKEN_URL = "https://services.sentinel-hub.com/auth/realms/main/protocol/openid-connect/token"
+CACHE_DIR = os.environ.get("SENTINEL_TOKEN_CACHE") or os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "cropgenius")
+MARGIN = 60  # seconds before expiry a token is no longer handed out
+REFRESH_AHEAD = 300  # seconds before expiry the background thread renews it
+
+
+class TokenError(Exception):
+    """Raised when the token endpoint does not return an access token"""
+
+
+class SentinelTokenManager:
+    """Caches a client-credentials token in memory and in a file-locked on-disk cache"""
+
+    def __init__(self, client_id, client_secret, token_url=SENTINEL_TOKEN_URL, cache_dir=CACHE_DIR, margin=MARGIN,
+                 refresh_ahead=REFRESH_AHEAD, background=False, session=None, timeout=30):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.token_url = token_url
+        self.margin = margin
+        self.refresh_ahead = max(refresh_ahead, margin)
+        self.session = session or requests.Session()
+        self.timeout = timeout
+        self.path = None
+        if cache_dir:
+            key = hashlib.sha256(f"{token_url}\n{client_id}".encode("utf-8")).hexdigest()[:16]
+            self.path = os.path.join(cache_dir, f"sentinel_token_{key}.json")
+        self.token = None
+        self.expires_at = 0.0
+        self.lock = threading.Lock()
+        self.fetches = 0
+        self.disk_hits = 0
+        self.memory_hits = 0
+        self.last_source = None
+        self._stop = threading.Event()
+        self._refresher = None
+        if background:
+            self._refresher = threading.Thread(target=self._refresh_loop, name="sentinel-token", daemon=True)
+            self._refresher.start()
+
+    def get_token(self):
+        """A token valid for at least `margin` more seconds"""
+        token, expires_at = self.token, self.expires_at
+        if token and expires_at - time.time() > self.margin:
+            self.memory_hits += 1
+            self.last_source = "memory"
+            return token
+        return self._refresh(self.margin)
+
+    def expires_in(self):
+        """Seconds until the current token expires (0 without one)"""
+        return max(0.0, self.expires_at - time.time())
+
+    def invalidate(self, token=None):
+        """Forget a token the API rejected (only if it is still the current one) and its disk copy"""
+        with self.lock:
+            if token is not None and token != self.token:
+                return
+            rejected, self.token, self.expires_at = self.token, None, 0.0
+            if self.path:
+                with self._file_lock():
+                    cached = self._read_cache()
+                    if cached and cached["access_token"] == rejected:
+                        os.unlink(self.path)
+
+    def close(self):
+        """Stop the background refresher"""
+        self._stop.set()
+
+    def _refresh(self, min_remaining):
+        # One thread per process refreshes; the rest block on the lock and find the new token
+        with self.lock:
+            if self.token and self.expires_at - time.time() > min_remaining:
+                self.last_source = "memory"
+                return self.token
+            with self._file_lock():
+                cached = self._read_cache()
+                if cached and cached["expires_at"] - time.time() > min_remaining:
+                    self.disk_hits += 1
+                    self.last_source = "disk"
+                else:
+                    cached = self._fetch()
+                    self._write_cache(cached)
+                    self.last_source = "fetched"
+            self.token, self.expires_at = cached["access_token"], cached["expires_at"]
+            return self.token
+
+    def _fetch(self):
+        requested = time.time()
+        response = self.session.post(self.token_url, data={"grant_type": "client_credentials",
+                                                           "client_id": self.client_id,
+                                                           "client_secret": self.client_secret},
+                                     headers={"Content-Type": "application/x-www-form-urlencoded"},
+                                     timeout=self.timeout)
+        self.fetches += 1
+        response.raise_for_status()
+        body = response.json()
+        if "access_token" not in body:
+            raise TokenError(f"Response missing access_token: {json.dumps(body)}")
+        # Count the lifetime from when the request was sent, so the round trip is not borrowed from it
+        return {"access_token": body["access_token"], "expires_at": requested + float(body.get("expires_in", 3600))}
+
+    def _file_lock(self):
+        return _FileLock(f"{self.path}.lock" if self.path and fcntl else None)
+
+    def _read_cache(self):
+        if not self.path:
+            return None
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                cached = json.load(f)
+            return cached if cached.get("access_token") else None
+        except (OSError, ValueError):
+            return None
+
+    def _write_cache(self, cached):
+        if not self.path:
+            return
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        descriptor, temporary = tempfile.mkstemp(dir=directory, prefix=".sentinel_token_")
+        try:
+            with os.fdopen(descriptor, "w", encoding="utf-8") as f:
+                json.dump(cached, f)
+            os.chmod(temporary, 0o600)
+            os.replace(temporary, self.path)
+        except OSError:
+            if os.path.exists(temporary):
+                os.unlink(temporary)
+
+    def _refresh_loop(self):
+        while not self._stop.is_set():
+            remaining = self.expires_at - time.time()
+            if remaining > self.refresh_ahead:
+                self._stop.wait(remaining - self.refresh_ahead)
+                continue
+            try:
+                self._refresh(self.refresh_ahead)
+            except (requests.RequestException, TokenError, ValueError):
+                self._stop.wait(min(30.0, max(1.0, remaining / 4)))
+
+
+class _FileLock:
+    """Exclusive flock on a lock file next to the cache; a no-op without a path"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def __enter__(self):
+        if self.path:
+            os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+            self.file = open(self.path, "a")
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if self.file:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+
+
+def _worker(token_url, cache_dir, calls, results):
+    from backend_test_new import SENTINEL_CLIENT_ID, SENTINEL_CLIENT_SECRET
+
+    tokens = SentinelTokenManager(SENTINEL_CLIENT_ID, SENTINEL_CLIENT_SECRET, token_url, cache_dir)
+    started = time.perf_counter()
+    first = None
+    for _ in range(calls):
+        tokens.get_token()
+        first = first or time.perf_counter() - started
+    results.put((first, time.perf_counter() - started, tokens.fetches, tokens.disk_hits))
+
+
+def main():
+    import multiprocessing
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--token-url", default=SENTINEL_TOKEN_URL)
+    parser.add_argument("--stub", action="store_true", help="use an in-process stub server as the token endpoint")
+    parser.add_argument("--stub-latency", type=float, default=0.2, help="seconds the stub adds to every request")
+    parser.add_argument("--processes", type=int, default=8, help="worker processes sharing the cache")
+    parser.add_argument("--calls", type=int, default=100, help="get_token() calls per process")
+    parser.add_argument("--cache-dir", help="token cache directory (default: a fresh temporary one)")
+    args = parser.parse_args()
+
+    token_url = args.token_url
+    server = None
+    if args.stub:
+        from stub_server import start_stub_server
+        server, base_url = start_stub_server(latency=args.stub_latency)
+        token_url = f"{base_url}/oauth/token"
+    cache_dir = args.cache_dir or tempfile.mkdtemp(prefix="sentinel_tokens_")
+
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=_worker, args=(token_url, cache_dir, args.calls, results))
+               for _ in range(args.processes)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    outcomes = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+
+    fetches = sum(outcome[2] for outcome in outcomes)
+    print(f"{args.processes} processes x {args.calls} get_token() calls in {elapsed:.2f}s")
+    print(f"  auth handshakes: {fetches} (without the shared cache: {args.processes}, "
+          f"or {args.processes * args.calls} fetching per call)")
+    print(f"  disk cache hits: {sum(outcome[3] for outcome in outcomes)}")
+    print(f"  first token per process: {', '.join(f'{outcome[0] * 1000:.0f}ms' for outcome in outcomes)}")
+    print(f"  all calls per process: {', '.join(f'{outcome[1] * 1000:.0f}ms' for outcome in outcomes)}")
+    if server is not None:
+        print(f"  tokens issued by the stub: {server.state.tokens_issued}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,276 @@
+"""
+Canned stand-ins for the third-party APIs the probes call.
+
+Each handler takes (state, query, headers, body) and returns
+(status, content_type, payload bytes). Payloads follow the shape of the real
+services closely enough for backend_test.py / backend_test_new.py and the
+client modules: values are deterministic per location so repeated runs and
+benchmarks see identical responses.
+
+  OpenWeatherMap  GET  /data/2.5/weather, /data/2.5/forecast
+  Sentinel Hub    POST /oauth/token, /auth/realms/main/protocol/openid-connect/token,
+                       /api/v1/process (GeoTIFF; named B0x/dataMask/SCL inputs get
+                       plausible reflectance), /api/v1/statistics
+  PlantNet        POST /v2/identify/<project>
+  Supabase auth   POST /auth/v1/token
+"""
+
+import json
+import math
+import re
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+from urllib.parse import parse_qsl
+
+import numpy as np
+
+import geotiff
+from geotiff import SAMPLE_TYPES
+
+FORECAST_STEPS = 40  # 5 days x 3 hours, as returned by /data/2.5/forecast
+FORECAST_STEP = 3 * 3600
+KELVIN = 273.15
+WEATHER_STATES = (
+    (800, "Clear", "clear sky", "01d"),
+    (802, "Clouds", "scattered clouds", "03d"),
+    (804, "Clouds", "overcast clouds", "04d"),
+    (500, "Rain", "light rain", "10d"),
+    (211, "Thunderstorm", "thunderstorm", "11d"),
+)
+
+
+def _json(status, body):
+    return status, "application/json", json.dumps(body).encode("utf-8")
+
+
+def _seed(*values):
+    return zlib.crc32(",".join(f"{v:.2f}" if isinstance(v, float) else str(v) for v in values).encode())
+
+
+def _coordinates(query):
+    try:
+        return float(query.get("lat", 0)), float(query.get("lon", query.get("lng", 0)))
+    except ValueError:
+        return None
+
+
+def _conditions(lat, lon, timestamp):
+    """Deterministic (temperature K, humidity, wind, weather state) for a place and time"""
+    seed = _seed(round(lat, 2), round(lon, 2))
+    hour = (timestamp // 3600 + lon / 15) % 24
+    daily = math.sin((hour - 9) / 24 * 2 * math.pi)
+    temp = KELVIN + 31 - abs(lat) * 0.45 + 6 * daily + (seed % 40) / 10 - 2
+    humidity = 45 + (seed >> 8) % 40 - int(15 * daily)
+    wind = 1.0 + (seed >> 16) % 60 / 10
+    state = WEATHER_STATES[(seed + int(timestamp // FORECAST_STEP)) % len(WEATHER_STATES)]
+    return round(temp, 2), humidity, round(wind, 1), state
+
+
+def _weather_entry(lat, lon, timestamp):
+    temp, humidity, wind, (code, main, description, icon) = _conditions(lat, lon, timestamp)
+    return {
+        "dt": int(timestamp),
+        "main": {"temp": temp, "feels_like": round(temp + 0.8, 2), "temp_min": round(temp - 1.2, 2),
+                 "temp_max": round(temp + 1.4, 2), "pressure": 1012, "humidity": humidity},
+        "weather": [{"id": code, "main": main, "description": description, "icon": icon}],
+        "clouds": {"all": 0 if code == 800 else 40 if code == 802 else 90},
+        "wind": {"speed": wind, "deg": _seed(lat, lon) % 360},
+    }
+
+
+def owm_current(state, query, headers, body):
+    location = _coordinates(query)
+    if location is None:
+        return _json(400, {"cod": "400", "message": "wrong latitude"})
+    lat, lon = location
+    entry = _weather_entry(lat, lon, time.time())
+    entry.update({"coord": {"lon": lon, "lat": lat}, "name": "Stub", "cod": 200,
+                  "sys": {"country": "KE"}, "timezone": 10800})
+    return _json(200, entry)
+
+
+def owm_forecast(state, query, headers, body):
+    location = _coordinates(query)
+    if location is None:
+        return _json(400, {"cod": "400", "message": "wrong latitude"})
+    lat, lon = location
+    start = (int(time.time()) // FORECAST_STEP + 1) * FORECAST_STEP
+    steps = min(FORECAST_STEPS, int(query.get("cnt", FORECAST_STEPS)))
+    entries = []
+    for step in range(steps):
+        timestamp = start + step * FORECAST_STEP
+        entry = _weather_entry(lat, lon, timestamp)
+        entry["pop"] = round(((_seed(lat, lon, step) % 100) / 100) ** 2, 2)
+        entry["dt_txt"] = datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        entries.append(entry)
+    return _json(200, {"cod": "200", "message": 0, "cnt": len(entries), "list": entries,
+                       "city": {"name": "Stub", "coord": {"lat": lat, "lon": lon}, "timezone": 10800}})
+
+
+def sentinel_token(state, query, headers, body):
+    form = dict(parse_qsl(body.decode("utf-8", "replace")))
+    if form.get("grant_type") != "client_credentials" or not form.get("client_id"):
+        return _json(400, {"error": "invalid_request", "error_description": "client credentials required"})
+    token = state.issue_token()
+    return _json(200, {"access_token": token, "token_type": "Bearer", "expires_in": int(state.token_ttl),
+                       "not-before-policy": 0})
+
+
+def _bearer(headers):
+    value = headers.get("Authorization") or ""
+    return value[7:] if value.startswith("Bearer ") else None
+
+
+def _bounds(request):
+    """(min_lng, min_lat, max_lng, max_lat) of a process request's bbox or polygon"""
+    bounds = request.get("input", {}).get("bounds", {})
+    if bounds.get("bbox"):
+        return tuple(bounds["bbox"])
+    rings = bounds.get("geometry", {}).get("coordinates") or [[[0.0, 0.0], [0.01, 0.01]]]
+    points = [point for ring in rings for point in ring]
+    lngs = [point[0] for point in points]
+    lats = [point[1] for point in points]
+    return min(lngs), min(lats), max(lngs), max(lats)
+
+
+def _vegetation(width, height, seed):
+    """Smooth synthetic canopy density in [0, 1] with field-like patches"""
+    fx = np.linspace(0.0, 1.0, width, dtype=np.float32)[None, :]
+    fy = np.linspace(0.0, 1.0, height, dtype=np.float32)[:, None]
+    wave = np.sin(fx * 6.3 + seed % 7) * np.cos(fy * 4.1 + seed % 3)
+    return np.clip(0.55 + 0.45 * wave * (0.6 + 0.4 * fx), 0.0, 1.0)
+
+
+def _band(name, vegetation, index, seed):
+    """Plausible surface reflectance (or mask / scene class) of a Sentinel-2 band over the synthetic canopy"""
+    height, width = vegetation.shape
+    if name == "dataMask":
+        # A no-data wedge in one corner, like the edge of a swath
+        rows, cols = np.indices((height, width))
+        return (rows + cols >= (width + height) // 12).astype(np.float32)
+    if name == "SCL":
+        scene = np.where(vegetation > 0.3, 4, 5).astype(np.float32)  # vegetation / not vegetated
+        scene[:height // 8, width // 2:] = 9  # a cloud bank
+        return scene
+    reflectance = {"B02": (0.07, -0.04), "B03": (0.10, -0.04), "B04": (0.20, -0.16), "B05": (0.22, -0.02),
+                   "B08": (0.20, 0.30), "B8A": (0.21, 0.29), "B11": (0.30, -0.12), "B12": (0.25, -0.15)}
+    base, gain = reflectance.get(name, (0.35, 0.45 * math.cos(index + seed % 5)))
+    return (base + gain * vegetation).astype(np.float32)
+
+
+def sentinel_process(state, query, headers, body):
+    if not state.check_token(_bearer(headers)):
+        return _json(401, {"error": {"status": 401, "reason": "Unauthorized", "message": "Invalid or expired token"}})
+    try:
+        request = json.loads(body or b"{}")
+        output = request.get("output", {})
+        width = int(output.get("width", 256))
+        height = int(output.get("height", 256))
+    except (ValueError, AttributeError):
+        return _json(400, {"error": {"status": 400, "reason": "Bad Request", "message": "invalid JSON"}})
+    if not (0 < width <= 2500 and 0 < height <= 2500):
+        return _json(400, {"error": {"status": 400, "reason": "Bad Request", "message": "width/height out of range"}})
+    evalscript = request.get("evalscript", "")
+    band_match = re.search(r"bands\s*:\s*(\d+)", evalscript)
+    type_match = re.search(r"sampleType\s*:\s*['\"](\w+)['\"]", evalscript)
+    count = int(band_match.group(1)) if band_match else 1
+    sample_type = type_match.group(1).upper() if type_match else "FLOAT32"
+    dtype = SAMPLE_TYPES.get(sample_type, np.float32)
+    # Bands named in the input list are served in that order when they match the output band count
+    inputs = re.findall(r"['\"]((?:B\d[\dA]|SCL|dataMask))['\"]", evalscript.split("output")[0])
+    names = inputs if len(inputs) == count else [None] * count
+    min_lng, min_lat, max_lng, max_lat = _bounds(request)
+    seed = _seed(min_lng, min_lat, max_lng, max_lat)
+    vegetation = _vegetation(width, height, seed)
+    pixels = np.empty((height, width, count), dtype=np.float32)
+    for index, name in enumerate(names):
+        pixels[:, :, index] = _band(name, vegetation, index, seed)
+    if dtype != np.float32:
+        # Integer outputs carry reflectance scaled like Sentinel Hub DN (x10000 for UINT16, x255 for UINT8)
+        scale = np.array([1.0 if name in ("dataMask", "SCL") else (10000.0 if dtype == np.uint16 else 255.0)
+                          for name in names], dtype=np.float32)
+        pixels = np.clip(np.rint(pixels * scale), 0, np.iinfo(dtype).max).astype(dtype)
+    transform = (min_lng, (max_lng - min_lng) / width, max_lat, -(max_lat - min_lat) / height)
+    return 200, "image/tiff", geotiff.encode(pixels, transform)
+
+
+def sentinel_statistics(state, query, headers, body):
+    if not state.check_token(_bearer(headers)):
+        return _json(401, {"error": {"status": 401, "reason": "Unauthorized", "message": "Invalid or expired token"}})
+    try:
+        request = json.loads(body or b"{}")
+        time_range = request["aggregation"]["timeRange"]
+        start = datetime.fromisoformat(time_range["from"].replace("Z", "+00:00"))
+        end = datetime.fromisoformat(time_range["to"].replace("Z", "+00:00"))
+    except (ValueError, KeyError, TypeError):
+        return _json(400, {"error": {"status": 400, "reason": "Bad Request", "message": "invalid aggregation"}})
+    seed = _seed(json.dumps(request.get("input", {}).get("bounds", {}), sort_keys=True))
+    data = []
+    day = start
+    while day < end and len(data) < 366:
+        following = day + timedelta(days=1)
+        # Roughly one clear Sentinel-2 acquisition every five days
+        if (day.toordinal() + seed) % 5 == 0:
+            mean = 0.25 + 0.4 * (0.5 + 0.5 * math.sin(day.timetuple().tm_yday / 365 * 2 * math.pi + seed % 5))
+            data.append({
+                "interval": {"from": day.strftime("%Y-%m-%dT%H:%M:%SZ"), "to": following.strftime("%Y-%m-%dT%H:%M:%SZ")},
+                "outputs": {"default": {"bands": {"B0": {"stats": {
+                    "min": round(mean - 0.3, 4), "max": round(mean + 0.25, 4), "mean": round(mean, 4),
+                    "stDev": 0.08, "sampleCount": 65536, "noDataCount": (seed + day.day) % 900}}}}},
+            })
+        day = following
+    return _json(200, {"data": data, "status": "OK"})
+
+
+def plantnet_identify(state, query, headers, body):
+    if not query.get("api-key"):
+        return _json(401, {"statusCode": 401, "error": "Unauthorized", "message": "Invalid API key"})
+    images = body.count(b'name="images"')
+    if not images:
+        return _json(400, {"statusCode": 400, "error": "Bad Request", "message": "images is required"})
+    return _json(200, {
+        "query": {"project": "all", "images": [f"stub-image-{i}" for i in range(images)], "organs": ["leaf"]},
+        "language": "en",
+        "preferedReferential": "k-world-flora",
+        "bestMatch": "Zea mays L.",
+        "results": [
+            {"score": 0.83, "species": {"scientificNameWithoutAuthor": "Zea mays", "scientificNameAuthorship": "L.",
+                                        "genus": {"scientificNameWithoutAuthor": "Zea"},
+                                        "family": {"scientificNameWithoutAuthor": "Poaceae"},
+                                        "commonNames": ["Maize", "Corn"]},
+             "gbif": {"id": "5290052"}},
+            {"score": 0.07, "species": {"scientificNameWithoutAuthor": "Sorghum bicolor",
+                                        "scientificNameAuthorship": "(L.) Moench",
+                                        "genus": {"scientificNameWithoutAuthor": "Sorghum"},
+                                        "family": {"scientificNameWithoutAuthor": "Poaceae"},
+                                        "commonNames": ["Sorghum"]},
+             "gbif": {"id": "2705180"}},
+        ],
+        "version": "stub",
+        "remainingIdentificationRequests": 499,
+    })
+
+
+def supabase_auth(state, query, headers, body):
+    return _json(400, {"error": "invalid_grant", "error_description": "Invalid login credentials"})
+
+
+# (method, path prefix, handler); the first match wins
+ROUTES = [
+    ("GET", "/data/2.5/weather", owm_current),
+    ("GET", "/data/2.5/forecast", owm_forecast),
+    ("POST", "/oauth/token", sentinel_token),
+    ("POST", "/auth/realms/main/protocol/openid-connect/token", sentinel_token),
+    ("POST", "/api/v1/process", sentinel_process),
+    ("POST", "/api/v1/statistics", sentinel_statistics),
+    ("POST", "/v2/identify/", plantnet_identify),
+    ("POST", "/auth/v1/token", supabase_auth),
+]
+
+
+def find_route(method, path):
+    for route_method, prefix, handler in ROUTES:
+        if method == route_method and path.startswith(prefix):
+            return handler
+    return None
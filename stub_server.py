@@ -0,0 +1,676 @@
+#!/usr/bin/env python3
+"""
+Local PostgREST-compatible stub server for offline benchmarks.
+
+Implements the subset of the Supabase REST API used by the ingestion scripts:
+bulk inserts into /rest/v1/<table> (single object or JSON array payloads),
+on_conflict upserts with merge-duplicates, simple filtered selects and an
+rpc/execute_sql endpoint that records migration batches. The edge functions
+probed by backend_test.py (/functions/v1/weather, field-analysis,
+fn-crop-disease, market-analysis/<crop> and selling-opportunities) answer
+with canned or table-derived payloads of the same shape.
+The third-party APIs the probes call (OpenWeatherMap, Sentinel Hub OAuth,
+process and statistics, PlantNet identify and Supabase auth) are served
+from stub_apis.py, so the whole suite can run hermetically.
+
+With --record the server instead proxies every request to the real upstream
+and appends the exchange to a cassette file; --replay serves recorded
+responses first (matched on method, path, query without API keys and body
+hash, then on method and path alone) and falls back to the canned handlers
+unless --strict is given. Fixed latency plus uniform jitter, random error
+statuses and a request rate limit that answers 429 with Retry-After can be
+injected to exercise client backoff; --seed makes the faults reproducible.
+
+    python stub_server.py --record cassettes/backend.json
+    python stub_server.py --replay cassettes/backend.json --latency 0.05 --jitter 0.1 --error-rate 0.02
+    STUB_URL=http://127.0.0.1:54321 python backend_test.py
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import os
+import random
+import re
+import secrets
+import threading
+import time
+import urllib.error
+import urllib.request
+from datetime import date
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import stub_apis
+
+REST_PREFIX = "/rest/v1/"
+RPC_PREFIX = "/rest/v1/rpc/"
+FUNCTIONS_PREFIX = "/functions/v1/"
+WEATHER_CONDITIONS = ("Clear", "Partly cloudy", "Overcast", "Light rain", "Thunderstorm")
+ERROR_MESSAGES = {500: "Internal Server Error", 502: "Bad Gateway", 503: "Service Unavailable",
+                  504: "Gateway Timeout"}
+
+# Real hosts behind each path prefix, used by --record
+UPSTREAMS = [
+    ("/data/2.5/", "https://api.openweathermap.org"),
+    ("/oauth/", "https://services.sentinel-hub.com"),
+    ("/auth/realms/", "https://services.sentinel-hub.com"),
+    ("/api/v1/", "https://services.sentinel-hub.com"),
+    ("/v2/", "https://my-api.plantnet.org"),
+    ("/auth/v1/", "https://bapqlyvfwxsichlyjxpd.supabase.co"),
+    ("/functions/v1/", "https://bapqlyvfwxsichlyjxpd.supabase.co"),
+    ("/rest/v1/", "https://bapqlyvfwxsichlyjxpd.supabase.co"),
+]
+FORWARDED_HEADERS = ("Authorization", "apikey", "Content-Type", "Accept", "Prefer")
+SECRET_PARAMS = ("appid", "api-key", "apikey", "key")
+# Stands in for OAuth tokens in cassettes; always accepted by the Sentinel Hub stub
+RECORDED_TOKEN = "recorded-access-token"
+
+# Ledger rows written by migration_runner.build_batch()
+LEDGER_INSERT = re.compile(
+    r"INSERT INTO public\.schema_migrations \(name, checksum\) VALUES \('((?:[^']|'')*)', '([0-9a-f]+)'\)")
+
+# Mirrors the CHECK constraint on public.market_listings
+CHECKS = {
+    "market_listings": {
+        "quality_rating": lambda v: v is None or 1 <= int(v) <= 5,
+        "price_per_unit": lambda v: v is not None,
+        "crop_type": lambda v: bool(v),
+    }
+}
+
+
+def upstream_for(path):
+    for prefix, host in UPSTREAMS:
+        if path.startswith(prefix):
+            return host
+    return None
+
+
+def _public_query(query):
+    """Query string with API keys removed and parameters sorted, for cassette matching"""
+    return urlencode(sorted((k, v) for k, v in parse_qsl(query, keep_blank_values=True) if k not in SECRET_PARAMS))
+
+
+def _mask_tokens(content_type, payload):
+    """Replace OAuth access tokens in a JSON response so cassettes hold no live credentials"""
+    if "json" not in (content_type or ""):
+        return payload
+    try:
+        body = json.loads(payload)
+    except ValueError:
+        return payload
+    if isinstance(body, dict) and "access_token" in body:
+        body["access_token"] = RECORDED_TOKEN
+        body.pop("refresh_token", None)
+        return json.dumps(body).encode("utf-8")
+    return payload
+
+
+class Cassette:
+    """Recorded upstream exchanges in a JSON file, matched on method, path, public query and body hash"""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = []
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.entries = json.load(f)["entries"]
+        self._exact = {}
+        self._loose = {}
+        for entry in self.entries:
+            self._index(entry)
+
+    def _index(self, entry):
+        self._exact.setdefault((entry["method"], entry["path"], entry["query"], entry["body_sha256"]), entry)
+        self._loose.setdefault((entry["method"], entry["path"]), entry)
+
+    def find(self, method, target, body):
+        """Return (status, content_type, payload) of the best recorded match, or None"""
+        parts = urlsplit(target)
+        key = (method, parts.path, _public_query(parts.query), hashlib.sha256(body).hexdigest())
+        entry = self._exact.get(key) or self._loose.get((method, parts.path))
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return entry["status"], entry["content_type"], base64.b64decode(entry["body"])
+
+    def add(self, method, target, body, status, content_type, payload):
+        parts = urlsplit(target)
+        entry = {"method": method, "path": parts.path, "query": _public_query(parts.query),
+                 "body_sha256": hashlib.sha256(body).hexdigest(), "status": status,
+                 "content_type": content_type, "body": base64.b64encode(_mask_tokens(content_type, payload)).decode()}
+        with self.lock:
+            self.entries.append(entry)
+            self._index(entry)
+            self.save()
+
+    def save(self):
+        """Write the cassette atomically (call with the lock held)"""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump({"entries": self.entries}, f, indent=1)
+        os.replace(temporary, self.path)
+
+
+def forward(method, target, headers, body, timeout=60):
+    """Send a request to its real upstream and return (status, content_type, payload)"""
+    upstream = upstream_for(urlsplit(target).path)
+    forwarded = {name: headers[name] for name in FORWARDED_HEADERS if headers.get(name)}
+    request = urllib.request.Request(upstream + target, data=body or None, method=method, headers=forwarded)
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status, response.headers.get("Content-Type"), response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers.get("Content-Type"), e.read()
+
+
+def _index_key(value):
+    """Hash index key of a column value: its text, as in.() operands compare it"""
+    return None if value is None else str(value)
+
+
+def _unindex(by_value, value, row):
+    """Drop row (by identity) from the hash index list under value"""
+    rows = [other for other in by_value.get(value, ()) if other is not row]
+    if rows:
+        by_value[value] = rows
+    else:
+        by_value.pop(value, None)
+
+
+class StubState:
+    """In-memory tables plus the fault injection settings of a stub server"""
+
+    def __init__(self, latency=0.0, error_rate=0.0, rate_limit=None, keep_rows=True, jitter=0.0,
+                 error_statuses=(503,), seed=None, cassette=None, record=False, strict=False, token_ttl=3600):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_statuses = tuple(error_statuses)
+        self.rate_limit = rate_limit
+        self.keep_rows = keep_rows
+        self.random = random.Random(seed)
+        self.cassette = cassette
+        self.record = record
+        self.strict = strict
+        self.token_ttl = token_ttl
+        self.tokens = {}
+        self.tokens_issued = 0
+        self.tables = {}
+        self.indexes = {}
+        self.market_index = None  # MarketIndex over market_listings, built on first use
+        self.row_counts = {}
+        self.requests = 0
+        self.throttled = 0
+        self.sql_scripts = []
+        self.lock = threading.Lock()
+        self._tokens = float(rate_limit or 0)
+        self._refilled = time.monotonic()
+
+    def take_token(self):
+        """Return True if the rate limiter admits another request"""
+        if not self.rate_limit:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self._tokens = min(float(self.rate_limit), self._tokens + (now - self._refilled) * self.rate_limit)
+            self._refilled = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            self.throttled += 1
+            return False
+
+    def delay(self):
+        """Injected latency for one request: the fixed part plus uniform jitter"""
+        if not self.jitter:
+            return self.latency
+        with self.lock:
+            return self.latency + self.random.uniform(0, self.jitter)
+
+    def injected_error(self):
+        """Status of an injected failure for this request, or None"""
+        if not self.error_rate:
+            return None
+        with self.lock:
+            if self.random.random() >= self.error_rate:
+                return None
+            return self.random.choice(self.error_statuses)
+
+    def issue_token(self):
+        """Mint a Sentinel Hub style access token valid for token_ttl seconds"""
+        token = secrets.token_urlsafe(24)
+        with self.lock:
+            self.tokens_issued += 1
+            self.tokens[token] = time.monotonic() + self.token_ttl
+        return token
+
+    def check_token(self, token):
+        if token == RECORDED_TOKEN:
+            return True
+        with self.lock:
+            expires = self.tokens.get(token)
+        return expires is not None and time.monotonic() < expires
+
+    def validate(self, table, rows):
+        """Return a PostgREST error dict for the first row violating a CHECK, else None"""
+        checks = CHECKS.get(table, {})
+        for row in rows:
+            for column, check in checks.items():
+                try:
+                    ok = check(row.get(column))
+                except (TypeError, ValueError):
+                    ok = False
+                if not ok:
+                    return {
+                        "code": "23514",
+                        "message": f'new row for relation "{table}" violates check constraint on "{column}"',
+                        "details": None,
+                        "hint": None,
+                    }
+        return None
+
+    def insert(self, table, rows):
+        """Validate and store rows, returning an error dict on the first violation"""
+        error = self.validate(table, rows)
+        if error:
+            return error
+        with self.lock:
+            self.row_counts[table] = self.row_counts.get(table, 0) + len(rows)
+            if self.keep_rows:
+                self.tables.setdefault(table, []).extend(rows)
+                for (indexed_table, column), index in self.indexes.items():
+                    if indexed_table == table:
+                        for row in rows:
+                            index.setdefault(_index_key(row.get(column)), []).append(row)
+                if table == "market_listings" and self.market_index is not None:
+                    self.market_index.observe([None] * len(rows), rows)
+        return None
+
+    def upsert(self, table, rows, conflict_column):
+        """Insert rows, merging into existing rows with the same conflict_column value"""
+        error = self.validate(table, rows)
+        if error:
+            return error
+        with self.lock:
+            index = self._index(table, conflict_column)
+            indexes = [(column, by_value) for (indexed_table, column), by_value in self.indexes.items()
+                       if indexed_table == table]
+            stored = self.tables.setdefault(table, [])
+            market = self.market_index if table == "market_listings" else None
+            for row in rows:
+                existing = index.get(_index_key(row.get(conflict_column)))
+                if existing:
+                    for match in list(existing):
+                        before = [match.get(column) for column, _ in indexes]
+                        if market is not None:
+                            market.remove(match)
+                        match.update(row)
+                        if market is not None:
+                            market.insert(match)
+                        for (column, by_value), old in zip(indexes, before):
+                            if match.get(column) != old:
+                                _unindex(by_value, _index_key(old), match)
+                                by_value.setdefault(_index_key(match.get(column)), []).append(match)
+                else:
+                    stored.append(row)
+                    for column, by_value in indexes:
+                        by_value.setdefault(_index_key(row.get(column)), []).append(row)
+                    if market is not None:
+                        market.insert(row)
+                    self.row_counts[table] = self.row_counts.get(table, 0) + 1
+        return None
+
+    def execute_sql(self, script):
+        """Record a script sent to rpc/execute_sql and apply its migration ledger entries"""
+        with self.lock:
+            self.sql_scripts.append(script)
+            ledger = self.tables.setdefault("schema_migrations", [])
+            for name, checksum in LEDGER_INSERT.findall(script):
+                name = name.replace("''", "'")
+                ledger[:] = [row for row in ledger if row["name"] != name]
+                ledger.append({"name": name, "checksum": checksum})
+
+    def call_function(self, name, params, payload):
+        """Answer an edge function call with (status, body)"""
+        if name == "weather":
+            try:
+                lat = float(params.get("lat", 0))
+            except ValueError:
+                return 400, {"error": "lat must be a number"}
+            return 200, {"tempC": round(30 - abs(lat) * 0.6, 1),
+                         "condition": WEATHER_CONDITIONS[int(abs(lat) * 10) % len(WEATHER_CONDITIONS)],
+                         "humidity": 60}
+        if name == "field-analysis":
+            return 404, {"error": "Field not found"}
+        if name == "fn-crop-disease":
+            if not isinstance(payload, dict) or not payload.get("imageBase64"):
+                return 400, {"success": False, "error": "imageBase64 is required"}
+            return 200, {"success": True, "disease": "Maize Leaf Blight", "confidence": 0.87,
+                         "cropType": payload.get("cropType")}
+        if name.startswith("market-analysis/"):
+            crop = name.split("/", 1)[1].casefold()
+            prices = [float(row["price_per_unit"]) for row in self.tables.get("market_listings", [])
+                      if str(row.get("crop_type", "")).casefold() == crop and row.get("price_per_unit") is not None]
+            return 200, {"crop": crop, "listings": len(prices),
+                         "average_price": sum(prices) / len(prices) if prices else None,
+                         "min_price": min(prices, default=None), "max_price": max(prices, default=None)}
+        if name == "selling-opportunities":
+            if not isinstance(payload, dict) or "farmer_location" not in payload:
+                return 400, {"error": "farmer_location is required"}
+            from market_spatial import MarketIndex, selling_opportunities
+            with self.lock:
+                if self.market_index is None:
+                    self.market_index = MarketIndex.from_rows(self.tables.get("market_listings", []))
+                opportunities = selling_opportunities(self.market_index, payload["farmer_location"],
+                                                      payload.get("farmer_crops") or [])
+            return 200, {"opportunities": opportunities}
+        return 404, {"error": f"Function {name} not found"}
+
+    def _index(self, table, column):
+        """Hash index value -> rows on table.column, built on first use (call with the lock held)
+
+        Columns need not be unique; every row with a value is listed under it.
+        """
+        key = (table, column)
+        if key not in self.indexes:
+            index = self.indexes[key] = {}
+            for row in self.tables.get(table, []):
+                index.setdefault(_index_key(row.get(column)), []).append(row)
+        return self.indexes[key]
+
+    def select(self, table, params):
+        """Apply PostgREST-style filters (eq, neq, gt, gte, lt, lte, in) to a table"""
+        rows = self.tables.get(table, [])
+        limit = None
+        offset = 0
+        columns = None
+        filters = []
+        for key, value in params:
+            if key == "limit":
+                limit = int(value)
+            elif key == "offset":
+                offset = int(value)
+            elif key == "select":
+                columns = None if value == "*" else value.split(",")
+            elif key not in ("order", "on_conflict", "columns"):
+                op, _, operand = value.partition(".")
+                filters.append((key, op, operand))
+        for position, (column, op, operand) in enumerate(filters):
+            if op == "in" and self.keep_rows:
+                with self.lock:
+                    index = self._index(table, column)
+                keys = dict.fromkeys(o.strip('"') for o in operand.strip("()").split(","))
+                rows = [row for k in keys for row in index.get(k, ())]
+                del filters[position]
+                break
+        result = [row for row in rows if all(_match(row.get(k), op, v) for k, op, v in filters)]
+        result = result[offset:offset + limit if limit is not None else None]
+        if columns:
+            result = [{c: row.get(c) for c in columns} for row in result]
+        return result
+
+
+def _json_value(value):
+    """Encode the Decimal and date values of rows stored from Python as PostgREST would"""
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, date):
+        return value.isoformat()
+    return str(value)
+
+
+def _coerce(value, operand):
+    if isinstance(value, bool):
+        return operand == "true"
+    if isinstance(value, (int, float)):
+        return float(operand)
+    return operand
+
+
+def _match(value, op, operand):
+    if op == "is":
+        return value is None if operand == "null" else str(value).lower() == operand
+    if value is None:
+        return False
+    if op == "in":
+        options = [o.strip('"') for o in operand.strip("()").split(",")]
+        return str(value) in options
+    try:
+        target = _coerce(value, operand)
+    except ValueError:
+        return False
+    if op == "eq":
+        return value == target
+    if op == "neq":
+        return value != target
+    if op == "gt":
+        return value > target
+    if op == "gte":
+        return value >= target
+    if op == "lt":
+        return value < target
+    if op == "lte":
+        return value <= target
+    return False
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Request handler serving the REST subset backed by the server's StubState"""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    server_version = "PostgRESTStub/1.0"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body=None, headers=None):
+        payload = b"" if body is None else json.dumps(body, default=_json_value).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if payload:
+            self.wfile.write(payload)
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _admit(self):
+        """Apply injected latency and faults; return False if the request was rejected"""
+        state = self.server.state
+        with state.lock:
+            state.requests += 1
+        if not state.take_token():
+            self._send_json(429, {"message": "Too Many Requests"}, {"Retry-After": "1"})
+            return False
+        delay = state.delay()
+        if delay:
+            time.sleep(delay)
+        status = state.injected_error()
+        if status:
+            self._send_json(status, {"message": ERROR_MESSAGES.get(status, "Injected failure")})
+            return False
+        return True
+
+    def _send_raw(self, status, content_type, payload):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type or "application/octet-stream")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _upstream(self, method, body=b""):
+        """Serve a recorded, proxied or canned third-party response; return False to fall through to the REST stub"""
+        state = self.server.state
+        if state.cassette is not None and not state.record:
+            recorded = state.cassette.find(method, self.path, body)
+            if recorded is not None:
+                self._send_raw(*recorded)
+                return True
+        if state.strict:
+            self._send_json(404, {"message": f"No recorded response for {method} {urlsplit(self.path).path}"})
+            return True
+        if state.record and upstream_for(urlsplit(self.path).path):
+            try:
+                exchange = forward(method, self.path, self.headers, body)
+            except (urllib.error.URLError, OSError) as e:
+                self._send_json(502, {"message": f"Upstream unreachable: {e}"})
+                return True
+            if state.cassette is not None:
+                state.cassette.add(method, self.path, body, *exchange)
+            self._send_raw(*exchange)
+            return True
+        parts = urlsplit(self.path)
+        handler = stub_apis.find_route(method, parts.path)
+        if handler is None:
+            return False
+        self._send_raw(*handler(state, dict(parse_qsl(parts.query)), self.headers, body))
+        return True
+
+    def _table(self):
+        path = urlsplit(self.path).path
+        if not path.startswith(REST_PREFIX):
+            return None
+        table = path[len(REST_PREFIX):].strip("/")
+        return table if re.fullmatch(r"(rpc/)?[A-Za-z_][A-Za-z0-9_]*", table) else None
+
+    def _function(self, payload=None):
+        """Serve /functions/v1/<name>; return False if the path is not a function call"""
+        parts = urlsplit(self.path)
+        if not parts.path.startswith(FUNCTIONS_PREFIX):
+            return False
+        name = parts.path[len(FUNCTIONS_PREFIX):].strip("/")
+        status, body = self.server.state.call_function(name, dict(parse_qsl(parts.query)), payload)
+        self._send_json(status, body)
+        return True
+
+    def do_POST(self):
+        body = self._read_body()
+        if not self._admit():
+            return
+        if self._upstream("POST", body):
+            return
+        if urlsplit(self.path).path.startswith(FUNCTIONS_PREFIX):
+            try:
+                payload = json.loads(body or b"null")
+            except ValueError:
+                payload = None
+            self._function(payload)
+            return
+        table = self._table()
+        if table is None:
+            self._send_json(404, {"message": "Not Found"})
+            return
+        try:
+            payload = json.loads(body or b"null")
+        except ValueError:
+            self._send_json(400, {"code": "PGRST102", "message": "Empty or invalid json"})
+            return
+        if urlsplit(self.path).path.startswith(RPC_PREFIX):
+            if table != "rpc/execute_sql" or not isinstance(payload, dict):
+                self._send_json(404, {"code": "PGRST202", "message": "Could not find the function"})
+                return
+            script = payload.get("sql") or payload.get("query") or ""
+            self.server.state.execute_sql(script)
+            self._send_json(200, None)
+            return
+        rows = payload if isinstance(payload, list) else [payload]
+        if not all(isinstance(row, dict) for row in rows):
+            self._send_json(400, {"code": "PGRST102", "message": "All object keys must match"})
+            return
+        params = dict(parse_qsl(urlsplit(self.path).query))
+        prefer = self.headers.get("Prefer") or ""
+        if "on_conflict" in params and "resolution=merge-duplicates" in prefer:
+            error = self.server.state.upsert(table, rows, params["on_conflict"])
+        else:
+            error = self.server.state.insert(table, rows)
+        if error:
+            self._send_json(400, error)
+        elif "return=representation" in prefer:
+            self._send_json(201, rows)
+        else:
+            self._send_json(201)
+
+    def do_GET(self):
+        if not self._admit():
+            return
+        if self._upstream("GET"):
+            return
+        if self._function():
+            return
+        table = self._table()
+        if table is None:
+            self._send_json(404, {"message": "Not Found"})
+            return
+        params = parse_qsl(urlsplit(self.path).query, keep_blank_values=True)
+        self._send_json(200, self.server.state.select(table, params))
+
+
+def start_stub_server(host="127.0.0.1", port=0, **options):
+    """Start a stub server in a daemon thread and return (server, base_url)"""
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    server.state = StubState(**options)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def main():
+    """Run the stub server in the foreground"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=54321)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra uniform random delay of up to this many seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with an error")
+    parser.add_argument("--error-status", default="503", help="comma-separated statuses to inject (default: 503)")
+    parser.add_argument("--rate-limit", type=float, default=None, help="requests/sec before answering 429")
+    parser.add_argument("--seed", type=int, help="seed for jitter and injected errors")
+    parser.add_argument("--token-ttl", type=int, default=3600, help="lifetime of issued Sentinel Hub tokens in seconds")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--record", metavar="CASSETTE", help="proxy to the real APIs and record responses")
+    mode.add_argument("--replay", metavar="CASSETTE", help="serve recorded responses before the canned ones")
+    parser.add_argument("--strict", action="store_true", help="with --replay, answer 404 for unrecorded requests")
+    args = parser.parse_args()
+    if args.strict and not args.replay:
+        parser.error("--strict requires --replay")
+    if args.replay and not os.path.exists(args.replay):
+        parser.error(f"cassette {args.replay} does not exist")
+
+    cassette = Cassette(args.record or args.replay) if args.record or args.replay else None
+    server = ThreadingHTTPServer((args.host, args.port), StubHandler)
+    server.daemon_threads = True
+    server.state = StubState(latency=args.latency, error_rate=args.error_rate, rate_limit=args.rate_limit,
+                             jitter=args.jitter, error_statuses=[int(s) for s in args.error_status.split(",")],
+                             seed=args.seed, cassette=cassette, record=bool(args.record), strict=args.strict,
+                             token_ttl=args.token_ttl)
+    mode = f"recording to {args.record}" if args.record else f"replaying {args.replay}" if args.replay else "canned"
+    print(f"Stub server listening on http://{args.host}:{args.port} ({mode})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if cassette is not None:
+            print(f"Cassette: {len(cassette.entries)} entries, {cassette.hits} hits, {cassette.misses} misses")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+Shared OpenWeatherMap response cache keyed by spatial grid cell.
+
+Farms a few hundred metres apart get identical forecasts, so lookups are
+snapped to a grid cell (0.05 degree squares by default, or geohash cells with
+grid="geohash6") and upstream is asked once per cell, for the cell centre.
+Current conditions and the 5-day forecast have separate TTLs; both live in
+one LRU bounded by max_entries. Concurrent misses for the same cell and kind
+wait on a single upstream request (single-flight); failures are not cached.
+stats() reports hits, misses, coalesced waits, upstream calls, evictions and
+the hit rate.
+
+    cache = WeatherCache(api_key=OPENWEATHERMAP_API_KEY)
+    forecast = cache.forecast(-1.2864, 36.8172)
+    print(cache.stats())
+
+    python weather_cache.py --stub --farms 20000 --requests 200000 --grid geohash6
+"""
+
+import argparse
+import math
+import random
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+
+from market_spatial import BITS, cell, cell_centre, encode_many
+
+OPENWEATHERMAP_URL = "https://api.openweathermap.org"
+DEFAULT_GRID = 0.05  # degrees, about 5.5 km at the equator
+CURRENT_TTL = 10 * 60  # seconds; OpenWeatherMap refreshes current conditions about every 10 minutes
+FORECAST_TTL = 3 * 3600  # seconds; the forecast has a 3-hour step
+MAX_ENTRIES = 50_000
+
+
+class Grid:
+    """Snaps coordinates to cells: a step in degrees (0.05) or "geohash<precision>" ("geohash6")"""
+
+    def __init__(self, spec=DEFAULT_GRID):
+        self.spec = spec
+        if isinstance(spec, str) and spec.startswith("geohash"):
+            self.precision = int(spec[len("geohash"):] or 6)
+            self.step = None
+        else:
+            self.precision = None
+            self.step = float(spec)
+            if self.step <= 0:
+                raise ValueError("grid step must be positive")
+
+    def key(self, lat, lng):
+        """Hashable cell id of a point"""
+        if self.step is None:
+            return cell(lat, lng, self.precision)
+        return math.floor(lat / self.step), math.floor(lng / self.step)
+
+    def key_array(self, lat, lng):
+        """Vectorized key() over coordinate arrays: one int64 row of key components per point"""
+        lat = np.asarray(lat, dtype=np.float64)
+        lng = np.asarray(lng, dtype=np.float64)
+        if self.step is None:
+            shift = np.uint64(2 * BITS - 5 * self.precision)
+            return (encode_many(lat, lng) >> shift).astype(np.int64)[:, None]
+        return np.stack([np.floor(lat / self.step), np.floor(lng / self.step)], axis=1).astype(np.int64)
+
+    def key_of(self, row):
+        """The key() of one row of key_array()"""
+        return int(row[0]) if self.step is None else (int(row[0]), int(row[1]))
+
+    def centre(self, key):
+        """(lat, lng) sent upstream for a cell"""
+        if self.step is None:
+            lat, lng = cell_centre(key, self.precision)
+        else:
+            lat, lng = (key[0] + 0.5) * self.step, (key[1] + 0.5) * self.step
+        return round(lat, 4), round(lng, 4)
+
+
+class _Flight:
+    """An upstream request in progress that later callers for the same key wait on"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class WeatherCache:
+    """Grid-quantized, TTL-expiring, LRU-bounded weather cache with single-flight misses
+
+    fetch(kind, lat, lng) returns the parsed response for kind "weather" or
+    "forecast"; by default it calls OpenWeatherMap with api_key.
+    """
+
+    def __init__(self, fetch=None, grid=DEFAULT_GRID, current_ttl=CURRENT_TTL, forecast_ttl=FORECAST_TTL,
+                 max_entries=MAX_ENTRIES, base_url=OPENWEATHERMAP_URL, api_key=None, pool_size=16,
+                 clock=time.monotonic):
+        self.grid = grid if isinstance(grid, Grid) else Grid(grid)
+        self.ttls = {"weather": current_ttl, "forecast": forecast_ttl}
+        self.max_entries = max_entries
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.fetch = fetch or self._fetch_upstream
+        self.clock = clock
+        self.entries = OrderedDict()  # (kind, cell) -> (value, expires)
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.expired = 0
+        self.evictions = 0
+        self.upstream_calls = 0
+        self.upstream_errors = 0
+        self.session = None
+        if fetch is None:
+            self.session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            self.session.mount("http://", adapter)
+            self.session.mount("https://", adapter)
+
+    def _fetch_upstream(self, kind, lat, lng):
+        response = self.session.get(f"{self.base_url}/data/2.5/{kind}",
+                                    params={"lat": lat, "lon": lng, "appid": self.api_key}, timeout=30)
+        response.raise_for_status()
+        return response.json()
+
+    def current(self, lat, lng):
+        """Current conditions for the cell containing (lat, lng)"""
+        return self.get("weather", lat, lng)
+
+    def forecast(self, lat, lng):
+        """5-day / 3-hour forecast for the cell containing (lat, lng)"""
+        return self.get("forecast", lat, lng)
+
+    def get(self, kind, lat, lng):
+        if kind not in self.ttls:
+            raise ValueError(f"unknown weather kind {kind!r}")
+        key = (kind, self.grid.key(lat, lng))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if self.clock() < entry[1]:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                del self.entries[key]
+                self.expired += 1
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = _Flight()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        try:
+            flight.value = self.fetch(kind, *self.grid.centre(key[1]))
+        except Exception as e:
+            flight.error = e
+            with self.lock:
+                self.upstream_calls += 1
+                self.upstream_errors += 1
+            raise
+        else:
+            with self.lock:
+                self.upstream_calls += 1
+                self.entries[key] = (flight.value, self.clock() + self.ttls[kind])
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+                    self.evictions += 1
+            return flight.value
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.event.set()
+
+    def invalidate(self, kind=None):
+        """Drop every cached entry, or only those of one kind"""
+        with self.lock:
+            for key in [k for k in self.entries if kind is None or k[0] == kind]:
+                del self.entries[key]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        """Counters plus hit_rate (hits and coalesced waits over all lookups)"""
+        with self.lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                "lookups": lookups,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "expired": self.expired,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "upstream_calls": self.upstream_calls,
+                "upstream_errors": self.upstream_errors,
+                "hit_rate": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+            }
+
+
+def run_simulation(cache, farms=5000, lookups=50_000, forecast_share=0.3, workers=32, seed=7):
+    """Replay lookups from farms scattered around the test regions and return (stats, elapsed)"""
+    from load_test import random_location
+
+    rng = random.Random(seed)
+    locations = [random_location(rng) for _ in range(farms)]
+    calls = [("forecast" if rng.random() < forecast_share else "weather", *rng.choice(locations))
+             for _ in range(lookups)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for _ in executor.map(lambda call: cache.get(*call), calls, chunksize=64):
+            pass
+    return cache.stats(), time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default=OPENWEATHERMAP_URL, help="OpenWeatherMap (or stub server) base URL")
+    parser.add_argument("--api-key", help="OpenWeatherMap API key (default: the backend test key)")
+    parser.add_argument("--stub", action="store_true", help="run against an in-process stub server")
+    parser.add_argument("--stub-latency", type=float, default=0.02, help="seconds the stub adds to every request")
+    parser.add_argument("--grid", default=str(DEFAULT_GRID), help="cell size in degrees, or geohash<precision>")
+    parser.add_argument("--farms", type=int, default=20_000)
+    parser.add_argument("--requests", type=int, default=200_000, help="lookups to replay")
+    parser.add_argument("--forecast-share", type=float, default=0.3, help="fraction of lookups that are forecasts")
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument("--max-entries", type=int, default=MAX_ENTRIES)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    base_url = args.url
+    if args.stub:
+        from stub_server import start_stub_server
+        server, base_url = start_stub_server(latency=args.stub_latency)
+    api_key = args.api_key
+    if api_key is None:
+        from backend_test import OPENWEATHERMAP_API_KEY as api_key
+    cache = WeatherCache(grid=args.grid, max_entries=args.max_entries, base_url=base_url, api_key=api_key,
+                         pool_size=args.workers)
+    stats, elapsed = run_simulation(cache, args.farms, args.requests, args.forecast_share, args.workers, args.seed)
+
+    print(f"Grid {cache.grid.spec}: {args.requests} lookups from {args.farms} farms in {elapsed:.2f}s "
+          f"({args.requests / elapsed:.0f}/s)")
+    print(f"  upstream calls {stats['upstream_calls']} ({stats['upstream_errors']} failed) instead of "
+          f"{args.requests}: {args.requests / max(1, stats['upstream_calls']):.0f}x fewer")
+    print(f"  hit rate {stats['hit_rate']:.1%}  hits {stats['hits']}  coalesced {stats['coalesced']}  "
+          f"misses {stats['misses']}  evictions {stats['evictions']}  cached cells {stats['entries']}")
+    return 1 if stats["upstream_errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())